@@ -22,6 +22,7 @@ import (
 	"os"
 	"os/signal"
 	"syscall"
+	"time"
 
 	"github.com/frp-manager/agent/internal/config"
 	"github.com/frp-manager/agent/internal/frpc"
@@ -101,6 +102,7 @@ func main() {
 	sysMonitor := monitor.NewMonitor()
 	frpcManager := frpc.NewManager(cfg.FRPCPath, cfg.ConfigPath, logCollector)
 	wsClient := ws.NewClient(cfg.ServerURL, cfg.ClientID, cfg.Token, version)
+	wsClient.ConfigHash = frpcManager.ConfigHash
 
 	// 设置 WebSocket 消息处理器
 	wsClient.OnMessage = func(msg ws.Message) {
@@ -108,17 +110,35 @@ func main() {
 		case "config_update":
 			log.Println("收到配置更新，正在重载 FRPC...")
 			if configData, ok := msg.Data.(string); ok {
-				if err := frpcManager.UpdateConfig(configData); err != nil {
+				err := frpcManager.UpdateConfig(configData)
+				if err != nil {
 					log.Printf("配置更新失败: %v", err)
 				} else {
 					log.Println("配置更新成功")
 				}
+				// 带版本号的下发需要回复确认，服务端据此跟踪配置收敛并停止重发
+				if msg.Version > 0 {
+					ack := map[string]interface{}{"version": msg.Version, "hash": msg.Hash, "ok": err == nil}
+					if err != nil {
+						ack["error"] = err.Error()
+					}
+					wsClient.Send("config_ack", ack)
+				}
 			}
 		case "restart":
 			log.Println("收到重启命令...")
 			frpcManager.Restart()
 		case "ping":
 			wsClient.Send("pong", nil)
+		case "throttle":
+			// 服务端限流：在 retry_after 秒内暂停发送该类型消息
+			if data, ok := msg.Data.(map[string]interface{}); ok {
+				msgType, _ := data["message_type"].(string)
+				retryAfter, _ := data["retry_after"].(float64)
+				if msgType != "" && retryAfter > 0 {
+					wsClient.Throttle(msgType, time.Duration(retryAfter*float64(time.Second)))
+				}
+			}
 		}
 	}
 
@@ -3,6 +3,9 @@ package frpc
 
 import (
 	"bufio"
+	"bytes"
+	"crypto/sha256"
+	"encoding/hex"
 	"fmt"
 	"io"
 	"log"
@@ -167,12 +170,19 @@ func (m *Manager) Restart() error {
 
 // UpdateConfig 更新配置并重载
 func (m *Manager) UpdateConfig(newConfig string) error {
+	// 内容未变化且进程在运行时无需重写文件和重载
+	current, readErr := os.ReadFile(m.configPath)
+	if readErr == nil && bytes.Equal(current, []byte(newConfig)) && m.IsRunning() {
+		log.Println("[FRPC] 配置未变化，跳过重载")
+		return nil
+	}
+
 	log.Println("[FRPC] 正在更新配置...")
 
 	// 备份旧配置
 	backupPath := m.configPath + ".bak"
-	if data, err := os.ReadFile(m.configPath); err == nil {
-		os.WriteFile(backupPath, data, 0644)
+	if readErr == nil {
+		os.WriteFile(backupPath, current, 0644)
 	}
 
 	// 写入新配置
@@ -202,6 +212,16 @@ func (m *Manager) UpdateConfig(newConfig string) error {
 	return m.Start()
 }
 
+// ConfigHash 返回本地配置文件内容的 sha256（十六进制），文件不存在时返回空串
+func (m *Manager) ConfigHash() string {
+	data, err := os.ReadFile(m.configPath)
+	if err != nil {
+		return ""
+	}
+	sum := sha256.Sum256(data)
+	return hex.EncodeToString(sum[:])
+}
+
 // checkAdminAPIAvailable 检查 Admin API 端口是否可达
 func (m *Manager) checkAdminAPIAvailable() bool {
 	timeout := 100 * time.Millisecond
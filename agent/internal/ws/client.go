@@ -15,8 +15,10 @@ import (
 
 // Message WebSocket 消息结构
 type Message struct {
-	Type string      `json:"type"`
-	Data interface{} `json:"data,omitempty"`
+	Type    string      `json:"type"`
+	Data    interface{} `json:"data,omitempty"`
+	Hash    string      `json:"hash,omitempty"`    // config_update: 配置内容的 sha256
+	Version int64       `json:"version,omitempty"` // config_update: 下发版本号，应用后通过 config_ack 回复
 }
 
 // Client WebSocket 客户端
@@ -29,10 +31,12 @@ type Client struct {
 	conn         *websocket.Conn
 	mu           sync.Mutex
 	isRunning    bool
+	throttled    map[string]time.Time // 消息类型 -> 服务端要求暂停发送的截止时间
 	reconnect    bool
 	OnMessage    func(Message)
 	OnConnect    func()
 	OnDisconnect func()
+	ConfigHash   func() string // 注册时上报本地 frpc 配置的哈希，服务端据此跳过相同内容的推送
 }
 
 // NewClient 创建新的 WebSocket 客户端
@@ -43,6 +47,7 @@ func NewClient(serverURL, clientID, token, version string) *Client {
 		token:     token,
 		version:   version,
 		reconnect: true,
+		throttled: make(map[string]time.Time),
 	}
 }
 
@@ -84,6 +89,8 @@ func (c *Client) connect() error {
 
 	c.mu.Lock()
 	c.conn = conn
+	// 限流只针对上一次连接，重连后的注册等消息不能被旧的暂停截止时间丢弃
+	c.throttled = make(map[string]time.Time)
 	c.mu.Unlock()
 
 	log.Println("[WebSocket] 连接成功")
@@ -92,13 +99,19 @@ func (c *Client) connect() error {
 	hostname, _ := os.Hostname()
 
 	// 发送注册消息（包含系统信息）
-	c.Send("register", map[string]string{
+	register := map[string]string{
 		"client_id": c.clientID,
 		"version":   c.version,
 		"hostname":  hostname,
 		"os":        runtime.GOOS,
 		"arch":      runtime.GOARCH,
-	})
+	}
+	if c.ConfigHash != nil {
+		if h := c.ConfigHash(); h != "" {
+			register["config_hash"] = h
+		}
+	}
+	c.Send("register", register)
 
 	if c.OnConnect != nil {
 		c.OnConnect()
@@ -135,13 +148,25 @@ func (c *Client) readLoop() {
 	}
 }
 
+// Throttle 服务端限流时调用，在 d 时间内丢弃该类型的消息
+func (c *Client) Throttle(msgType string, d time.Duration) {
+	c.mu.Lock()
+	c.throttled[msgType] = time.Now().Add(d)
+	c.mu.Unlock()
+}
+
 // Send 发送消息到服务端
 func (c *Client) Send(msgType string, data interface{}) error {
 	c.mu.Lock()
 	conn := c.conn
+	until, throttled := c.throttled[msgType]
+	if throttled && !time.Now().Before(until) {
+		delete(c.throttled, msgType)
+		throttled = false
+	}
 	c.mu.Unlock()
 
-	if conn == nil {
+	if conn == nil || throttled {
 		return nil
 	}
 
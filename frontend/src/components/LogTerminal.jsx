@@ -1,12 +1,56 @@
 import Ansi from 'ansi-to-react';
 import React, { useEffect, useRef, useState } from 'react';
-import { Terminal, X, Download, Pause, Play, Trash2 } from 'lucide-react';
+import { Terminal, X, Download, Pause, Play, Trash2, Filter } from 'lucide-react';
+
+// 断线重连的退避时间
+const RECONNECT_BASE_MS = 1000;
+const RECONNECT_MAX_MS = 30000;
+
+// 服务端过滤条件 -> URL 参数 / filter 消息
+const buildFilter = ({ level, contains }) => ({
+    level: level || '',
+    contains: contains.trim(),
+});
 
 const LogTerminal = ({ clientId, onClose, clientName }) => {
     const [logs, setLogs] = useState([]);
     const [isConnected, setIsConnected] = useState(false);
     const [isPaused, setIsPaused] = useState(false);
+    const [filter, setFilter] = useState({ level: '', contains: '' });
     const terminalRef = useRef(null);
+    const wsRef = useRef(null);
+    const filterRef = useRef(filter);
+    // 已收到的最大日志序号，重连时用于续传
+    const lastSeqRef = useRef({ clientId, seq: null });
+    // 暂停期间收到的日志先缓存（不断开连接），恢复时一次性追加
+    const isPausedRef = useRef(isPaused);
+    const pausedLogsRef = useRef([]);
+
+    const appendLogs = (entries) => {
+        if (isPausedRef.current) {
+            const buffered = pausedLogsRef.current.concat(entries);
+            pausedLogsRef.current = buffered.length > 1000 ? buffered.slice(buffered.length - 1000) : buffered;
+            return;
+        }
+        setLogs(prev => {
+            const newLogs = prev.concat(entries);
+            if (newLogs.length > 1000) return newLogs.slice(newLogs.length - 1000);
+            return newLogs;
+        });
+    };
+
+    useEffect(() => {
+        isPausedRef.current = isPaused;
+        if (!isPaused && pausedLogsRef.current.length) {
+            const buffered = pausedLogsRef.current;
+            pausedLogsRef.current = [];
+            setLogs(prev => {
+                const newLogs = prev.concat(buffered);
+                if (newLogs.length > 1000) return newLogs.slice(newLogs.length - 1000);
+                return newLogs;
+            });
+        }
+    }, [isPaused]);
 
     useEffect(() => {
         // 动态判断 WebSocket URL
@@ -25,72 +69,150 @@ const LogTerminal = ({ clientId, onClose, clientName }) => {
         // 如果你是 create-vite-app 配置了 proxy，那么 ws://localhost:5173/ws/... 会被转发
         // 如果没有 proxy，直接连后端端口
 
-        let wsUrl = `${protocol}//${window.location.host}/ws/logs/${clientId}`;
+        let baseUrl = `${protocol}//${window.location.host}/ws/logs/${clientId}`;
         if (window.location.port === '5173') {
             // Dev mode specific override if needed, usually Vite proxy handles this
             // But if not using Vite proxy for WS:
-            wsUrl = `ws://localhost:8000/ws/logs/${clientId}`;
+            baseUrl = `ws://localhost:8000/ws/logs/${clientId}`;
         }
 
-        const token = localStorage.getItem('token');
-        if (token) {
-            wsUrl += `?token=${token}`;
-        }
+        let unmounted = false;
+        let retries = 0;
+        let retryTimer = null;
 
-        console.log("Connecting Log WS:", wsUrl);
-        const ws = new WebSocket(wsUrl);
+        const connect = () => {
+            const params = new URLSearchParams();
+            const token = localStorage.getItem('token');
+            if (token) {
+                params.set('token', token);
+            }
+            // 初始过滤条件随连接一起发送，历史日志回放也会按条件过滤
+            const connectFilter = filterRef.current;
+            Object.entries(buildFilter(connectFilter)).forEach(([key, value]) => {
+                if (value) params.set(key, value);
+            });
+            if (lastSeqRef.current.seq !== null) {
+                params.set('after', lastSeqRef.current.seq);
+            }
+            let wsUrl = baseUrl;
+            const query = params.toString();
+            if (query) {
+                wsUrl += `?${query}`;
+            }
 
-        ws.onopen = () => {
-            setIsConnected(true);
-            setLogs(prev => [...prev, { type: 'info', content: `Connected to log stream for ${clientName || clientId}...`, ts: Date.now() }]);
-        };
+            console.log("Connecting Log WS:", wsUrl);
+            const ws = new WebSocket(wsUrl);
+            wsRef.current = ws;
+
+            ws.onopen = () => {
+                retries = 0;
+                setIsConnected(true);
+                setLogs(prev => [...prev, { type: 'info', content: `Connected to log stream for ${clientName || clientId}...`, ts: Date.now() }]);
+                // 连接建立期间过滤条件又变了
+                if (filterRef.current !== connectFilter) {
+                    ws.send(JSON.stringify({ type: 'filter', ...buildFilter(filterRef.current) }));
+                }
+            };
+
+            ws.onmessage = (event) => {
+                if (document.hidden && logs.length > 2000) return; // 简单的性能保护
+                try {
+                    // Server sends JSON string: {"type": "log", "data": "...", ...}
+                    const message = JSON.parse(event.data);
+
+                    // 批量日志帧：一次 setState 追加整批
+                    if (message.type === 'log_batch') {
+                        if (!Array.isArray(message.data)) return;
+                        if (Array.isArray(message.seqs) && message.seqs.length) {
+                            const last = message.seqs[message.seqs.length - 1];
+                            if (lastSeqRef.current.seq === null || last > lastSeqRef.current.seq) {
+                                lastSeqRef.current.seq = last;
+                            }
+                        }
+                        const ts = Date.now();
+                        appendLogs(message.data.map(content => ({ type: 'log', content, ts })));
+                        return;
+                    }
+
+                    // 续传位置之后的部分日志已被清理
+                    if (message.type === 'log_gap') {
+                        setLogs(prev => [...prev, { type: 'info', content: `... ${message.lost} log lines lost while disconnected ...`, ts: Date.now() }]);
+                        return;
+                    }
 
-        ws.onmessage = (event) => {
-            if (document.hidden && logs.length > 2000) return; // 简单的性能保护
-            try {
-                // Server sends JSON string: {"type": "log", "data": "...", ...}
-                const message = JSON.parse(event.data);
+                    if (message.type === 'filter_error') {
+                        setLogs(prev => [...prev, { type: 'error', content: `Filter error: ${message.detail}`, ts: Date.now() }]);
+                        return;
+                    }
 
-                // Only handle log messages
-                if (message.type !== 'log' && message.type !== 'info') return;
+                    // Only handle log messages
+                    if (message.type !== 'log' && message.type !== 'info') return;
 
-                let content = message.data || "";
+                    let content = message.data || "";
 
-                if (!isPaused) {
-                    setLogs(prev => {
-                        const newLogs = [...prev, { type: message.type || 'log', content, ts: Date.now() }];
-                        if (newLogs.length > 1000) return newLogs.slice(newLogs.length - 1000);
-                        return newLogs;
-                    });
+                    appendLogs([{ type: message.type || 'log', content, ts: Date.now() }]);
+                } catch (e) {
+                    // Fallback for non-JSON raw text (just in case)
+                    console.warn("Log parsing warning:", e);
+                    appendLogs([{ type: 'log', content: event.data, ts: Date.now() }]);
                 }
-            } catch (e) {
-                // Fallback for non-JSON raw text (just in case)
-                console.warn("Log parsing warning:", e);
-                const content = event.data;
-                if (!isPaused) {
-                    setLogs(prev => {
-                        const newLogs = [...prev, { type: 'log', content, ts: Date.now() }];
-                        return newLogs.slice(-1000);
-                    });
+            };
+
+            ws.onclose = (e) => {
+                if (unmounted) return;
+                wsRef.current = null;
+                setIsConnected(false);
+                // 1008 为鉴权失败，重连也不会成功
+                if (e.code === 1008) {
+                    setLogs(prev => [...prev, { type: 'info', content: `Connection closed (Code: ${e.code}).`, ts: Date.now() }]);
+                    return;
                 }
-            }
-        };
+                // 指数退避重连，带上已收到的最大序号续传，不会重复回放
+                const delay = Math.min(RECONNECT_BASE_MS * 2 ** retries, RECONNECT_MAX_MS);
+                retries += 1;
+                setLogs(prev => [...prev, { type: 'info', content: `Connection closed (Code: ${e.code}), reconnecting in ${Math.round(delay / 1000)}s...`, ts: Date.now() }]);
+                retryTimer = setTimeout(connect, delay);
+            };
 
-        ws.onclose = (e) => {
-            setIsConnected(false);
-            setLogs(prev => [...prev, { type: 'info', content: `Connection closed (Code: ${e.code}).`, ts: Date.now() }]);
+            ws.onerror = () => {
+                if (unmounted) return;
+                setLogs(prev => [...prev, { type: 'error', content: 'WebSocket connection error.', ts: Date.now() }]);
+            };
         };
 
-        ws.onerror = () => {
-            setLogs(prev => [...prev, { type: 'error', content: 'WebSocket connection error.', ts: Date.now() }]);
-        };
+        if (lastSeqRef.current.clientId !== clientId) {
+            lastSeqRef.current = { clientId, seq: null };
+        }
+        connect();
 
         return () => {
-            if (ws.readyState === WebSocket.OPEN) {
+            unmounted = true;
+            clearTimeout(retryTimer);
+            const ws = wsRef.current;
+            wsRef.current = null;
+            if (ws && (ws.readyState === WebSocket.OPEN || ws.readyState === WebSocket.CONNECTING)) {
                 ws.close();
             }
         };
-    }, [clientId, clientName, isPaused]);
+    }, [clientId, clientName]);
+
+    // 过滤条件变化时通知服务端（防抖），服务端会按新条件重新回放历史
+    useEffect(() => {
+        if (filterRef.current === filter) return;
+        filterRef.current = filter;
+        const timer = setTimeout(() => {
+            const ws = wsRef.current;
+            setLogs([]);
+            pausedLogsRef.current = [];
+            if (ws && ws.readyState === WebSocket.OPEN) {
+                ws.send(JSON.stringify({ type: 'filter', ...buildFilter(filter) }));
+            } else {
+                // 正在重连：下次连接按新条件重新回放全部历史
+                lastSeqRef.current.seq = null;
+            }
+        }, 300);
+        return () => clearTimeout(timer);
+    }, [filter]);
 
     // Auto scroll
     useEffect(() => {
@@ -99,7 +221,10 @@ const LogTerminal = ({ clientId, onClose, clientName }) => {
         }
     }, [logs, isPaused]);
 
-    const handleClear = () => setLogs([]);
+    const handleClear = () => {
+        setLogs([]);
+        pausedLogsRef.current = [];
+    };
 
     const handleDownload = () => {
         const text = logs.map(l => l.content).join('\n');
@@ -131,6 +256,26 @@ const LogTerminal = ({ clientId, onClose, clientName }) => {
                         </span>
                     </div>
                     <div className="flex items-center gap-1">
+                        <div className="flex items-center gap-1 mr-2 px-2 py-1 bg-slate-800 rounded border border-slate-700">
+                            <Filter size={14} className="text-slate-500" />
+                            <select
+                                value={filter.level}
+                                onChange={(e) => setFilter(f => ({ ...f, level: e.target.value }))}
+                                className="bg-transparent text-slate-300 text-xs outline-none"
+                                title="Minimum Level"
+                            >
+                                <option value="">ALL</option>
+                                <option value="info">INFO+</option>
+                                <option value="warn">WARN+</option>
+                                <option value="error">ERROR</option>
+                            </select>
+                            <input
+                                value={filter.contains}
+                                onChange={(e) => setFilter(f => ({ ...f, contains: e.target.value }))}
+                                placeholder="Filter..."
+                                className="w-36 bg-transparent text-slate-300 text-xs outline-none placeholder:text-slate-600"
+                            />
+                        </div>
                         <button
                             onClick={() => setIsPaused(!isPaused)}
                             className={`p-2 rounded hover:bg-slate-700 transition-colors ${isPaused ? 'text-amber-400 bg-amber-400/10' : 'text-slate-400'}`}
@@ -175,7 +175,14 @@ export function useLogStream(clientId, enabled = true) {
     const maxLogs = 1000; // 最多保留 1000 条日志
 
     const handleMessage = useCallback((msg) => {
-        if (msg?.type === 'log') {
+        if (msg?.type === 'log_batch' && Array.isArray(msg.data)) {
+            const timestamp = new Date().toISOString();
+            setLogs(prev => prev.concat(msg.data.map(text => ({
+                timestamp,
+                text,
+                clientId: msg.client_id
+            }))).slice(-maxLogs));
+        } else if (msg?.type === 'log') {
             setLogs(prev => {
                 const newLogs = [...prev, {
                     timestamp: new Date().toISOString(),
@@ -0,0 +1,130 @@
+"""
+Agent 元信息缓存
+在内存中保存每个客户端的 AgentInfo 字段和客户端名称，
+只有当上报的值与缓存不同时才写数据库，稳态心跳不再读写元信息表。
+缓存会被数据库线程池和单写入线程同时访问，所有读写都持有同一把锁
+"""
+from sqlalchemy.orm import Session
+from typing import Dict, Optional
+import logging
+import threading
+
+import models
+
+logger = logging.getLogger(__name__)
+
+# 参与脏检查的 AgentInfo 字段
+AGENT_INFO_FIELDS = ("hostname", "os", "arch", "agent_version", "platform")
+
+
+class AgentInfoCache:
+    """AgentInfo / 客户端名称的写穿缓存"""
+
+    def __init__(self):
+        # client_id -> AgentInfo 字段快照；值为 None 表示数据库中没有记录
+        self._info: Dict[str, Optional[dict]] = {}
+
+        # client_id -> Client.name
+        self._client_names: Dict[str, str] = {}
+
+        # 可重入：update 内部会调用 _load
+        self._lock = threading.RLock()
+
+    # ========================
+    # AgentInfo
+    # ========================
+
+    def _load(self, db: Session, client_id: str) -> Optional[dict]:
+        """缓存未命中时从数据库加载一次"""
+        with self._lock:
+            if client_id in self._info:
+                return self._info[client_id]
+
+            agent = db.query(models.AgentInfo).filter(
+                models.AgentInfo.client_id == client_id
+            ).first()
+            snapshot = None
+            if agent:
+                snapshot = {field: getattr(agent, field) for field in AGENT_INFO_FIELDS}
+            self._info[client_id] = snapshot
+            return snapshot
+
+    def get(self, db: Session, client_id: str) -> Optional[dict]:
+        """获取 AgentInfo 字段快照（只读，调用方不要修改返回值）"""
+        return self._load(db, client_id)
+
+    def update(self, db: Session, client_id: str, fields: dict, create: bool = False) -> bool:
+        """
+        合并上报字段，仅在值发生变化时写数据库
+
+        Args:
+            fields: 上报的字段，只比较出现在其中的键
+            create: 数据库中没有记录时是否新建
+
+        Returns:
+            是否执行了数据库写入（调用方需自行 commit）
+        """
+        fields = {k: v for k, v in fields.items() if k in AGENT_INFO_FIELDS}
+        # 检查与新建在同一个临界区内，同一客户端的并发上报不会重复插入记录
+        with self._lock:
+            snapshot = self._load(db, client_id)
+
+            if snapshot is None:
+                if not create:
+                    return False
+                agent = models.AgentInfo(client_id=client_id, **fields)
+                db.add(agent)
+                self._info[client_id] = {field: fields.get(field) for field in AGENT_INFO_FIELDS}
+                return True
+
+            changed = {k: v for k, v in fields.items() if snapshot.get(k) != v}
+            if not changed:
+                return False
+
+            db.query(models.AgentInfo).filter(
+                models.AgentInfo.client_id == client_id
+            ).update(changed, synchronize_session=False)
+            # 换成新的快照，get() 返回给其他线程的旧快照保持不变
+            self._info[client_id] = {**snapshot, **changed}
+            return True
+
+    # ========================
+    # 客户端名称
+    # ========================
+
+    def sync_client_name(self, db: Session, client_id: str, name: str) -> bool:
+        """确保客户端名称为 name，名称不变时不访问数据库；返回是否改名"""
+        with self._lock:
+            if not name or self._client_names.get(client_id) == name:
+                return False
+
+        # 提交要等待写锁，不在持有缓存锁时进行（单写入线程的事务里也会用到这把锁）
+        client = db.query(models.Client).filter(models.Client.id == client_id).first()
+        if not client:
+            return False
+        changed = client.name != name
+        if changed:
+            client.name = name
+            db.commit()
+        with self._lock:
+            self._client_names[client_id] = name
+        return changed
+
+    def set_client_name(self, client_id: str, name: str):
+        """客户端名称被其他路径修改后同步缓存"""
+        with self._lock:
+            self._client_names[client_id] = name
+
+    def invalidate(self, client_id: str = None):
+        """丢弃缓存（client_id 为空时全部丢弃），下次访问重新从数据库加载"""
+        with self._lock:
+            if client_id is None:
+                self._info.clear()
+                self._client_names.clear()
+                return
+            self._info.pop(client_id, None)
+            self._client_names.pop(client_id, None)
+
+
+# 全局缓存实例
+agent_info_cache = AgentInfoCache()
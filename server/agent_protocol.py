@@ -0,0 +1,213 @@
+"""
+Agent WebSocket 消息协议
+用 pydantic 模型描述 Agent 上报的每种消息，直接从原始帧解码并按 type 分发到处理函数
+"""
+from pydantic import BaseModel, ConfigDict, Field, TypeAdapter, ValidationError
+from typing import Annotated, Awaitable, Callable, Dict, Literal, Optional, Union
+import logging
+import re
+
+logger = logging.getLogger(__name__)
+
+
+# ========================
+# 消息体
+# ========================
+
+class RegisterData(BaseModel):
+    """register: Agent 上线时上报的主机信息"""
+    client_id: Optional[str] = None
+    version: Optional[str] = None
+    hostname: Optional[str] = None
+    os: Optional[str] = None
+    arch: Optional[str] = None
+    platform: Optional[str] = None
+    # 本地 frpc.toml 的 sha256，服务端据此跳过内容相同的配置推送
+    config_hash: Optional[str] = None
+
+
+class SystemInfoData(BaseModel):
+    """system_info: 周期性系统指标（同时视作心跳）"""
+    model_config = ConfigDict(extra="allow")
+
+    timestamp: Optional[int] = None
+    hostname: Optional[str] = None
+    os: Optional[str] = None
+    arch: Optional[str] = None
+    cpu_percent: Optional[float] = None
+    memory_used: Optional[int] = None
+    memory_total: Optional[int] = None
+    memory_percent: Optional[float] = None
+    disk_used: Optional[int] = None
+    disk_total: Optional[int] = None
+    disk_percent: Optional[float] = None
+    net_bytes_in: Optional[int] = None
+    net_bytes_out: Optional[int] = None
+    net_speed_in: Optional[int] = None
+    net_speed_out: Optional[int] = None
+    uptime: Optional[int] = None
+
+
+class FrpcStatusData(BaseModel):
+    status: str = "unknown"
+
+
+class ConfigAckData(BaseModel):
+    """config_ack: Agent 应用 config_update 后的结果"""
+    version: int
+    hash: Optional[str] = None
+    ok: bool = True
+    error: Optional[str] = None
+
+
+# ========================
+# 消息（按 type 区分）
+# ========================
+
+class RegisterMessage(BaseModel):
+    type: Literal["register"]
+    data: RegisterData = Field(default_factory=RegisterData)
+
+
+class SystemInfoMessage(BaseModel):
+    type: Literal["system_info"]
+    data: SystemInfoData
+
+
+class LogMessage(BaseModel):
+    type: Literal["log"]
+    data: str
+
+
+class FrpcStatusMessage(BaseModel):
+    type: Literal["frpc_status"]
+    data: Union[str, FrpcStatusData]
+
+    @property
+    def status(self) -> str:
+        return self.data if isinstance(self.data, str) else self.data.status
+
+
+class ConfigAckMessage(BaseModel):
+    type: Literal["config_ack"]
+    data: ConfigAckData
+
+
+class PongMessage(BaseModel):
+    type: Literal["pong"]
+    data: None = None
+
+
+AgentMessage = Annotated[
+    Union[RegisterMessage, SystemInfoMessage, LogMessage, FrpcStatusMessage, ConfigAckMessage, PongMessage],
+    Field(discriminator="type"),
+]
+
+_adapter = TypeAdapter(AgentMessage)
+
+MESSAGE_TYPES = ("register", "system_info", "log", "frpc_status", "config_ack", "pong")
+
+# 只在帧开头这么多字节内查找 type（Agent 总是把 type 放在最前面）
+PEEK_BYTES = 256
+_PEEK_TYPE = re.compile(r'"type"\s*:\s*"([a-z_]+)"')
+_PEEK_TYPE_BYTES = re.compile(rb'"type"\s*:\s*"([a-z_]+)"')
+
+
+def peek_type(raw: Union[str, bytes]) -> Optional[str]:
+    """
+    不解码整帧，从开头取出消息类型用于限流；找不到或不是已知类型时返回 None。
+    结果只是提示，解码后的 type 与之不同时调用方应按实际类型再检查一次
+    """
+    if isinstance(raw, str):
+        match = _PEEK_TYPE.search(raw, 0, PEEK_BYTES)
+        msg_type = match.group(1) if match else None
+    else:
+        match = _PEEK_TYPE_BYTES.search(raw, 0, PEEK_BYTES)
+        msg_type = match.group(1).decode() if match else None
+    return msg_type if msg_type in MESSAGE_TYPES else None
+
+
+# ========================
+# 解码与分发
+# ========================
+
+Handler = Callable[[str, BaseModel], Awaitable[None]]
+
+
+class MessageRouter:
+    """解码 Agent 消息并按 type 分发，同时记录每种消息的计数"""
+
+    def __init__(self):
+        self._handlers: Dict[str, Handler] = {}
+
+        # type -> {"received", "rejected"}，未知类型计入 "unknown"
+        self.counters: Dict[str, Dict[str, int]] = {
+            t: {"received": 0, "rejected": 0} for t in (*MESSAGE_TYPES, "unknown")
+        }
+
+    def handler(self, msg_type: str):
+        """注册处理函数的装饰器"""
+        if msg_type not in MESSAGE_TYPES:
+            raise ValueError(f"未知的消息类型: {msg_type}")
+
+        def decorator(func: Handler) -> Handler:
+            self._handlers[msg_type] = func
+            return func
+        return decorator
+
+    def decode(self, raw: Union[str, bytes]) -> Optional[BaseModel]:
+        """从原始帧解码消息，格式错误时返回 None"""
+        try:
+            msg = _adapter.validate_json(raw)
+        except ValidationError as e:
+            self.counters[self._reject_bucket(e)]["rejected"] += 1
+            return None
+        self.counters[msg.type]["received"] += 1
+        return msg
+
+    async def dispatch(self, client_id: str, msg: BaseModel):
+        handler = self._handlers.get(msg.type)
+        if handler:
+            await handler(client_id, msg)
+
+    @staticmethod
+    def _reject_bucket(error: ValidationError) -> str:
+        # 判别字段命中时错误位置以 type 开头，否则归为 unknown
+        for err in error.errors():
+            loc = err.get("loc") or ()
+            if loc and loc[0] in MESSAGE_TYPES:
+                return loc[0]
+        return "unknown"
+
+    def get_stats(self) -> dict:
+        return {t: dict(c) for t, c in self.counters.items()}
+
+
+# 全局消息路由实例
+router = MessageRouter()
+
+
+if __name__ == "__main__":
+    # 解码吞吐基准: python agent_protocol.py
+    import json
+    import time
+
+    frames = {
+        "system_info": json.dumps({"type": "system_info", "data": {
+            "timestamp": 1700000000, "hostname": "node-1", "os": "linux", "arch": "amd64",
+            "cpu_percent": 12.5, "memory_used": 1 << 31, "memory_total": 1 << 33,
+            "memory_percent": 25.0, "disk_used": 1 << 35, "disk_total": 1 << 37,
+            "disk_percent": 25.0, "net_bytes_in": 123456789, "net_bytes_out": 987654321,
+            "net_speed_in": 1024, "net_speed_out": 2048, "uptime": 86400,
+        }}).encode(),
+        "log": json.dumps({"type": "log", "data": "2024/01/01 00:00:00 [I] [proxy.go:204] [node-1.ssh] start proxy success"}).encode(),
+    }
+    n = 200_000
+    bench_router = MessageRouter()
+    for name, frame in frames.items():
+        for label, decode in (("json.loads", json.loads), ("router.decode", bench_router.decode)):
+            start = time.perf_counter()
+            for _ in range(n):
+                decode(frame)
+            elapsed = time.perf_counter() - start
+            print(f"{name:12s} {label:14s} {n / elapsed:12,.0f} msg/s")
@@ -0,0 +1,253 @@
+"""
+流式告警引擎
+在 system_info 样本到达时增量评估规则（阈值、变化率、持续时长、Agent 离线），
+每个 (规则, Agent) 只保存常数大小的状态，单条样本的评估开销与历史长度无关
+"""
+from collections import deque
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, Tuple
+import asyncio
+import itertools
+import logging
+import time
+
+import requests
+
+import schemas
+from agent_protocol import SystemInfoData
+
+logger = logging.getLogger(__name__)
+
+# 可用于 threshold/rate 规则的指标：system_info 中的数值字段
+METRICS = tuple(
+    name for name, field in SystemInfoData.model_fields.items()
+    if name != "timestamp" and field.annotation in (Optional[int], Optional[float])
+)
+
+# 未配置规则时使用的默认规则
+DEFAULT_RULES = [
+    schemas.AlertRule(id="disk-full", name="磁盘使用率过高", kind="threshold",
+                      metric="disk_percent", op=">=", value=95, for_seconds=60),
+    schemas.AlertRule(id="cpu-busy", name="CPU 持续满载", kind="threshold",
+                      metric="cpu_percent", op=">=", value=95, for_seconds=300),
+    schemas.AlertRule(id="agent-offline", name="Agent 离线", kind="offline", for_seconds=60),
+]
+
+_OPS = {
+    ">": lambda a, b: a > b,
+    ">=": lambda a, b: a >= b,
+    "<": lambda a, b: a < b,
+    "<=": lambda a, b: a <= b,
+}
+
+Sink = Callable[[dict], Awaitable[None]]
+
+# 等待分发的告警事件上限，满时丢弃新事件
+ALERT_QUEUE_SIZE = 10000
+
+
+class RuleState:
+    """单个 (规则, Agent) 的评估状态"""
+
+    __slots__ = ("pending_since", "firing", "prev_value", "prev_ts", "value")
+
+    def __init__(self):
+        self.pending_since: Optional[float] = None  # 条件开始成立的时间
+        self.firing = False
+        self.prev_value: Optional[float] = None     # rate 规则的上一个样本
+        self.prev_ts: Optional[float] = None
+        self.value: Optional[float] = None          # 最近一次评估的取值
+
+
+class AlertEngine:
+    def __init__(self, rules: List[schemas.AlertRule] = None):
+        self.rules: List[schemas.AlertRule] = list(DEFAULT_RULES if rules is None else rules)
+        self._state: Dict[Tuple[str, str], RuleState] = {}
+        self._last_seen: Dict[str, float] = {}  # client_id -> 最近一次样本时间
+        self.events = deque(maxlen=500)         # 最近的 firing/resolved 事件
+        self.sinks: List[Sink] = []
+        self._seq = itertools.count(1)
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=ALERT_QUEUE_SIZE)
+        self.dropped = 0
+
+    def set_rules(self, rules: List[schemas.AlertRule]):
+        """替换规则；已删除或被修改的规则状态会被清除"""
+        old = {r.id: r for r in self.rules}
+        keep = {r.id for r in rules if old.get(r.id) == r}
+        self._state = {k: v for k, v in self._state.items() if k[0] in keep}
+        self.rules = list(rules)
+
+    def retain(self, client_ids: Iterable[str]):
+        """只保留仍存在的客户端，其余的状态全部丢弃，离线规则不再检查它们"""
+        keep = set(client_ids)
+        for client_id in [c for c in self._last_seen if c not in keep]:
+            del self._last_seen[client_id]
+        self._state = {k: v for k, v in self._state.items() if k[1] in keep}
+
+    def _get_state(self, rule_id: str, client_id: str) -> RuleState:
+        key = (rule_id, client_id)
+        state = self._state.get(key)
+        if state is None:
+            state = self._state[key] = RuleState()
+        return state
+
+    def _event(self, rule: schemas.AlertRule, client_id: str, state: str, value, now: float) -> dict:
+        event = {
+            "id": next(self._seq),
+            "rule_id": rule.id,
+            "rule_name": rule.name,
+            "kind": rule.kind,
+            "metric": rule.metric,
+            "client_id": client_id,
+            "state": state,
+            "value": value,
+            "threshold": rule.value,
+            "ts": now,
+        }
+        self.events.append(event)
+        return event
+
+    def _step(self, rule: schemas.AlertRule, client_id: str, state: RuleState,
+              condition: bool, value, now: float, events: List[dict]):
+        """推进持续时长状态机"""
+        state.value = value
+        if condition:
+            if state.pending_since is None:
+                state.pending_since = now
+            if not state.firing and now - state.pending_since >= rule.for_seconds:
+                state.firing = True
+                events.append(self._event(rule, client_id, "firing", value, now))
+        else:
+            state.pending_since = None
+            if state.firing:
+                state.firing = False
+                events.append(self._event(rule, client_id, "resolved", value, now))
+
+    # ========================
+    # 评估
+    # ========================
+
+    def observe(self, client_id: str, sample: dict, now: float = None) -> List[dict]:
+        """评估一条 system_info 样本，返回本次产生的事件，O(规则数)"""
+        now = time.time() if now is None else now
+        self._last_seen[client_id] = now
+        events: List[dict] = []
+
+        for rule in self.rules:
+            if not rule.enabled:
+                continue
+
+            if rule.kind == "offline":
+                # 收到样本即视为在线，恢复已触发的离线告警
+                state = self._state.get((rule.id, client_id))
+                if state is not None:
+                    self._step(rule, client_id, state, False, None, now, events)
+                continue
+
+            value = sample.get(rule.metric)
+            if value is None:
+                continue
+            state = self._get_state(rule.id, client_id)
+
+            if rule.kind == "rate":
+                prev_value, prev_ts = state.prev_value, state.prev_ts
+                state.prev_value, state.prev_ts = value, now
+                if prev_ts is None or now <= prev_ts:
+                    continue
+                value = (value - prev_value) / (now - prev_ts)
+
+            self._step(rule, client_id, state, _OPS[rule.op](value, rule.value), value, now, events)
+
+        return events
+
+    def check_offline(self, now: float = None) -> List[dict]:
+        """周期性检查静默的 Agent，O(Agent 数 × 离线规则数)"""
+        now = time.time() if now is None else now
+        events: List[dict] = []
+        for rule in self.rules:
+            if not rule.enabled or rule.kind != "offline":
+                continue
+            for client_id, last_seen in self._last_seen.items():
+                silent = now - last_seen
+                if silent < rule.for_seconds:
+                    continue
+                state = self._get_state(rule.id, client_id)
+                if not state.firing:
+                    # 静默时长本身就是持续时间，直接触发
+                    state.pending_since = last_seen
+                    self._step(rule, client_id, state, True, round(silent, 1), now, events)
+        return events
+
+    # ========================
+    # 事件分发
+    # ========================
+
+    def enqueue(self, events: List[dict]):
+        """采集路径调用：事件排队后立即返回，由 run() 按顺序分发，慢的 sink 不会阻塞 Agent 的接收循环"""
+        for event in events:
+            try:
+                self.queue.put_nowait(event)
+            except asyncio.QueueFull:
+                self.dropped += 1
+
+    async def run(self):
+        while True:
+            event = await self.queue.get()
+            await self.publish([event])
+
+    async def publish(self, events: List[dict]):
+        for event in events:
+            for sink in self.sinks:
+                try:
+                    await sink(event)
+                except Exception as e:
+                    logger.warning(f"告警事件分发失败: {e}")
+
+    def active(self) -> List[dict]:
+        """当前处于 firing 状态的告警"""
+        rules = {r.id: r for r in self.rules}
+        result = []
+        for (rule_id, client_id), state in self._state.items():
+            if state.firing and rule_id in rules:
+                rule = rules[rule_id]
+                result.append({
+                    "rule_id": rule_id,
+                    "rule_name": rule.name,
+                    "kind": rule.kind,
+                    "metric": rule.metric,
+                    "client_id": client_id,
+                    "value": state.value,
+                    "threshold": rule.value,
+                    "since": state.pending_since,
+                })
+        return result
+
+
+class WebhookSink:
+    """把告警事件 POST 到本地 Webhook，队列满时丢弃，避免拖慢采集路径"""
+
+    def __init__(self, url: str, maxsize: int = 1000, timeout: float = 5):
+        self.url = url
+        self.timeout = timeout
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=maxsize)
+        self.dropped = 0
+
+    async def __call__(self, event: dict):
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            self.dropped += 1
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            event = await self.queue.get()
+            try:
+                await loop.run_in_executor(
+                    None, lambda: requests.post(self.url, json=event, timeout=self.timeout)
+                )
+            except Exception as e:
+                logger.warning(f"告警 Webhook 发送失败: {e}")
+
+
+# 全局告警引擎实例
+alert_engine = AlertEngine()
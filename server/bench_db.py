@@ -0,0 +1,173 @@
+"""
+数据库并发读写基准
+模拟 Agent 心跳写入（每次一个小事务）与管理后台读取（客户端列表及其隧道）同时进行，
+输出吞吐、延迟与 "database is locked" 错误数。
+
+    python bench_db.py                          # 调优后的 SQLite（database.create_db_engine）
+    python bench_db.py --plain                  # 对照：SQLAlchemy 默认的 SQLite 连接（回滚日志、FULL 同步）
+    python bench_db.py --queue --writers 64     # 写入改由单写入线程合并提交（database.DBWriter），64 个并发提交方
+    python bench_db.py --url postgresql+psycopg2://...   # 其他数据库
+"""
+from sqlalchemy import create_engine
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import sessionmaker, selectinload
+import argparse
+import asyncio
+import os
+import random
+import threading
+import time
+
+from database import Base, DBWriter, create_db_engine
+import models
+import crud
+
+
+def _percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return round(values[min(len(values) - 1, int(q * len(values)))] * 1000, 2)
+
+
+def _seed(Session, clients: int, tunnels: int):
+    db = Session()
+    try:
+        if db.query(models.Client).count() >= clients:
+            return
+        db.query(models.Tunnel).delete()
+        db.query(models.Client).delete()
+        db.execute(models.Client.__table__.insert(), [
+            {"id": f"bench-{i}", "name": f"host-{i}", "auth_token": "x", "status": "offline"}
+            for i in range(clients)
+        ])
+        db.execute(models.Tunnel.__table__.insert(), [
+            {"client_id": f"bench-{i}", "name": f"t{j}", "type": "tcp", "enabled": True,
+             "local_ip": "127.0.0.1", "local_port": 22, "remote_port": 10000 + i * tunnels + j}
+            for i in range(clients) for j in range(tunnels)
+        ])
+        db.commit()
+    finally:
+        db.close()
+
+
+def run(url: str, plain: bool, writers: int, readers: int, seconds: float, clients: int, tunnels: int,
+        queue: bool = False) -> dict:
+    if plain:
+        engine = create_engine(url, connect_args={"check_same_thread": False})
+    else:
+        engine = create_db_engine(url)
+    Base.metadata.create_all(bind=engine)
+    Session = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    _seed(Session, clients, tunnels)
+
+    stop = time.monotonic() + seconds
+    stats = {"write": [], "read": [], "write_errors": 0, "read_errors": 0}
+    lock = threading.Lock()
+
+    def writer():
+        latencies, errors = [], 0
+        db = Session()
+        while time.monotonic() < stop:
+            started = time.perf_counter()
+            try:
+                crud.touch_client(db, f"bench-{random.randrange(clients)}")
+                latencies.append(time.perf_counter() - started)
+            except OperationalError:
+                db.rollback()
+                errors += 1
+        db.close()
+        with lock:
+            stats["write"] += latencies
+            stats["write_errors"] += errors
+
+    def queued_writers():
+        """writers 个协程通过单写入线程提交写操作"""
+        async def submitter(db_writer, latencies):
+            errors = 0
+            while time.monotonic() < stop:
+                started = time.perf_counter()
+                try:
+                    await db_writer.submit(crud.touch_client, f"bench-{random.randrange(clients)}")
+                    latencies.append(time.perf_counter() - started)
+                except OperationalError:
+                    errors += 1
+            return errors
+
+        async def main():
+            db_writer = DBWriter(engine)
+            latencies = []
+            errors = await asyncio.gather(*[submitter(db_writer, latencies) for _ in range(writers)])
+            await db_writer.close()
+            return latencies, sum(errors)
+
+        latencies, errors = asyncio.run(main())
+        with lock:
+            stats["write"] += latencies
+            stats["write_errors"] += errors
+
+    def reader():
+        latencies, errors = [], 0
+        db = Session()
+        while time.monotonic() < stop:
+            started = time.perf_counter()
+            try:
+                offset = random.randrange(max(1, clients - 100))
+                (db.query(models.Client).options(selectinload(models.Client.tunnels))
+                 .order_by(models.Client.id).offset(offset).limit(100).all())
+                db.rollback()  # 结束读事务，释放快照
+                latencies.append(time.perf_counter() - started)
+            except OperationalError:
+                db.rollback()
+                errors += 1
+        db.close()
+        with lock:
+            stats["read"] += latencies
+            stats["read_errors"] += errors
+
+    if queue:
+        threads = [threading.Thread(target=queued_writers)]
+    else:
+        threads = [threading.Thread(target=writer) for _ in range(writers)]
+    threads += [threading.Thread(target=reader) for _ in range(readers)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    engine.dispose()
+
+    return {
+        "engine": "plain" if plain else "tuned",
+        "writes": "single writer" if queue else "per-thread commit",
+        "writes_per_sec": round(len(stats["write"]) / seconds),
+        "write_p50_ms": _percentile(stats["write"], 0.5),
+        "write_p99_ms": _percentile(stats["write"], 0.99),
+        "write_errors": stats["write_errors"],
+        "reads_per_sec": round(len(stats["read"]) / seconds),
+        "read_p50_ms": _percentile(stats["read"], 0.5),
+        "read_p99_ms": _percentile(stats["read"], 0.99),
+        "read_errors": stats["read_errors"],
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="数据库并发读写基准")
+    parser.add_argument("--url", default="sqlite:///./bench_db.sqlite")
+    parser.add_argument("--plain", action="store_true", help="使用未调优的 SQLite 连接作为对照")
+    parser.add_argument("--queue", action="store_true", help="写入通过单写入线程合并提交")
+    parser.add_argument("--writers", type=int, default=4, help="写线程数（--queue 时为并发提交的协程数）")
+    parser.add_argument("--readers", type=int, default=4)
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--clients", type=int, default=1000)
+    parser.add_argument("--tunnels", type=int, default=5, help="每个客户端的隧道数")
+    args = parser.parse_args()
+
+    result = run(args.url, args.plain, args.writers, args.readers, args.seconds, args.clients, args.tunnels,
+                 args.queue)
+    for key, value in result.items():
+        print(f"{key:>16}: {value}")
+    if args.url.startswith("sqlite:///") and args.url.endswith("bench_db.sqlite"):
+        path = args.url[len("sqlite:///"):]
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
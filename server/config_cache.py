@@ -0,0 +1,76 @@
+"""
+frpc 配置渲染缓存
+每个客户端渲染好的 frpc.toml 及其内容哈希按版本号缓存：隧道增删改、客户端改名时递增该客户端的版本，
+FRPS 地址/端口/Token 变化时递增全局版本，版本不变时直接复用上次的渲染结果，不再查询数据库
+"""
+from typing import Callable, Dict, Optional, Tuple
+import hashlib
+
+Rendered = Tuple[Optional[str], Optional[str]]  # (toml, sha256)，客户端不存在或服务端未配置时为 (None, None)
+
+
+def config_hash(content: str) -> str:
+    """配置内容的 sha256（十六进制），Agent 端对本地 frpc.toml 使用相同算法"""
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+class ConfigRenderCache:
+    """按 (全局版本, 客户端版本) 失效的渲染结果缓存"""
+
+    def __init__(self):
+        self._global_version = 0
+        self._client_versions: Dict[str, int] = {}
+        self._rendered: Dict[str, Tuple[Tuple[int, int], Rendered]] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def version(self, client_id: str) -> Tuple[int, int]:
+        return self._global_version, self._client_versions.get(client_id, 0)
+
+    def invalidate_client(self, client_id: str):
+        """客户端的隧道或名称发生变化"""
+        self._client_versions[client_id] = self._client_versions.get(client_id, 0) + 1
+        self._rendered.pop(client_id, None)
+
+    def invalidate_all(self):
+        """影响所有客户端的全局配置（FRPS 地址、端口、Token）发生变化"""
+        self._global_version += 1
+        self._rendered.clear()
+
+    def get(self, client_id: str) -> Optional[Rendered]:
+        """返回仍然有效的缓存结果，未命中时返回 None"""
+        entry = self._rendered.get(client_id)
+        if entry is None or entry[0] != self.version(client_id):
+            return None
+        self.hits += 1
+        return entry[1]
+
+    def render(self, db, client_id: str, renderer: Callable) -> Rendered:
+        """
+        命中缓存时直接返回，否则调用 renderer(db, client_id) 渲染并缓存
+        渲染前先记下版本号，渲染期间版本被递增时结果不会被后续读取命中
+        """
+        cached = self.get(client_id)
+        if cached is not None:
+            return cached
+        version = self.version(client_id)
+        return self.store(client_id, version, renderer(db, client_id))
+
+    def store(self, client_id: str, version: Tuple[int, int], toml: Optional[str]) -> Rendered:
+        """缓存以 version（渲染前取得）渲染出的结果"""
+        self.misses += 1
+        result = (toml, config_hash(toml)) if toml else (None, None)
+        self._rendered[client_id] = (version, result)
+        return result
+
+    def get_stats(self) -> dict:
+        return {
+            "cached_clients": len(self._rendered),
+            "global_version": self._global_version,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+# 全局配置渲染缓存实例
+config_cache = ConfigRenderCache()
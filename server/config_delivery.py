@@ -0,0 +1,207 @@
+"""
+frpc 配置下发跟踪
+每次推送分配一个版本号，Agent 应用配置后回复 config_ack（成功或失败），
+服务端据此记录每个 Agent 实际运行的配置版本；超时未确认的推送按指数退避重发
+"""
+from typing import Dict, List, Optional
+import os
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+# 首次等待确认的秒数，之后每次重发翻倍，最长 CONFIG_RETRY_MAX_DELAY
+CONFIG_ACK_TIMEOUT = float(os.environ.get("CONFIG_ACK_TIMEOUT", "10"))
+CONFIG_RETRY_MAX_DELAY = 120.0
+# 连续未确认的最大发送次数，超过后标记为 timeout 不再重发（下次注册或配置变化时重新下发）
+CONFIG_MAX_ATTEMPTS = int(os.environ.get("CONFIG_MAX_ATTEMPTS", "6"))
+
+# 下发状态
+PENDING = "pending"    # 等待发送或等待确认
+APPLIED = "applied"    # Agent 确认已应用
+FAILED = "failed"      # Agent 回复应用失败
+TIMEOUT = "timeout"    # 重试次数耗尽仍未确认
+STATES = (PENDING, APPLIED, FAILED, TIMEOUT)
+
+
+class Delivery:
+    """一次配置下发（同一版本的多次重发共用一个对象）"""
+
+    __slots__ = ("version", "hash", "content", "state", "attempts",
+                 "created_at", "sent_at", "next_retry", "acked_at", "error")
+
+    def __init__(self, version: int, content_hash: str, content: str):
+        self.version = version
+        self.hash = content_hash
+        self.content = content
+        self.state = PENDING
+        self.attempts = 0         # 当前连接上已发送的次数，断线后归零
+        self.created_at = time.time()
+        self.sent_at: Optional[float] = None
+        self.next_retry: Optional[float] = None  # monotonic 时间
+        self.acked_at: Optional[float] = None
+        self.error: Optional[str] = None
+
+    def message(self) -> dict:
+        return {"type": "config_update", "data": self.content, "hash": self.hash, "version": self.version}
+
+
+class ConfigDeliveryTracker:
+    """每个客户端最新一次下发（期望状态）与 Agent 已确认的配置（实际状态）"""
+
+    def __init__(self):
+        self._last_version = 0
+        self._desired: Dict[str, Delivery] = {}
+        # client_id -> {"version", "hash", "at"}，version 为 None 表示来自注册上报而非确认
+        self._applied: Dict[str, dict] = {}
+        self.sent = 0
+        self.skipped = 0
+        self.retried = 0
+        self.acked = 0
+        self.nacked = 0
+        self.stale_acks = 0
+
+    def _next_version(self) -> int:
+        # 以毫秒时间戳为下限，服务端重启后版本号依然递增，旧连接的确认不会被误认
+        self._last_version = max(self._last_version + 1, int(time.time() * 1000))
+        return self._last_version
+
+    def delivery(self, client_id: str) -> Optional[Delivery]:
+        """客户端最新一次下发"""
+        return self._desired.get(client_id)
+
+    def applied_hash(self, client_id: str) -> Optional[str]:
+        applied = self._applied.get(client_id)
+        return applied["hash"] if applied else None
+
+    def prepare(self, client_id: str, content: str, content_hash: str, force: bool = False) -> Optional[Delivery]:
+        """
+        为一次推送准备下发记录，不需要发送时返回 None：
+        Agent 已确认相同内容，或相同内容已在当前连接上发出、正在等待确认
+        """
+        current = self._desired.get(client_id)
+        if not force:
+            if self.applied_hash(client_id) == content_hash and (current is None or current.hash == content_hash):
+                if current is None:
+                    # 首次推送时 Agent 已持有相同内容（注册时上报），直接记为已应用
+                    current = self._desired[client_id] = Delivery(self._next_version(), content_hash, content)
+                    current.state = APPLIED
+                    self._applied[client_id]["version"] = current.version
+                self.skipped += 1
+                return None
+            if current is not None and current.hash == content_hash and current.state == PENDING:
+                if current.attempts:
+                    self.skipped += 1
+                    return None
+                return current
+        delivery = Delivery(self._next_version(), content_hash, content)
+        self._desired[client_id] = delivery
+        return delivery
+
+    def mark_sent(self, delivery: Delivery):
+        """记录一次发送并安排下一次重发时间"""
+        if delivery.attempts:
+            self.retried += 1
+        else:
+            self.sent += 1
+        delivery.attempts += 1
+        delivery.sent_at = time.time()
+        delay = min(CONFIG_ACK_TIMEOUT * 2 ** (delivery.attempts - 1), CONFIG_RETRY_MAX_DELAY)
+        delivery.next_retry = time.monotonic() + delay
+
+    def ack(self, client_id: str, version: int, ok: bool, content_hash: str = None, error: str = None) -> bool:
+        """处理 Agent 的确认，版本不是最新下发时忽略并返回 False"""
+        delivery = self._desired.get(client_id)
+        if delivery is None or delivery.version != version:
+            self.stale_acks += 1
+            return False
+        delivery.acked_at = time.time()
+        delivery.next_retry = None
+        if ok:
+            delivery.state = APPLIED
+            delivery.error = None
+            self._applied[client_id] = {"version": version, "hash": content_hash or delivery.hash, "at": delivery.acked_at}
+            self.acked += 1
+        else:
+            delivery.state = FAILED
+            delivery.error = (error or "unknown error")[:500]
+            self.nacked += 1
+            logger.warning(f"Agent {client_id} 应用配置 v{version} 失败: {delivery.error}")
+        return True
+
+    def reported(self, client_id: str, content_hash: Optional[str]):
+        """Agent 注册时上报本地配置哈希（旧版 Agent 不上报）"""
+        if not content_hash:
+            self._applied.pop(client_id, None)
+            return
+        delivery = self._desired.get(client_id)
+        version = delivery.version if delivery is not None and delivery.hash == content_hash else None
+        self._applied[client_id] = {"version": version, "hash": content_hash, "at": time.time()}
+        if version is not None and delivery.state != APPLIED:
+            delivery.state = APPLIED
+            delivery.acked_at = time.time()
+            delivery.next_retry = None
+
+    def disconnected(self, client_id: str):
+        """连接断开：未确认的下发需要在新连接上重新发送"""
+        delivery = self._desired.get(client_id)
+        if delivery is not None and delivery.state == PENDING:
+            delivery.attempts = 0
+            delivery.next_retry = None
+
+    def due(self, connected) -> List[tuple]:
+        """返回 [(client_id, delivery)]：已连接、等待确认且到达重发时间的下发，重试耗尽的标记为 timeout"""
+        now = time.monotonic()
+        result = []
+        for client_id, delivery in self._desired.items():
+            if delivery.state != PENDING or delivery.next_retry is None or delivery.next_retry > now:
+                continue
+            if client_id not in connected:
+                continue
+            if delivery.attempts >= CONFIG_MAX_ATTEMPTS:
+                delivery.state = TIMEOUT
+                delivery.next_retry = None
+                logger.warning(f"Agent {client_id} 未确认配置 v{delivery.version}（已发送 {delivery.attempts} 次）")
+                continue
+            result.append((client_id, delivery))
+        return result
+
+    def fleet(self, online) -> dict:
+        """全舰队配置收敛视图：每个 Agent 的期望版本与已应用版本"""
+        agents = []
+        summary = {state: 0 for state in STATES}
+        for client_id in sorted(set(self._desired) | set(self._applied)):
+            delivery = self._desired.get(client_id)
+            applied = self._applied.get(client_id)
+            state = delivery.state if delivery else APPLIED
+            summary[state] += 1
+            agents.append({
+                "client_id": client_id,
+                "online": client_id in online,
+                "state": state,
+                "desired_version": delivery.version if delivery else None,
+                "desired_hash": delivery.hash if delivery else None,
+                "applied_version": applied["version"] if applied else None,
+                "applied_hash": applied["hash"] if applied else None,
+                "converged": bool(applied and delivery and applied["hash"] == delivery.hash),
+                "attempts": delivery.attempts if delivery else 0,
+                "sent_at": delivery.sent_at if delivery else None,
+                "acked_at": delivery.acked_at if delivery else None,
+                "error": delivery.error if delivery else None,
+            })
+        return {"summary": summary, "agents": agents}
+
+    def get_stats(self) -> dict:
+        return {
+            "sent": self.sent,
+            "skipped": self.skipped,
+            "retried": self.retried,
+            "acked": self.acked,
+            "nacked": self.nacked,
+            "stale_acks": self.stale_acks,
+            "pending": sum(1 for d in self._desired.values() if d.state == PENDING),
+        }
+
+
+# 全局配置下发跟踪实例
+config_delivery = ConfigDeliveryTracker()
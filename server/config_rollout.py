@@ -0,0 +1,139 @@
+"""
+全舰队配置重新下发
+FRPS 地址、端口或 Token 变化后，所有在线 Agent 的 frpc.toml 都需要更新：
+一次性批量渲染所有客户端的配置，再以有限并发推送，进度（已推送/已确认/失败）可通过 API 查询
+"""
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+import asyncio
+import os
+import time
+import uuid
+import logging
+
+from config_delivery import config_delivery, APPLIED, FAILED, PENDING, TIMEOUT
+
+logger = logging.getLogger(__name__)
+
+CONFIG_FANOUT_CONCURRENCY = int(os.environ.get("CONFIG_FANOUT_CONCURRENCY", "50"))
+
+# 保留最近多少个任务供查询
+ROLLOUT_HISTORY = 20
+
+Rendered = Tuple[Optional[str], Optional[str]]
+
+
+class RolloutJob:
+    """一次全舰队下发任务"""
+
+    def __init__(self, reason: str, client_ids: List[str]):
+        self.id = uuid.uuid4().hex[:12]
+        self.reason = reason
+        self.client_ids = client_ids
+        self.state = "rendering"   # rendering -> pushing -> done
+        self.created_at = time.time()
+        self.finished_at: Optional[float] = None
+        self.pushed = 0        # 已发送（内容未变化、无需发送的也计入）
+        self.send_failed = 0   # 发送时 Agent 已断开
+        self.no_config = 0     # 客户端不存在或服务端尚未配置 FRPS
+        self.versions: Dict[str, int] = {}  # client_id -> 本次下发的版本
+        self.error: Optional[str] = None
+        self.task: Optional[asyncio.Task] = None  # 持有引用，避免事件循环只保留弱引用时任务中途被回收
+
+    def progress(self) -> dict:
+        """按 Agent 对本次下发版本的确认情况汇总"""
+        acked = failed = awaiting = timeout = superseded = 0
+        for client_id, version in self.versions.items():
+            delivery = config_delivery.delivery(client_id)
+            if delivery is None or delivery.version != version:
+                superseded += 1  # 之后又有新的下发
+            elif delivery.state == APPLIED:
+                acked += 1
+            elif delivery.state == FAILED:
+                failed += 1
+            elif delivery.state == TIMEOUT:
+                timeout += 1
+            elif delivery.state == PENDING:
+                awaiting += 1
+        return {
+            "id": self.id,
+            "reason": self.reason,
+            "state": self.state,
+            "created_at": self.created_at,
+            "finished_at": self.finished_at,
+            "total": len(self.client_ids),
+            "pushed": self.pushed,
+            "send_failed": self.send_failed,
+            "no_config": self.no_config,
+            "acked": acked,
+            "failed": failed,
+            "awaiting_ack": awaiting,
+            "timeout": timeout,
+            "superseded": superseded,
+            "error": self.error,
+        }
+
+
+class ConfigRollouts:
+    """创建并跟踪全舰队下发任务"""
+
+    def __init__(self, concurrency: int = CONFIG_FANOUT_CONCURRENCY):
+        self.concurrency = max(1, concurrency)
+        self._jobs: "OrderedDict[str, RolloutJob]" = OrderedDict()
+
+    def start(self, reason: str, client_ids: List[str],
+              render: Callable[[List[str]], Awaitable[Dict[str, Rendered]]],
+              push: Callable[[str, str, str], Awaitable[bool]]) -> RolloutJob:
+        """
+        创建任务并在后台执行
+        render(client_ids) 批量渲染并返回 {client_id: (toml, hash)}，push(client_id, toml, hash) 推送单个 Agent
+        """
+        job = RolloutJob(reason, sorted(client_ids))
+        self._jobs[job.id] = job
+        # 只淘汰已结束的任务，执行中的任务要靠这里的引用保持存活
+        finished = [j.id for j in self._jobs.values() if j.finished_at is not None]
+        for job_id in finished[:max(0, len(self._jobs) - ROLLOUT_HISTORY)]:
+            del self._jobs[job_id]
+        job.task = asyncio.create_task(self._run(job, render, push))
+        return job
+
+    async def _run(self, job: RolloutJob, render, push):
+        started = time.monotonic()
+        try:
+            rendered = await render(job.client_ids)
+            job.state = "pushing"
+            semaphore = asyncio.Semaphore(self.concurrency)
+
+            async def push_one(client_id: str):
+                toml, content_hash = rendered.get(client_id, (None, None))
+                if not toml:
+                    job.no_config += 1
+                    return
+                async with semaphore:
+                    ok = await push(client_id, toml, content_hash)
+                if ok:
+                    job.pushed += 1
+                    delivery = config_delivery.delivery(client_id)
+                    if delivery is not None:
+                        job.versions[client_id] = delivery.version
+                else:
+                    job.send_failed += 1
+
+            await asyncio.gather(*(push_one(cid) for cid in job.client_ids))
+        except Exception as e:
+            job.error = str(e)
+            logger.error(f"配置下发任务 {job.id} 失败: {e}")
+        job.state = "done"
+        job.finished_at = time.time()
+        logger.info(f"配置下发任务 {job.id}（{job.reason}）: {job.pushed}/{len(job.client_ids)} 个 Agent 已推送，"
+                    f"耗时 {time.monotonic() - started:.2f}s")
+
+    def get(self, job_id: str) -> Optional[RolloutJob]:
+        return self._jobs.get(job_id)
+
+    def list(self) -> List[dict]:
+        return [job.progress() for job in reversed(self._jobs.values())]
+
+
+# 全局配置下发任务实例
+config_rollouts = ConfigRollouts()
@@ -37,9 +37,13 @@ def create_admin(db: Session, admin: schemas.UserCreate):
 
 def update_admin_password(db: Session, admin_id: int, new_password: str):
     """更新管理员密码"""
+    return set_admin_password_hash(db, admin_id, auth.get_password_hash(new_password))
+
+def set_admin_password_hash(db: Session, admin_id: int, hashed_password: str):
+    """写入已经计算好的密码哈希"""
     admin = db.query(models.Admin).filter(models.Admin.id == admin_id).first()
     if admin:
-        admin.hashed_password = auth.get_password_hash(new_password)
+        admin.hashed_password = hashed_password
         db.commit()
         return True
     return False
@@ -76,19 +80,21 @@ def create_client_with_token(db: Session, name: str):
     db.refresh(db_client)
     return db_client
 
-def touch_client(db: Session, client_id: str, status: str = "online"):
-    client = get_client(db, client_id)
-    if not client:
-        return None
-    client.status = status
-    client.last_seen = int(time.time())
+def touch_client(db: Session, client_id: str, status: str = "online") -> bool:
+    """更新在线状态与心跳时间（单条 UPDATE，不加载客户端对象），返回客户端是否存在"""
+    updated = db.query(models.Client).filter(models.Client.id == client_id).update(
+        {models.Client.status: status, models.Client.last_seen: int(time.time())},
+        synchronize_session=False,
+    )
     db.commit()
-    db.refresh(client)
-    return client
+    return updated > 0
 
 def get_tunnels(db: Session, client_id: str):
     return db.query(models.Tunnel).filter(models.Tunnel.client_id == client_id).all()
 
+def get_client_tunnel(db: Session, client_id: str, tunnel_id: int):
+    return db.query(models.Tunnel).filter(models.Tunnel.id == tunnel_id, models.Tunnel.client_id == client_id).first()
+
 def create_tunnel(db: Session, tunnel: schemas.TunnelCreate, client_id: str):
     db_tunnel = models.Tunnel(**tunnel.dict(), client_id=client_id)
     db.add(db_tunnel)
@@ -1,12 +1,336 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import OperationalError
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import Session, sessionmaker
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Optional
+import anyio.from_thread
+import asyncio
+import functools
+import logging
+import os
+import time
 
-SQLALCHEMY_DATABASE_URL = "sqlite:///./frp_manager.db"
+logger = logging.getLogger(__name__)
 
-engine = create_engine(
-    SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False}
-)
+# 默认使用 SQLite；也可以指向 PostgreSQL/MySQL 等（需自行安装对应驱动），如
+# DATABASE_URL=postgresql+psycopg2://frp:secret@db/frp_manager
+SQLALCHEMY_DATABASE_URL = os.environ.get("DATABASE_URL", "sqlite:///./frp_manager.db")
+
+# 数据库专用线程池：异步代码中的同步 SQLAlchemy 操作都在这里执行，
+# 避免 SQLite 写入/fsync 阻塞事件循环（以及所有 WebSocket）
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", "4"))
+
+# SQLite 连接参数（每个新连接上执行对应的 PRAGMA）
+# WAL 下读写互不阻塞，synchronous=NORMAL 在 WAL 下只在检查点时 fsync，断电最多丢失最近的事务而不会损坏数据库
+SQLITE_JOURNAL_MODE = os.environ.get("SQLITE_JOURNAL_MODE", "WAL")
+SQLITE_SYNCHRONOUS = os.environ.get("SQLITE_SYNCHRONOUS", "NORMAL")
+# 写锁被占用时等待的毫秒数，超时才报 "database is locked"
+SQLITE_BUSY_TIMEOUT_MS = int(os.environ.get("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+SQLITE_CACHE_SIZE_KB = int(os.environ.get("SQLITE_CACHE_SIZE_KB", "65536"))
+SQLITE_MMAP_SIZE = int(os.environ.get("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024)))
+
+# 单写入线程：一个事务最多合并的写操作数、排队上限（满时提交方等待）、遇到锁冲突时整批重试的次数
+DB_WRITE_BATCH = int(os.environ.get("DB_WRITE_BATCH", "200"))
+DB_WRITE_QUEUE = int(os.environ.get("DB_WRITE_QUEUE", "10000"))
+DB_WRITE_RETRIES = int(os.environ.get("DB_WRITE_RETRIES", "3"))
+
+
+def _sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    try:
+        cursor.execute(f"PRAGMA busy_timeout = {SQLITE_BUSY_TIMEOUT_MS}")
+        cursor.execute(f"PRAGMA journal_mode = {SQLITE_JOURNAL_MODE}")
+        cursor.execute(f"PRAGMA synchronous = {SQLITE_SYNCHRONOUS}")
+        cursor.execute(f"PRAGMA cache_size = -{SQLITE_CACHE_SIZE_KB}")
+        cursor.execute(f"PRAGMA mmap_size = {SQLITE_MMAP_SIZE}")
+        cursor.execute("PRAGMA temp_store = MEMORY")
+    finally:
+        cursor.close()
+
+
+def create_db_engine(url: str = SQLALCHEMY_DATABASE_URL, **kwargs):
+    """
+    创建数据库引擎
+    SQLite 在每个连接建立时设置 WAL、同步级别、缓存、mmap 与 busy_timeout；
+    其他数据库使用连接池并在取出连接前检测连接是否可用
+    """
+    if make_url(url).get_backend_name() == "sqlite":
+        connect_args = {"check_same_thread": False, "timeout": SQLITE_BUSY_TIMEOUT_MS / 1000}
+        engine = create_engine(url, connect_args=connect_args, **kwargs)
+        event.listen(engine, "connect", _sqlite_pragmas)
+        return engine
+    kwargs.setdefault("pool_size", max(5, DB_POOL_SIZE))
+    kwargs.setdefault("pool_pre_ping", True)
+    return create_engine(url, **kwargs)
+
+
+engine = create_db_engine()
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
 Base = declarative_base()
+
+_db_executor = ThreadPoolExecutor(max_workers=DB_POOL_SIZE, thread_name_prefix="db")
+
+
+async def run_db(fn, *args, **kwargs):
+    """
+    在数据库线程池中打开一个会话执行 fn(db, *args, **kwargs) 并返回结果
+
+    fn 返回的 ORM 对象在会话关闭后变为 detached，只能访问已加载的属性
+    """
+    def _call():
+        db = SessionLocal()
+        try:
+            return fn(db, *args, **kwargs)
+        finally:
+            db.close()
+
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_db_executor, _call)
+
+
+# ========================
+# 单写入线程（组提交）
+# ========================
+
+class _WriterSession(Session):
+    """写入线程的会话：合并提交期间写操作里的 commit() 只 flush，整批结束后由写入线程统一提交"""
+    grouping = False
+
+    def commit(self):
+        if self.grouping:
+            self.flush()
+        else:
+            super().commit()
+
+
+def _is_locked(error: OperationalError) -> bool:
+    """SQLite 的 database is locked / busy 错误"""
+    message = str(error.orig).lower()
+    return "locked" in message or "busy" in message
+
+
+def on_undo(db: Session, callback: Callable[[], None]):
+    """
+    写操作在提交前修改了内存状态时登记撤销回调：该操作的修改随整批或其 SAVEPOINT 回滚时逆序调用。
+    普通会话中的写入已经各自提交，不会再被回滚，直接忽略
+    """
+    undo = db.info.get("undo")
+    if undo is not None:
+        undo.append(callback)
+
+
+def _undo(undo: list, mark: int = 0):
+    """逆序执行 mark 之后登记的撤销回调"""
+    while len(undo) > mark:
+        callback = undo.pop()
+        try:
+            callback()
+        except Exception as e:
+            logger.error(f"撤销内存修改失败: {e}")
+
+
+class DBWriter:
+    """
+    单写入线程
+    写操作排进异步队列，由一个专用线程持有写连接依次执行；队列中积压的操作合并到同一个事务里提交。
+    整批先直接执行，有操作失败时回滚整批，再让每个操作在自己的 SAVEPOINT 中重做，
+    失败只回滚该操作并把异常交给它的提交方。
+
+    写操作 fn(db, *args, **kwargs) 内可以照常调用 db.commit()，但不要调用 db.rollback()（抛出异常即可）；
+    操作可能随整批回滚后重新执行，提交前就修改的内存状态用 on_undo() 登记撤销，
+    或在 on_rollback 回调中整体失效
+    """
+
+    def __init__(self, bind):
+        self.bind = bind
+        self.on_rollback: List[Callable[[], None]] = []
+        self._session_factory = sessionmaker(class_=_WriterSession, autoflush=False, expire_on_commit=False)
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-writer")
+        self._connection = None  # 只在写入线程中使用
+        self._queue: asyncio.Queue = None
+        self._task: asyncio.Task = None
+        self.operations = 0
+        self.failed = 0
+        self.commits = 0
+        self.replays = 0
+        self.retries = 0
+        self.max_batch = 0
+
+    def start(self):
+        if self._task is None:
+            self._queue = asyncio.Queue(DB_WRITE_QUEUE)
+            self._task = asyncio.create_task(self._run())
+
+    async def submit(self, fn, *args, **kwargs):
+        """排队执行写操作，提交后返回 fn 的结果（fn 抛出的异常原样抛出）"""
+        self.start()
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((fn, args, kwargs, future))
+        return await future
+
+    async def close(self):
+        """执行完已排队的写操作后停止"""
+        if self._task is None:
+            return
+        await self._queue.put(None)
+        await self._task
+        self._task = None
+        await asyncio.get_running_loop().run_in_executor(self._executor, self._disconnect)
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            # 上一批提交期间积压的操作一起取出，不额外等待
+            item = await self._queue.get()
+            batch, closing = [], False
+            while True:
+                if item is None:
+                    closing = True
+                    break
+                batch.append(item)
+                if len(batch) >= DB_WRITE_BATCH or self._queue.empty():
+                    break
+                item = self._queue.get_nowait()
+
+            if batch:
+                try:
+                    results = await loop.run_in_executor(self._executor, self._apply, batch)
+                except Exception as e:
+                    logger.error(f"批量写入失败（{len(batch)} 个操作）: {e}")
+                    results = [(False, e)] * len(batch)
+                for (_, _, _, future), (ok, value) in zip(batch, results):
+                    if future.done():
+                        continue
+                    if ok:
+                        future.set_result(value)
+                    else:
+                        future.set_exception(value)
+            if closing:
+                return
+
+    # ========================
+    # 写入线程
+    # ========================
+
+    def _disconnect(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def _abort(self, db: Session, disconnect: bool = False):
+        """回滚本批事务，撤销写操作登记的内存修改并通知内存缓存失效"""
+        _undo(db.info["undo"])
+        db.close()
+        if disconnect:
+            self._disconnect()
+        for callback in self.on_rollback:
+            callback()
+
+    @staticmethod
+    def _execute(db: Session, batch, isolate: bool) -> Optional[list]:
+        """
+        执行整批操作，返回每个操作的 (是否成功, 结果或异常)；
+        不隔离时任一操作失败返回 None，锁冲突与操作本身无关，直接抛出由整批重试
+        """
+        results = []
+        undo = db.info["undo"]
+        for fn, args, kwargs, _ in batch:
+            mark = len(undo)
+            try:
+                if isolate:
+                    with db.begin_nested():
+                        value = fn(db, *args, **kwargs)
+                else:
+                    value = fn(db, *args, **kwargs)
+            except OperationalError as e:
+                if _is_locked(e):
+                    raise
+                if not isolate:
+                    return None
+                _undo(undo, mark)
+                results.append((False, e))
+                continue
+            except Exception as e:
+                if not isolate:
+                    return None
+                _undo(undo, mark)
+                results.append((False, e))
+                continue
+            results.append((True, value))
+        return results
+
+    def _apply(self, batch) -> list:
+        """在一个事务中执行整批操作并提交，返回每个操作的 (是否成功, 结果或异常)"""
+        isolate = False
+        attempt = 0
+        while True:
+            if self._connection is None:
+                self._connection = self.bind.connect()
+            db = self._session_factory(bind=self._connection)
+            db.grouping = True
+            db.info["undo"] = []
+            try:
+                results = self._execute(db, batch, isolate)
+                if results is not None:
+                    db.grouping = False
+                    db.commit()
+            except OperationalError as e:
+                if not _is_locked(e) or attempt == DB_WRITE_RETRIES:
+                    self._abort(db, disconnect=not _is_locked(e))
+                    raise
+                self._abort(db)
+                attempt += 1
+                self.retries += 1
+                logger.warning(f"批量写入遇到锁冲突，第 {attempt} 次重试: {e}")
+                time.sleep(0.05 * attempt)
+                continue
+            except Exception:
+                self._abort(db, disconnect=True)
+                raise
+
+            if results is None:
+                # 有操作失败：回滚整批，每个操作放进各自的 SAVEPOINT 重做
+                self._abort(db)
+                self.replays += 1
+                isolate = True
+                continue
+
+            db.close()
+            failed = sum(1 for ok, _ in results if not ok)
+            if failed:
+                for callback in self.on_rollback:
+                    callback()
+            self.operations += len(batch)
+            self.failed += failed
+            self.commits += 1
+            self.max_batch = max(self.max_batch, len(batch))
+            return results
+
+    def get_stats(self) -> dict:
+        return {
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+            "operations": self.operations,
+            "failed": self.failed,
+            "commits": self.commits,
+            "avg_batch": round(self.operations / self.commits, 1) if self.commits else 0,
+            "max_batch": self.max_batch,
+            "replays": self.replays,
+            "retries": self.retries,
+        }
+
+
+# 全局单写入线程实例
+db_writer = DBWriter(engine)
+
+
+async def write_db(fn, *args, **kwargs):
+    """通过单写入线程执行写操作 fn(db, *args, **kwargs)，与其他写操作合并提交"""
+    return await db_writer.submit(fn, *args, **kwargs)
+
+
+def write_db_from_thread(fn, *args, **kwargs):
+    """在同步接口（FastAPI 工作线程）中调用 write_db，阻塞到提交完成"""
+    return anyio.from_thread.run(functools.partial(write_db, fn, *args, **kwargs))
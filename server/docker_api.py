@@ -0,0 +1,339 @@
+"""
+Docker Engine API 客户端
+通过已挂载的 /var/run/docker.sock 直接调用 Docker Engine API（HTTP/1.1），不再为每次操作启动 docker CLI 进程；
+复用同一个 keep-alive 连接，请求串行发送，连接失效时自动重连
+
+自检（本地模拟的 Docker socket）: python docker_api.py
+"""
+from typing import Dict, Optional, Tuple
+from urllib.parse import quote, urlencode
+import asyncio
+import json
+import os
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+DOCKER_SOCKET = os.environ.get("DOCKER_SOCKET", "/var/run/docker.sock")
+DOCKER_API_TIMEOUT = float(os.environ.get("DOCKER_API_TIMEOUT", "10"))
+
+# 复用的连接上请求失败时，只有这些幂等方法会在新连接上重发（重发 POST /restart 可能让容器重启两次）
+RETRY_METHODS = ("GET", "HEAD")
+
+
+class DockerError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(f"Docker API {status}: {message}" if status else message)
+        self.status = status
+        self.message = message
+
+
+class DockerClient:
+    """最小化的异步 Docker Engine API 客户端"""
+
+    def __init__(self, socket_path: str = DOCKER_SOCKET):
+        self.socket_path = socket_path
+        self._reader: Optional[asyncio.StreamReader] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._lock = asyncio.Lock()
+        self.requests = 0
+        self.connects = 0
+        self.errors = 0
+
+    @property
+    def available(self) -> bool:
+        return os.path.exists(self.socket_path)
+
+    # ========================
+    # 连接与 HTTP
+    # ========================
+
+    async def _connect(self):
+        self._reader, self._writer = await asyncio.open_unix_connection(self.socket_path)
+        self.connects += 1
+
+    def _drop(self):
+        if self._writer is not None:
+            self._writer.close()
+        self._reader = self._writer = None
+
+    async def close(self):
+        async with self._lock:
+            self._drop()
+
+    async def request(self, method: str, path: str, params: dict = None,
+                      body: dict = None, timeout: float = DOCKER_API_TIMEOUT) -> Tuple[int, bytes]:
+        """发送请求并返回 (状态码, 响应体)，连接或超时错误抛出 DockerError(0, ...)"""
+        if params:
+            path = f"{path}?{urlencode(params)}"
+        payload = json.dumps(body).encode() if body is not None else b""
+        head = f"{method} {path} HTTP/1.1\r\nHost: docker\r\nContent-Length: {len(payload)}\r\n"
+        if body is not None:
+            head += "Content-Type: application/json\r\n"
+        data = (head + "\r\n").encode() + payload
+
+        async with self._lock:
+            self.requests += 1
+            # Docker 已关闭的空闲连接在发送前丢弃
+            if self._reader is not None and self._reader.at_eof():
+                self._drop()
+            # 复用的连接仍可能刚被 Docker 关闭，幂等请求重连重试一次
+            retry = self._writer is not None and method in RETRY_METHODS
+            for reused in (retry, False):
+                try:
+                    if self._writer is None:
+                        await self._connect()
+                    return await asyncio.wait_for(self._roundtrip(data), timeout)
+                except asyncio.TimeoutError:
+                    self._drop()
+                    self.errors += 1
+                    raise DockerError(0, f"{method} {path} 超时（{timeout:g}s）")
+                except (OSError, asyncio.IncompleteReadError, ValueError) as e:
+                    self._drop()
+                    if not reused:
+                        self.errors += 1
+                        raise DockerError(0, f"无法访问 Docker ({self.socket_path}): {e}")
+
+    async def _roundtrip(self, data: bytes) -> Tuple[int, bytes]:
+        self._writer.write(data)
+        await self._writer.drain()
+        status_line = await self._reader.readuntil(b"\r\n")
+        status = int(status_line.split()[1])
+        headers: Dict[str, str] = {}
+        while True:
+            line = await self._reader.readuntil(b"\r\n")
+            if line == b"\r\n":
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+        if headers.get("transfer-encoding", "").lower() == "chunked":
+            chunks = []
+            while True:
+                size = int((await self._reader.readuntil(b"\r\n")).split(b";")[0], 16)
+                chunk = await self._reader.readexactly(size + 2)
+                if size == 0:
+                    break
+                chunks.append(chunk[:-2])
+            body = b"".join(chunks)
+        elif "content-length" in headers:
+            body = await self._reader.readexactly(int(headers["content-length"]))
+        elif status in (204, 304) or status < 200:
+            body = b""
+        else:
+            body = await self._reader.read()
+            headers["connection"] = "close"
+
+        if headers.get("connection", "").lower() == "close":
+            self._drop()
+        return status, body
+
+    async def _json(self, method: str, path: str, expect=(200,), **kwargs):
+        status, body = await self.request(method, path, **kwargs)
+        if status not in expect:
+            try:
+                message = json.loads(body).get("message", "")
+            except ValueError:
+                message = body.decode(errors="replace")
+            raise DockerError(status, message.strip() or f"{method} {path}")
+        return json.loads(body) if body else None
+
+    # ========================
+    # 容器
+    # ========================
+
+    async def inspect(self, container: str) -> dict:
+        return await self._json("GET", f"/containers/{quote(container)}/json")
+
+    async def state(self, container: str) -> dict:
+        """容器状态摘要（运行状态、启动时间、健康检查结果）"""
+        info = await self.inspect(container)
+        state = info.get("State") or {}
+        health = state.get("Health") or {}
+        return {
+            "id": info.get("Id", "")[:12],
+            "name": info.get("Name", "").lstrip("/"),
+            "image": (info.get("Config") or {}).get("Image"),
+            "status": state.get("Status"),
+            "running": bool(state.get("Running")),
+            "restarting": bool(state.get("Restarting")),
+            "exit_code": state.get("ExitCode"),
+            "error": state.get("Error") or None,
+            "started_at": state.get("StartedAt"),
+            "restart_count": info.get("RestartCount"),
+            "health": health.get("Status"),  # 未配置健康检查时为 None
+        }
+
+    async def restart(self, container: str, stop_timeout: int = 10):
+        """重启容器，stop_timeout 为强制结束前等待容器退出的秒数"""
+        await self._json("POST", f"/containers/{quote(container)}/restart", expect=(204,),
+                         params={"t": stop_timeout}, timeout=stop_timeout + DOCKER_API_TIMEOUT)
+
+    async def wait_ready(self, container: str, timeout: float = 30, started_after: str = None,
+                         interval: float = 0.2) -> dict:
+        """
+        等待容器就绪：正在运行、不在重启中、配置了健康检查时为 healthy；
+        指定 started_after 时还要求启动时间与之不同（确认是重启后的新进程）。
+        返回最后一次的状态摘要，超时抛出 DockerError
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            state = await self.state(container)
+            if (state["running"] and not state["restarting"]
+                    and state["health"] in (None, "healthy")
+                    and (started_after is None or state["started_at"] != started_after)):
+                return state
+            stopped = not state["running"] and not state["restarting"]
+            if state["health"] == "unhealthy" or (stopped and state["started_at"] != started_after):
+                raise DockerError(0, f"容器 {container} 未能启动: {state['status']} {state['error'] or ''}".strip())
+            if time.monotonic() + interval > deadline:
+                raise DockerError(0, f"等待容器 {container} 就绪超时（{state['status']}）")
+            await asyncio.sleep(interval)
+
+    def get_stats(self) -> dict:
+        return {
+            "socket": self.socket_path,
+            "available": self.available,
+            "connected": self._writer is not None,
+            "requests": self.requests,
+            "connects": self.connects,
+            "errors": self.errors,
+        }
+
+
+# 全局 Docker 客户端实例
+docker_client = DockerClient()
+
+
+if __name__ == "__main__":
+    # 自检: 在临时 unix socket 上模拟 Docker Engine API，检查分块响应、错误、重启与就绪等待、连接复用与重试
+    import tempfile
+
+    class FakeDocker:
+        def __init__(self):
+            self.connections = 0
+            self.restarts = 0
+            self.started_at = "2024-01-01T00:00:00Z"
+            self.polls_until_ready = 0
+            self.close_after_response = False
+
+        def container(self) -> dict:
+            restarting = self.polls_until_ready > 0
+            if restarting:
+                self.polls_until_ready -= 1
+            return {
+                "Id": "0123456789abcdef", "Name": "/frps", "RestartCount": self.restarts,
+                "Config": {"Image": "snowdreamtech/frps"},
+                "State": {"Status": "restarting" if restarting else "running", "Running": not restarting,
+                          "Restarting": restarting, "ExitCode": 0, "Error": "", "StartedAt": self.started_at},
+            }
+
+        async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+            self.connections += 1
+            try:
+                while True:
+                    request_line = await reader.readline()
+                    if not request_line:
+                        return
+                    method, path, _ = request_line.decode().split(" ", 2)
+                    headers = {}
+                    while (line := await reader.readline()) != b"\r\n":
+                        name, _, value = line.decode().partition(":")
+                        headers[name.strip().lower()] = value.strip()
+                    await reader.readexactly(int(headers.get("content-length", 0)))
+
+                    if path.startswith("/containers/flaky/"):
+                        # 收到请求后不响应直接断开
+                        self.restarts += 1
+                        return
+                    if method == "GET" and path == "/containers/frps/json":
+                        body = json.dumps(self.container()).encode()
+                        # 分块发送
+                        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\nTransfer-Encoding: chunked\r\n\r\n")
+                        for i in range(0, len(body), 64):
+                            chunk = body[i:i + 64]
+                            writer.write(f"{len(chunk):x}\r\n".encode() + chunk + b"\r\n")
+                        writer.write(b"0\r\n\r\n")
+                    elif method == "POST" and path.startswith("/containers/frps/restart"):
+                        self.restarts += 1
+                        self.started_at = f"2024-01-01T00:00:{self.restarts:02d}Z"
+                        self.polls_until_ready = 2
+                        writer.write(b"HTTP/1.1 204 No Content\r\n\r\n")
+                    else:
+                        body = json.dumps({"message": f"No such container: {path.split('/')[2]}"}).encode()
+                        writer.write(b"HTTP/1.1 404 Not Found\r\nContent-Length: " + str(len(body)).encode() + b"\r\n\r\n" + body)
+                    await writer.drain()
+                    if self.close_after_response:
+                        return
+            finally:
+                writer.close()
+
+    async def self_check():
+        fake = FakeDocker()
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "docker.sock")
+            server = await asyncio.start_unix_server(fake.handle, path)
+            client = DockerClient(path)
+
+            # 分块响应
+            state = await client.state("frps")
+            assert state["running"] and state["name"] == "frps" and state["image"] == "snowdreamtech/frps", state
+            print("chunked response      ok")
+
+            # 错误响应
+            try:
+                await client.inspect("missing")
+                raise AssertionError("404 expected")
+            except DockerError as e:
+                assert e.status == 404 and "missing" in e.message, e
+            print("error response        ok")
+
+            # 重启并等待新进程就绪
+            before = state["started_at"]
+            await client.restart("frps", stop_timeout=1)
+            ready = await client.wait_ready("frps", timeout=5, started_after=before, interval=0.01)
+            assert ready["running"] and ready["started_at"] != before and fake.restarts == 1, ready
+            print("restart + wait_ready  ok")
+
+            # keep-alive：上面的请求和之后的 50 次查询共用一个连接
+            started = time.perf_counter()
+            for _ in range(50):
+                await client.inspect("frps")
+            elapsed = time.perf_counter() - started
+            assert fake.connections == 1 and client.connects == 1, (fake.connections, client.connects)
+            print(f"keep-alive reuse      ok ({client.requests} requests, 1 connection, {elapsed / 50 * 1000:.2f}ms/inspect)")
+
+            # Docker 关闭空闲连接后自动重连
+            fake.close_after_response = True
+            await client.inspect("frps")
+            await asyncio.sleep(0.05)
+            await client.inspect("frps")
+            fake.close_after_response = False
+            assert client.connects == 2, client.connects
+            print("reconnect             ok")
+
+            # 复用的连接上 POST 失败时不重发
+            await client.inspect("frps")
+            restarts = fake.restarts
+            try:
+                await client.restart("flaky")
+                raise AssertionError("DockerError expected")
+            except DockerError:
+                pass
+            assert fake.restarts == restarts + 1, fake.restarts
+            print("POST not retried      ok")
+
+            await client.close()
+            server.close()
+            await server.wait_closed()
+
+            # socket 不存在
+            try:
+                await DockerClient(path).inspect("frps")
+                raise AssertionError("DockerError expected")
+            except DockerError as e:
+                assert e.status == 0
+            print("missing socket        ok")
+
+    asyncio.run(self_check())
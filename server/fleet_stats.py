@@ -0,0 +1,196 @@
+"""
+全舰队指标统计
+以列式 numpy 数组保存每个 Agent 的最新指标和按分钟聚合的近期窗口，
+百分位、Top-K、直方图都在数组上向量化计算，无需逐个遍历 Agent
+"""
+from typing import Dict, List, Optional, Sequence
+import threading
+import time
+
+import numpy as np
+
+# 参与统计的指标（列顺序）
+METRICS = ("cpu_percent", "memory_percent", "disk_percent", "net_speed_in", "net_speed_out")
+_METRIC_INDEX = {name: i for i, name in enumerate(METRICS)}
+
+# 百分比类指标的直方图固定在 0-100
+PERCENT_METRICS = {"cpu_percent", "memory_percent", "disk_percent"}
+
+BUCKET_SECONDS = 60   # 窗口聚合粒度
+WINDOW_BUCKETS = 60   # 保留最近 60 个桶（1 小时）
+WINDOW_MINUTES = WINDOW_BUCKETS * BUCKET_SECONDS // 60  # 可查询的最大窗口
+
+DEFAULT_PERCENTILES = (50, 90, 95, 99)
+
+
+class FleetMetricsStore:
+    """按行存放 Agent、按列存放指标的内存统计表"""
+
+    def __init__(self, initial_capacity: int = 256):
+        self._lock = threading.Lock()
+        self._rows: Dict[str, int] = {}   # client_id -> 行号
+        self._client_ids: List[str] = []  # 行号 -> client_id
+        self._allocate(initial_capacity)
+
+    def _allocate(self, capacity: int):
+        m = len(METRICS)
+        self.latest = np.full((capacity, m), np.nan)
+        self.updated_at = np.zeros(capacity)
+        # 窗口桶按 (指标, Agent, 桶) 排列，查询单个指标时内存连续
+        self.bucket_sum = np.zeros((m, capacity, WINDOW_BUCKETS), dtype=np.float32)
+        self.bucket_cnt = np.zeros((m, capacity, WINDOW_BUCKETS), dtype=np.float32)
+        self.bucket_epoch = np.full((capacity, WINDOW_BUCKETS), -1, dtype=np.int64)
+
+    def _grow(self):
+        latest, updated_at, bucket_sum, bucket_cnt, bucket_epoch = (
+            self.latest, self.updated_at, self.bucket_sum, self.bucket_cnt, self.bucket_epoch
+        )
+        n = len(self._client_ids)
+        self._allocate(max(len(latest) * 2, 1))
+        self.latest[:n] = latest[:n]
+        self.updated_at[:n] = updated_at[:n]
+        self.bucket_sum[:, :n] = bucket_sum[:, :n]
+        self.bucket_cnt[:, :n] = bucket_cnt[:, :n]
+        self.bucket_epoch[:n] = bucket_epoch[:n]
+
+    def _row(self, client_id: str) -> int:
+        row = self._rows.get(client_id)
+        if row is None:
+            if len(self._client_ids) == len(self.latest):
+                self._grow()
+            row = self._rows[client_id] = len(self._client_ids)
+            self._client_ids.append(client_id)
+        return row
+
+    def retain(self, client_ids):
+        """只保留仍存在的客户端，压缩掉已删除客户端的行"""
+        with self._lock:
+            keep = [row for row, cid in enumerate(self._client_ids) if cid in client_ids]
+            if len(keep) == len(self._client_ids):
+                return
+            latest, updated_at, bucket_sum, bucket_cnt, bucket_epoch = (
+                self.latest, self.updated_at, self.bucket_sum, self.bucket_cnt, self.bucket_epoch
+            )
+            # 重新分配而不是原地移动：查询在锁外持有的是旧列表和旧数组
+            self._allocate(len(latest))
+            n = len(keep)
+            self.latest[:n] = latest[keep]
+            self.updated_at[:n] = updated_at[keep]
+            self.bucket_sum[:, :n] = bucket_sum[:, keep]
+            self.bucket_cnt[:, :n] = bucket_cnt[:, keep]
+            self.bucket_epoch[:n] = bucket_epoch[keep]
+            self._client_ids = [self._client_ids[row] for row in keep]
+            self._rows = {cid: row for row, cid in enumerate(self._client_ids)}
+
+    # ========================
+    # 写入
+    # ========================
+
+    def record(self, client_id: str, sample: dict, now: float = None):
+        """写入一条 system_info 样本，O(指标数)"""
+        now = time.time() if now is None else now
+        values = np.array(
+            [np.nan if sample.get(name) is None else float(sample[name]) for name in METRICS]
+        )
+        present = ~np.isnan(values)
+        epoch = int(now // BUCKET_SECONDS)
+        slot = epoch % WINDOW_BUCKETS
+
+        with self._lock:
+            row = self._row(client_id)
+            self.latest[row, present] = values[present]
+            self.updated_at[row] = now
+            if self.bucket_epoch[row, slot] != epoch:
+                self.bucket_epoch[row, slot] = epoch
+                self.bucket_sum[:, row, slot] = 0
+                self.bucket_cnt[:, row, slot] = 0
+            self.bucket_sum[present, row, slot] += values[present]
+            self.bucket_cnt[present, row, slot] += 1
+
+    # ========================
+    # 查询
+    # ========================
+
+    def _values(self, metric: str, window_minutes: Optional[int], max_age: Optional[float], now: float):
+        """返回 (行号数组, 对应的取值)，已过滤缺失值"""
+        n = len(self._client_ids)
+        col = _METRIC_INDEX[metric]
+        if window_minutes:
+            window = int(window_minutes * 60 // BUCKET_SECONDS) or 1
+            current = int(now // BUCKET_SECONDS)
+            in_window = (self.bucket_epoch[:n] > current - window)
+            sums = (self.bucket_sum[col, :n] * in_window).sum(axis=1)
+            cnts = (self.bucket_cnt[col, :n] * in_window).sum(axis=1)
+            with np.errstate(invalid="ignore", divide="ignore"):
+                values = sums / cnts
+        else:
+            values = self.latest[:n, col].copy()
+
+        mask = ~np.isnan(values)
+        if max_age is not None:
+            mask &= (now - self.updated_at[:n]) <= max_age
+        rows = np.nonzero(mask)[0]
+        return rows, values[rows]
+
+    def query(
+        self,
+        metric: str,
+        window_minutes: int = None,
+        percentiles: Sequence[float] = DEFAULT_PERCENTILES,
+        top: int = 10,
+        bins: int = 10,
+        ascending: bool = False,
+        max_age: float = None,
+    ) -> dict:
+        """
+        统计单个指标在全部 Agent 上的分布
+
+        Args:
+            window_minutes: 为空时使用最新值，否则使用最近 N 分钟的均值（不超过 WINDOW_MINUTES）
+            top: 返回数值最高（ascending=True 时最低）的 N 个 Agent
+            bins: 直方图分桶数
+            max_age: 只统计最近 max_age 秒内有上报的 Agent
+        """
+        if metric not in _METRIC_INDEX:
+            raise ValueError(f"未知指标: {metric}")
+        if window_minutes and window_minutes > WINDOW_MINUTES:
+            raise ValueError(f"窗口不能超过 {WINDOW_MINUTES} 分钟")
+        now = time.time()
+        with self._lock:
+            rows, values = self._values(metric, window_minutes, max_age, now)
+            client_ids = self._client_ids
+
+        result = {"metric": metric, "window_minutes": window_minutes, "count": int(values.size)}
+        if values.size == 0:
+            return {**result, "percentiles": {}, "top": [], "histogram": {"edges": [], "counts": []}}
+
+        pct = np.percentile(values, percentiles)
+
+        top_items = []
+        if top:
+            k = min(top, values.size)
+            keyed = values if ascending else -values
+            idx = np.argpartition(keyed, k - 1)[:k]
+            idx = idx[np.argsort(keyed[idx], kind="stable")]
+            # retain() 会替换整个列表而不是原地修改，锁外用快照映射 client_id 是安全的
+            top_items = [{"client_id": client_ids[rows[i]], "value": float(values[i])} for i in idx]
+
+        hist_range = (0.0, 100.0) if metric in PERCENT_METRICS else None
+        counts, edges = np.histogram(values, bins=bins, range=hist_range)
+
+        return {
+            **result,
+            "mean": float(values.mean()),
+            "min": float(values.min()),
+            "max": float(values.max()),
+            "percentiles": {f"p{p:g}": float(v) for p, v in zip(percentiles, pct)},
+            "top": top_items,
+            "histogram": {"edges": edges.tolist(), "counts": counts.tolist()},
+        }
+
+    def __len__(self):
+        return len(self._client_ids)
+
+
+# 全局统计实例
+fleet_stats = FleetMetricsStore()
@@ -1,10 +1,12 @@
-import subprocess
 import requests
 import secrets
-from typing import Dict
+from typing import Dict, List, Optional
 import ipaddress
 import os
 import re
+import tomllib
+
+from port_ranges import PortRangeSet, PORT_MIN, PORT_MAX
 
 # FRP 配置文件路径（映射到宿主机项目根目录）
 # Backend 容器中 /app/frps.toml 映射到宿主机 ./frps.toml
@@ -17,6 +19,15 @@ DOCKER_COMPOSE_DIR = "/app"
 # 默认 FRP 版本（备用，当无法获取最新版本时使用）
 DEFAULT_FRP_VERSION = "0.61.1"
 
+# frps 不支持热加载配置，任何修改都要重启容器才能生效，而重启会断开所有客户端的隧道。
+# 按修改的配置项决定是否需要立即重启：
+RESTART_NONE = "none"          # 没有实际变化（只是注释或格式不同）
+RESTART_DEFERRED = "deferred"  # 可以推迟到维护窗口
+RESTART_REQUIRED = "required"  # 需要立即重启
+
+# 差异报告中不显示明文的配置项
+SECRET_KEYS = {"auth.token", "webServer.password"}
+
 def get_latest_frp_version() -> str:
     """从 GitHub API 获取 FRP 最新发布版本号"""
     try:
@@ -121,21 +132,107 @@ def get_public_ip_details() -> Dict:
 def get_public_ip() -> str:
     return get_public_ip_details().get("ip") or "未知"
 
-def generate_frps_config(port: int = 7000, auth_token: str = None, server_ip: str = None, disabled_ports: list = None) -> Dict:
+def read_frps_config() -> Optional[str]:
+    """读取当前的 frps.toml，文件不存在时返回 None"""
+    try:
+        with open(FRPS_CONFIG_PATH) as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+def _flatten(table: dict, prefix: str = "") -> Dict:
+    """{"auth": {"token": x}} -> {"auth.token": x}"""
+    result = {}
+    for key, value in table.items():
+        if isinstance(value, dict):
+            result.update(_flatten(value, f"{prefix}{key}."))
+        else:
+            result[f"{prefix}{key}"] = value
+    return result
+
+def _describe_value(key: str, value):
+    if value is None:
+        return None
+    if key in SECRET_KEYS:
+        return "******"
+    if key == "allowPorts":
+        return str(_allowed_ports(value))
+    return value
+
+def _allowed_ports(value) -> PortRangeSet:
+    """[{ start = 1, end = 6000 }, { single = 6002 }] -> 1-6000,6002；未配置 allowPorts 时允许所有端口"""
+    if value is None:
+        return PortRangeSet([(PORT_MIN, PORT_MAX)])
+    allowed = PortRangeSet()
+    for item in value:
+        if "single" in item:
+            allowed.add(item["single"], item["single"])
+        else:
+            allowed.add(item["start"], item["end"])
+    return allowed
+
+def _restart_for(key: str, old_value, new_value) -> str:
+    """单个配置项变化所需的重启方式"""
+    if key == "allowPorts":
+        # 只收窄允许的端口（禁用端口）可以推迟：FRP Manager 分配/校验隧道端口时已经拦截，frps 的 allowPorts 只是兜底。
+        # 放宽（重新启用端口）必须立即重启，否则 FRP Manager 已放行的端口会一直被 frps 拒绝
+        if _allowed_ports(new_value).issubset(_allowed_ports(old_value)):
+            return RESTART_DEFERRED
+    return RESTART_REQUIRED
+
+def diff_frps_config(old: Optional[str], new: str) -> List[Dict]:
+    """
+    比较两份 frps.toml，返回每个变化的配置项 {"key", "old", "new", "restart"}
+    旧配置未知或无法解析时返回一条 key 为 "*" 的需要重启的记录
+    """
+    try:
+        old_items = _flatten(tomllib.loads(old)) if old is not None else None
+    except tomllib.TOMLDecodeError:
+        old_items = None
+    if old_items is None:
+        return [{"key": "*", "old": None, "new": None, "restart": RESTART_REQUIRED}]
+    new_items = _flatten(tomllib.loads(new))
+
+    changes = []
+    for key in sorted(set(old_items) | set(new_items)):
+        old_value, new_value = old_items.get(key), new_items.get(key)
+        if old_value == new_value:
+            continue
+        changes.append({
+            "key": key,
+            "old": _describe_value(key, old_value),
+            "new": _describe_value(key, new_value),
+            "restart": _restart_for(key, old_value, new_value),
+        })
+    return changes
+
+def restart_decision(changes: List[Dict]) -> str:
+    """根据配置差异决定重启方式"""
+    if not changes:
+        return RESTART_NONE
+    if any(c["restart"] == RESTART_REQUIRED for c in changes):
+        return RESTART_REQUIRED
+    return RESTART_DEFERRED
+
+def generate_frps_config(port: int = 7000, auth_token: str = None, server_ip: str = None, disabled_ports: list = None,
+                         dashboard_pwd: str = None) -> Dict:
     """
-    生成 FRPS 配置文件
+    生成 FRPS 配置文件（只写文件，重启 FRPS 由 frps_jobs 在后台完成）
+    会访问外部网络（公网 IP、最新版本号），不要在事件循环中直接调用
     
     Args:
         port: FRPS 监听端口
         auth_token: 认证 Token
         server_ip: 公网 IP
-        disabled_ports: 禁用的端口列表，例如 [6001, 6005]
+        disabled_ports: 禁用的端口，端口列表（例如 [6001, 6005]）或 PortRangeSet
+        dashboard_pwd: Dashboard 密码，为空时重新生成
     """
     if not auth_token:
         auth_token = secrets.token_hex(16)
     
     # 生成 Dashboard 密码（用于 FRPS Admin API）
-    dashboard_pwd = secrets.token_hex(8)
+    if not dashboard_pwd:
+        dashboard_pwd = secrets.token_hex(8)
     
     # 计算 allowPorts
     # 默认允许所有端口 (1-65535)
@@ -143,38 +240,19 @@ def generate_frps_config(port: int = 7000, auth_token: str = None, server_ip: st
     allow_ports_config = ""
     
     if disabled_ports:
-        # 全端口范围
-        total_start = 1
-        total_end = 65535
-        
-        allowed_ranges = []
-        current_start = total_start
-        
-        # 排序并去重
-        sorted_disabled = sorted(list(set([int(p) for p in disabled_ports if total_start <= int(p) <= total_end])))
-        
-        for p in sorted_disabled:
-            if p > current_start:
-                if p - 1 == current_start:
-                    allowed_ranges.append(str(current_start))
-                else:
-                    allowed_ranges.append(f"{current_start}-{p-1}")
-            current_start = p + 1
-            
-        if current_start <= total_end:
-            if current_start == total_end:
-                allowed_ranges.append(str(current_start))
-            else:
-                allowed_ranges.append(f"{current_start}-{total_end}")
+        # 禁用端口可以是端口列表或 PortRangeSet，允许的端口为其在 1-65535 中的补集
+        if not isinstance(disabled_ports, PortRangeSet):
+            disabled_ports = PortRangeSet((int(p), int(p)) for p in disabled_ports if 1 <= int(p) <= 65535)
+        allowed_ranges = [
+            f"{{ single = {start} }}" if start == end else f"{{ start = {start}, end = {end} }}"
+            for start, end in disabled_ports.complement().ranges()
+        ]
         
         # 如果排除了所有端口（极端情况），allowed_ranges 为空，这将导致 allowPorts = []，即拒绝所有
         if allowed_ranges:
-            allow_ports_config = f'allowPorts = [{", ".join([f"{r}" for r in allowed_ranges])}]'
+            allow_ports_config = "allowPorts = [\n" + "".join(f"  {r},\n" for r in allowed_ranges) + "]"
         else:
             allow_ports_config = 'allowPorts = []' # 禁用所有端口
-    else:
-        # 没有任何禁用端口，不生成 allowPorts 配置，默认允许所有
-        pass
 
     try:
         # 生成配置内容（包含 Dashboard API 配置）
@@ -198,41 +276,6 @@ webServer.password = "{dashboard_pwd}"
         with open(FRPS_CONFIG_PATH, 'w') as f:
             f.write(config_content)
         
-        # 尝试重启 FRPS 容器（如果在 Docker Compose 环境中）
-        frps_restarted = False
-        restart_message = ""
-        
-        try:
-            # 使用 docker CLI 重启容器
-            result = subprocess.run(
-                ["docker", "restart", "frps"],
-                check=False,
-                capture_output=True,
-                timeout=30,  # 增加超时时间
-                text=True
-            )
-            if result.returncode == 0:
-                print("✅ FRPS 容器已成功重启")
-                frps_restarted = True
-                restart_message = "FRPS 已重启"
-                
-                # 等待容器启动完成
-                import time
-                time.sleep(2)
-            else:
-                restart_message = f"FRPS 重启失败: {result.stderr.strip()}"
-                print(f"⚠️ {restart_message}")
-        except FileNotFoundError:
-            restart_message = "未找到 docker 命令，请手动重启 FRPS"
-            print(f"⚠️ {restart_message}")
-        except subprocess.TimeoutExpired:
-            restart_message = "FRPS 重启超时，请手动检查"
-            print(f"⚠️ {restart_message}")
-        except Exception as e:
-            restart_message = f"无法重启 FRPS 容器: {str(e)}"
-            print(f"⚠️ {restart_message}")
-            print("提示: 配置已生成，请手动执行 'docker restart frps'")
-        
         # 获取公网 IP（优先使用用户提供的）
         if server_ip and server_ip.strip():
             public_ip = server_ip.strip()
@@ -244,9 +287,8 @@ webServer.password = "{dashboard_pwd}"
         
         return {
             "success": True,
-            "message": "FRPS 配置已生成" + (" 并已重启" if frps_restarted else ""),
-            "frps_restarted": frps_restarted,
-            "restart_message": restart_message,
+            "message": "FRPS 配置已生成",
+            "content": config_content,
             "info": {
                 "version": frp_version,  # 从 GitHub API 获取的真实版本号
                 "port": port,
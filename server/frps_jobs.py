@@ -0,0 +1,445 @@
+"""
+FRPS 后台任务
+生成 frps.toml、重启 FRPS 容器都是耗时操作，统一放到一个后台 worker 中按提交顺序串行执行，
+接口只需提交任务并拿到任务 id，状态与日志可通过 /api/frp/jobs 查询；
+重启优先通过 Docker Engine API（docker.sock）完成并等待容器就绪，没有 socket 时退回 docker CLI 子进程，
+等待期间事件循环照常处理其他请求。
+排队中的任务会尽量合并：重启请求并入已在排队、且包含重启步骤的任务，
+新提交的配置任务会吸收排队中的单纯重启任务，同一时间最多只会有一次重启在排队。
+写入新配置的任务在重启前与 FRPS 运行中的配置比较：没有变化时不重启，
+只有禁用端口（收窄 allowPorts）时推迟到维护窗口或没有在线 Agent 时统一重启一次
+"""
+from collections import OrderedDict, deque
+from datetime import datetime
+from typing import Awaitable, Callable, Deque, List, Optional, Sequence, Tuple, Union
+import asyncio
+import os
+import time
+import uuid
+import logging
+
+import crud
+import models
+import frp_deploy
+from database import write_db
+from docker_api import docker_client, DockerError
+from frp_deploy import RESTART_NONE, RESTART_DEFERRED
+
+logger = logging.getLogger(__name__)
+
+FRPS_CONTAINER = os.environ.get("FRPS_CONTAINER", "frps")
+FRPS_RESTART_TIMEOUT = float(os.environ.get("FRPS_RESTART_TIMEOUT", "30"))
+# 重启后等待容器就绪的最长秒数（Docker API）
+FRPS_READY_TIMEOUT = float(os.environ.get("FRPS_READY_TIMEOUT", "20"))
+# 通过 docker CLI 重启时无法得知容器状态，成功后固定等待的秒数
+FRPS_RESTART_SETTLE = float(os.environ.get("FRPS_RESTART_SETTLE", "2"))
+
+# 可推迟的重启在每天的这个时间段内执行（服务器本地时间，可跨零点如 "23:00-01:00"，为空表示不设窗口）
+FRPS_MAINTENANCE_WINDOW = os.environ.get("FRPS_MAINTENANCE_WINDOW", "03:00-05:00")
+# 没有在线 Agent 时立即执行推迟的重启（此时重启不会断开任何隧道）
+FRPS_RESTART_WHEN_IDLE = os.environ.get("FRPS_RESTART_WHEN_IDLE", "1").lower() not in ("0", "false", "no")
+
+# 保留最近多少个任务供查询
+JOB_HISTORY = 50
+# 每个任务最多保留的日志条数
+JOB_LOG_LIMIT = 200
+
+# 任务状态
+QUEUED = "queued"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+COALESCED = "coalesced"   # 已并入另一个任务（见 merged_into）
+
+# 步骤列表中的重启 FRPS 标记
+RESTART = "restart"
+
+# 重启方式：auto 按配置差异决定是否推迟，now 总是立即重启
+RESTART_AUTO = "auto"
+RESTART_NOW = "now"
+RESTART_MODES = (RESTART_AUTO, RESTART_NOW)
+
+Step = Union[str, Callable[["FrpsJob"], Awaitable[Optional[dict]]]]
+Restarter = Callable[["FrpsJob"], Awaitable[Tuple[bool, str]]]
+
+
+class FrpsJob:
+    """
+    一个 FRPS 任务
+    steps 按顺序执行：RESTART 表示重启 FRPS，其他为协程函数 step(job)，返回的 dict 合并进 job.result；
+    步骤抛出异常或重启失败时任务失败并跳过后续步骤（后续步骤通常依赖 FRPS 已加载新配置）
+    """
+
+    def __init__(self, kind: str, steps: Sequence[Step], coalesce: bool = False, restart_mode: str = RESTART_AUTO):
+        self.id = uuid.uuid4().hex[:12]
+        self.kind = kind
+        self.steps = list(steps)
+        self.coalesce = coalesce  # 排队中时，同类任务可以直接并入
+        self.restart_mode = restart_mode
+        self.config: Optional[str] = None  # 本任务写入的 frps.toml，由生成配置的步骤设置
+        self.state = QUEUED
+        self.created_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.requests = 1         # 并入本任务的请求数（含自身）
+        self.merged_into: Optional[str] = None
+        self.result: dict = {}
+        self.error: Optional[str] = None
+        self.logs: Deque[dict] = deque(maxlen=JOB_LOG_LIMIT)
+        self._target: Optional["FrpsJob"] = None
+        self._done = asyncio.Event()
+
+    @property
+    def restarts(self) -> bool:
+        return RESTART in self.steps
+
+    @property
+    def finished(self) -> bool:
+        return self._done.is_set()
+
+    def log(self, message: str):
+        self.logs.append({"at": time.time(), "message": message})
+        logger.info(f"FRPS 任务 {self.id}（{self.kind}）: {message}")
+
+    def to_dict(self, logs: bool = True) -> dict:
+        result = {
+            "id": self.id,
+            "kind": self.kind,
+            "state": self.state,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "requests": self.requests,
+            "restart_mode": self.restart_mode,
+            "merged_into": self.merged_into,
+            "result": self.result,
+            "error": self.error,
+        }
+        if logs:
+            result["logs"] = list(self.logs)
+        return result
+
+
+async def docker_cli_restart(job: FrpsJob) -> Tuple[bool, str]:
+    """通过 docker CLI 重启 FRPS 容器"""
+    try:
+        proc = await asyncio.create_subprocess_exec(
+            "docker", "restart", FRPS_CONTAINER,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+        )
+    except FileNotFoundError:
+        return False, "未找到 docker 命令，请手动重启 FRPS"
+    try:
+        _, stderr = await asyncio.wait_for(proc.communicate(), FRPS_RESTART_TIMEOUT)
+    except asyncio.TimeoutError:
+        proc.kill()
+        await proc.wait()
+        return False, "FRPS 重启超时，请手动检查"
+    if proc.returncode != 0:
+        return False, f"FRPS 重启失败: {stderr.decode(errors='replace').strip()}"
+    if FRPS_RESTART_SETTLE > 0:
+        job.log(f"等待 FRPS 启动 {FRPS_RESTART_SETTLE:g}s")
+        await asyncio.sleep(FRPS_RESTART_SETTLE)
+    return True, "FRPS 已重启"
+
+
+async def docker_api_restart(job: FrpsJob) -> Tuple[bool, str]:
+    """通过 Docker Engine API 重启 FRPS 容器，并等待新启动的容器就绪"""
+    try:
+        before = await docker_client.state(FRPS_CONTAINER)
+        job.log(f"重启前容器状态: {before['status']}，启动于 {before['started_at']}")
+        await docker_client.restart(FRPS_CONTAINER)
+        job.log("等待容器就绪")
+        state = await docker_client.wait_ready(FRPS_CONTAINER, FRPS_READY_TIMEOUT, started_after=before["started_at"])
+    except DockerError as e:
+        return False, f"FRPS 重启失败: {e}"
+    job.log(f"容器已就绪: {state['status']}" + (f"（{state['health']}）" if state["health"] else ""))
+    return True, "FRPS 已重启"
+
+
+def _parse_window(text: str) -> Optional[Tuple[int, int]]:
+    """"03:00-05:00" -> (180, 300)，单位为当天的分钟数"""
+    if not text or not text.strip():
+        return None
+    start, _, end = text.strip().partition("-")
+    minutes = []
+    for part in (start, end):
+        hour, _, minute = part.strip().partition(":")
+        minutes.append(int(hour) * 60 + int(minute or 0))
+    return minutes[0], minutes[1]
+
+
+async def restart_frps_container(job: FrpsJob) -> Tuple[bool, str]:
+    """有 docker.sock 时使用 Docker Engine API，否则使用 docker CLI"""
+    if docker_client.available:
+        return await docker_api_restart(job)
+    return await docker_cli_restart(job)
+
+
+class FrpsJobRunner:
+    """FRPS 任务队列与串行 worker"""
+
+    def __init__(self, restarter: Restarter = restart_frps_container):
+        self.restarter = restarter
+        self._jobs: "OrderedDict[str, FrpsJob]" = OrderedDict()
+        self._queue: Deque[FrpsJob] = deque()
+        self._worker: Optional[asyncio.Task] = None
+        self.current: Optional[FrpsJob] = None
+        self.window = _parse_window(FRPS_MAINTENANCE_WINDOW)
+        self.running_config: Optional[str] = None  # FRPS 最近一次重启时加载的 frps.toml
+        self.deferred: Optional[dict] = None       # 推迟中的重启
+        self.submitted = 0
+        self.coalesced = 0
+        self.restarts = 0
+        self.restart_failures = 0
+        self.restarts_skipped = 0
+        self.restarts_deferred = 0
+
+    def load(self, db):
+        """启动时读取 FRPS 运行中的配置，与磁盘上的 frps.toml 不一致说明有尚未执行的重启"""
+        current = frp_deploy.read_frps_config()
+        running = crud.get_config(db, models.ConfigKeys.FRPS_RUNNING_CONFIG)
+        if running is None and current is not None:
+            # 没有记录时认为 FRPS 运行的就是磁盘上的配置
+            crud.set_config(db, models.ConfigKeys.FRPS_RUNNING_CONFIG, current)
+            running = current
+        self.running_config = running
+        self.deferred = None
+        if current is not None and current != running:
+            changes = frp_deploy.diff_frps_config(running, current)
+            if frp_deploy.restart_decision(changes) != RESTART_NONE:
+                self._defer(changes)
+
+    # ========================
+    # 提交
+    # ========================
+
+    def submit(self, kind: str, steps: Sequence[Step], coalesce: bool = False,
+               restart_mode: str = RESTART_AUTO) -> FrpsJob:
+        """
+        提交任务并返回（可能是合并后的）任务对象
+        coalesce 为 True 时，若已有同类任务在排队则直接并入该任务；要求立即重启的请求并入后，该任务也会立即重启
+        """
+        self.submitted += 1
+        restart_only = list(steps) == [RESTART]
+        for queued in self._queue:
+            if (coalesce and queued.coalesce and queued.kind == kind) or (restart_only and queued.restarts):
+                queued.requests += 1
+                if restart_mode == RESTART_NOW:
+                    queued.restart_mode = RESTART_NOW
+                self.coalesced += 1
+                queued.log(f"合并了一个新的 {kind} 请求")
+                return queued
+
+        job = FrpsJob(kind, steps, coalesce, restart_mode)
+        if job.restarts:
+            # 排队中的单纯重启任务由本任务代为完成
+            for queued in [q for q in self._queue if q.steps == [RESTART]]:
+                self._queue.remove(queued)
+                self._merge(queued, job)
+                job.restart_mode = RESTART_NOW
+        self._remember(job)
+        self._queue.append(job)
+        job.log("已排队")
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.create_task(self._run())
+        return job
+
+    def restart(self, reason: str = "manual") -> FrpsJob:
+        """请求重启 FRPS，与排队中的重启合并"""
+        job = self.submit("restart", [RESTART], restart_mode=RESTART_NOW)
+        job.log(f"重启原因: {reason}")
+        return job
+
+    def _merge(self, job: FrpsJob, into: FrpsJob):
+        job.state = COALESCED
+        job.merged_into = into.id
+        job._target = into
+        job.finished_at = time.time()
+        into.requests += job.requests
+        self.coalesced += 1
+        job.log(f"已并入任务 {into.id}")
+        job._done.set()
+
+    def _remember(self, job: FrpsJob):
+        self._jobs[job.id] = job
+        while len(self._jobs) > JOB_HISTORY:
+            oldest_id, oldest = next(iter(self._jobs.items()))
+            if not oldest.finished:
+                break
+            del self._jobs[oldest_id]
+
+    # ========================
+    # 执行
+    # ========================
+
+    async def _run(self):
+        while self._queue:
+            job = self._queue.popleft()
+            self.current = job
+            try:
+                await self._execute(job)
+            finally:
+                self.current = None
+
+    async def _execute(self, job: FrpsJob):
+        job.state = RUNNING
+        job.started_at = time.time()
+        job.log("开始执行")
+        try:
+            for i, step in enumerate(job.steps):
+                if step == RESTART:
+                    await self._restart_step(job)
+                    if job.error:
+                        skipped = len(job.steps) - i - 1
+                        if skipped:
+                            job.log(f"FRPS 重启失败，跳过后续 {skipped} 个步骤")
+                        break
+                else:
+                    job.result.update(await step(job) or {})
+        except Exception as e:
+            job.error = str(e)
+            job.log(f"执行失败: {e}")
+            logger.exception(f"FRPS 任务 {job.id} 失败")
+        job.state = FAILED if job.error else SUCCEEDED
+        job.finished_at = time.time()
+        job.log(f"结束（{job.state}），耗时 {job.finished_at - job.started_at:.2f}s")
+        job._done.set()
+
+    async def _restart_step(self, job: FrpsJob):
+        """写入了新配置的任务先与运行中的配置比较，决定不重启、推迟重启还是立即重启"""
+        if job.config is not None:
+            changes = frp_deploy.diff_frps_config(self.running_config, job.config)
+            decision = frp_deploy.restart_decision(changes)
+            job.result["config_changes"] = changes
+            job.result["restart_decision"] = decision
+            for change in changes:
+                job.log(f"配置变化 {change['key']}: {change['old']} -> {change['new']}（{change['restart']}）")
+            if decision == RESTART_NONE:
+                # 与运行中的配置一致，之前推迟的重启也不再需要
+                self.deferred = None
+                self.restarts_skipped += 1
+                job.result.update(frps_restarted=False, restart_message="配置与 FRPS 运行中的一致，无需重启")
+                job.log("配置没有实际变化，不重启 FRPS")
+                return
+            if decision == RESTART_DEFERRED and job.restart_mode != RESTART_NOW:
+                self._defer(changes, job)
+                message = f"配置已写入，FRPS 重启已推迟到{self.describe_window()}"
+                job.result.update(frps_restarted=False, restart_message=message)
+                job.log(message)
+                return
+        await self._restart(job)
+
+    def _defer(self, changes: List[dict], job: FrpsJob = None):
+        if self.deferred is None:
+            self.deferred = {"since": time.time(), "jobs": []}
+        # 差异总是相对于运行中的配置，后一次的结果已包含之前推迟的修改
+        self.deferred["changes"] = changes
+        if job is not None:
+            self.deferred["jobs"] = (self.deferred["jobs"] + [job.id])[-JOB_HISTORY:]
+            self.restarts_deferred += 1
+
+    async def _restart(self, job: FrpsJob):
+        # 重启后 FRPS 加载的就是此刻磁盘上的配置
+        config = frp_deploy.read_frps_config()
+        job.log(f"重启 FRPS 容器 {FRPS_CONTAINER}")
+        self.restarts += 1
+        try:
+            ok, message = await self.restarter(job)
+        except Exception as e:
+            ok, message = False, f"无法重启 FRPS 容器: {e}"
+        job.result["frps_restarted"] = ok
+        job.result["restart_message"] = message
+        job.log(message)
+        if not ok:
+            self.restart_failures += 1
+            job.error = message
+            return
+        self.deferred = None
+        if config is not None and config != self.running_config:
+            self.running_config = config
+            try:
+                await write_db(crud.set_config, models.ConfigKeys.FRPS_RUNNING_CONFIG, config)
+            except Exception as e:
+                logger.warning(f"保存 FRPS 运行中的配置失败: {e}")
+
+    # ========================
+    # 维护窗口
+    # ========================
+
+    def in_maintenance_window(self, now: datetime = None) -> bool:
+        if self.window is None:
+            return False
+        now = now or datetime.now()
+        minute = now.hour * 60 + now.minute
+        start, end = self.window
+        if start <= end:
+            return start <= minute < end
+        return minute >= start or minute < end
+
+    def describe_window(self) -> str:
+        parts = []
+        if self.window is not None:
+            parts.append(f"维护窗口（{FRPS_MAINTENANCE_WINDOW.strip()}）")
+        if FRPS_RESTART_WHEN_IDLE:
+            parts.append("没有在线 Agent 时")
+        return "或".join(parts) or "手动重启时"
+
+    def maintenance_tick(self, online_agents: int) -> Optional[FrpsJob]:
+        """定期调用：有推迟的重启且处于维护窗口或没有在线 Agent 时提交重启任务"""
+        if self.deferred is None:
+            return None
+        if (self.current is not None and self.current.restarts) or any(q.restarts for q in self._queue):
+            return None
+        if FRPS_RESTART_WHEN_IDLE and online_agents == 0:
+            reason = "没有在线 Agent"
+        elif self.in_maintenance_window():
+            reason = "维护窗口"
+        else:
+            return None
+        return self.restart(f"执行推迟的重启（{reason}）")
+
+    # ========================
+    # 查询
+    # ========================
+
+    async def wait(self, job: FrpsJob, timeout: float = None) -> FrpsJob:
+        """
+        等待任务结束（不阻塞事件循环），任务被合并时继续等待合并后的任务
+        返回实际执行的任务，超时返回时其 finished 为 False
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            remaining = None if deadline is None else deadline - time.monotonic()
+            try:
+                await asyncio.wait_for(job._done.wait(), remaining)
+            except asyncio.TimeoutError:
+                return job
+            if job._target is None:
+                return job
+            job = job._target
+
+    def get(self, job_id: str) -> Optional[FrpsJob]:
+        return self._jobs.get(job_id)
+
+    def list(self) -> List[dict]:
+        return [job.to_dict(logs=False) for job in reversed(self._jobs.values())]
+
+    def get_stats(self) -> dict:
+        return {
+            "queued": len(self._queue),
+            "running": self.current.id if self.current else None,
+            "submitted": self.submitted,
+            "coalesced": self.coalesced,
+            "restarts": self.restarts,
+            "restart_failures": self.restart_failures,
+            "restarts_skipped": self.restarts_skipped,
+            "restarts_deferred": self.restarts_deferred,
+            "deferred_restart": self.deferred,
+            "maintenance_window": FRPS_MAINTENANCE_WINDOW.strip() or None,
+        }
+
+
+# 全局 FRPS 任务实例
+frps_jobs = FrpsJobRunner()
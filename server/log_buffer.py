@@ -0,0 +1,181 @@
+"""
+Agent 近期日志的内存缓冲
+每个客户端一个预分配的字节环形缓冲区，日志以 [长度(u32) + UTF-8 内容] 紧凑存放，
+写满时覆盖最旧的行。行的序号（与磁盘日志存储的偏移量一致）是连续的，只需记录最旧一行的序号；所有缓冲区共享一个全局字节预算，超出时按 LRU 整体淘汰最久未活跃的客户端
+"""
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+import os
+import time
+
+LOG_BUFFER_BUDGET = int(os.environ.get("LOG_BUFFER_BUDGET", str(64 * 1024 * 1024)))
+LOG_RING_MAX_BYTES = int(os.environ.get("LOG_RING_MAX_BYTES", str(256 * 1024)))
+LOG_RING_MIN_BYTES = 16 * 1024
+# 为已有缓冲区扩容时，只淘汰空闲超过该时长的客户端，避免活跃客户端互相挤占
+LOG_RING_IDLE_SECONDS = 600
+
+_HEADER = 4  # 每行的长度前缀（小端 u32）
+
+
+class LogRing:
+    """单个客户端的字节环形缓冲区，行可以跨越缓冲区末尾"""
+
+    __slots__ = ("buf", "head", "used", "count", "first_seq", "touched")
+
+    def __init__(self, capacity: int):
+        self.buf = bytearray(capacity)
+        self.head = 0       # 最旧一行的起始位置
+        self.used = 0       # 已使用字节数（含长度前缀）
+        self.count = 0      # 行数
+        self.first_seq = 0  # 最旧一行的序号
+        self.touched = time.monotonic()  # 最近一次写入时间
+
+    @property
+    def capacity(self) -> int:
+        return len(self.buf)
+
+    @property
+    def free(self) -> int:
+        return len(self.buf) - self.used
+
+    def _read(self, pos: int, n: int) -> bytes:
+        cap = len(self.buf)
+        pos %= cap
+        end = pos + n
+        if end <= cap:
+            return bytes(self.buf[pos:end])
+        return bytes(self.buf[pos:]) + bytes(self.buf[:end - cap])
+
+    def _write(self, pos: int, data: bytes):
+        cap = len(self.buf)
+        pos %= cap
+        first = min(len(data), cap - pos)
+        self.buf[pos:pos + first] = data[:first]
+        if first < len(data):
+            self.buf[:len(data) - first] = data[first:]
+
+    @property
+    def next_seq(self) -> int:
+        return self.first_seq + self.count
+
+    def append(self, seq: int, data: bytes):
+        """追加一行，空间不足时丢弃最旧的行；序号不连续时清空重新开始"""
+        if seq != self.next_seq:
+            self.head = self.used = self.count = 0
+            self.first_seq = seq
+        data = data[:len(self.buf) - _HEADER]
+        need = _HEADER + len(data)
+        while self.free < need:
+            length = int.from_bytes(self._read(self.head, _HEADER), "little")
+            self.head = (self.head + _HEADER + length) % len(self.buf)
+            self.used -= _HEADER + length
+            self.count -= 1
+            self.first_seq += 1
+        tail = self.head + self.used
+        self._write(tail, len(data).to_bytes(_HEADER, "little"))
+        self._write(tail + _HEADER, data)
+        self.used += need
+        self.count += 1
+
+    def resize(self, capacity: int):
+        """扩容并把内容整理为从 0 开始的连续区域"""
+        data = self._read(self.head, self.used) if self.used else b""
+        self.buf = bytearray(capacity)
+        self.buf[:len(data)] = data
+        self.head = 0
+
+    def lines(self, skip: int = 0) -> List[str]:
+        """按顺序返回缓存的行，跳过最旧的 skip 行"""
+        data = self._read(self.head, self.used) if self.used else b""
+        result = []
+        pos = 0
+        while pos < len(data):
+            length = int.from_bytes(data[pos:pos + _HEADER], "little")
+            pos += _HEADER
+            if skip > 0:
+                skip -= 1
+            else:
+                result.append(data[pos:pos + length].decode("utf-8", "replace"))
+            pos += length
+        return result
+
+
+class LogBufferPool:
+    """所有客户端日志缓冲区，按最近活跃时间排序（LRU）"""
+
+    def __init__(self, budget: int = LOG_BUFFER_BUDGET, ring_max: int = LOG_RING_MAX_BYTES,
+                 ring_min: int = LOG_RING_MIN_BYTES):
+        self.budget = budget
+        self.ring_max = max(ring_max, ring_min)
+        self.ring_min = ring_min
+        self._rings: "OrderedDict[str, LogRing]" = OrderedDict()
+        self.allocated = 0  # 所有缓冲区的容量之和
+        self.evicted = 0    # 因预算被淘汰的客户端数
+
+    def _reserve(self, nbytes: int, keep: str, idle_before: float = None) -> bool:
+        """
+        淘汰最久未活跃的其他客户端，直到预算能容纳 nbytes
+        idle_before 不为空时只淘汰在该时间之前就已空闲的客户端
+        """
+        while self.allocated + nbytes > self.budget:
+            victim = next((cid for cid in self._rings if cid != keep), None)
+            if victim is None:
+                return False
+            if idle_before is not None and self._rings[victim].touched >= idle_before:
+                return False
+            self.allocated -= self._rings.pop(victim).capacity
+            self.evicted += 1
+        return True
+
+    def append(self, client_id: str, seq: int, line: str):
+        data = line.encode("utf-8", "replace")
+        now = time.monotonic()
+        ring = self._rings.get(client_id)
+        if ring is None:
+            self._reserve(self.ring_min, client_id)
+            ring = self._rings[client_id] = LogRing(self.ring_min)
+            self.allocated += ring.capacity
+        else:
+            self._rings.move_to_end(client_id)
+        ring.touched = now
+
+        # 写满前先按 1.5 倍扩容，预算不足时保持原大小、覆盖最旧的行
+        if ring.free < _HEADER + len(data) and ring.capacity < self.ring_max:
+            capacity = min(self.ring_max, ring.capacity * 3 // 2)
+            if self._reserve(capacity - ring.capacity, client_id, idle_before=now - LOG_RING_IDLE_SECONDS):
+                self.allocated += capacity - ring.capacity
+                ring.resize(capacity)
+        ring.append(seq, data)
+
+    def entries(self, client_id: str, after: int = None) -> Tuple[Optional[int], List[str]]:
+        """
+        返回 (第一行的序号, 行列表)，after 不为空时只返回序号大于 after 的行
+        第一行的序号为 None 表示没有缓存；after 早于缓存中最旧的行时从最旧的行开始
+        """
+        ring = self._rings.get(client_id)
+        if ring is None or not ring.count:
+            return None, []
+        self._rings.move_to_end(client_id)
+        skip = 0 if after is None else min(max(after + 1 - ring.first_seq, 0), ring.count)
+        return ring.first_seq + skip, ring.lines(skip)
+
+    def usage(self) -> Dict[str, dict]:
+        """每个客户端的缓冲区占用"""
+        return {
+            cid: {"bytes": ring.used, "capacity": ring.capacity, "lines": ring.count,
+                  "first_seq": ring.first_seq, "next_seq": ring.next_seq}
+            for cid, ring in self._rings.items()
+        }
+
+    def get_stats(self) -> dict:
+        return {
+            "clients": len(self._rings),
+            "used_bytes": sum(ring.used for ring in self._rings.values()),
+            "allocated_bytes": self.allocated,
+            "budget_bytes": self.budget,
+            "evicted_clients": self.evicted,
+        }
+
+
+# 全局日志缓冲实例
+log_buffers = LogBufferPool()
@@ -0,0 +1,81 @@
+"""
+日志订阅过滤
+订阅者通过 WebSocket 发送过滤条件（级别、子串、正则、代理名），
+服务端按条件分组，每组只过滤一次再推送给组内所有订阅者
+"""
+from typing import List, Optional, Tuple
+import re
+
+# frp 日志级别标记: 2024/01/01 00:00:00 [W] [proxy.go:117] [node-1.web] ...
+LEVELS = "TDIWE"
+LEVEL_NAMES = {"trace": "T", "debug": "D", "info": "I", "warn": "W", "warning": "W", "error": "E"}
+
+_LEVEL = re.compile(r"\[([TDIWE])\]")
+_BRACKET = re.compile(r"\[([^\[\]\s]+)\]")
+
+MAX_PATTERN_LENGTH = 200
+
+
+class LogFilter:
+    """一组过滤条件，所有条件都满足的行才会推送；key 相同的过滤器等价"""
+
+    __slots__ = ("key", "min_level", "contains", "regex", "proxy")
+
+    def __init__(self, level: str = None, contains: str = None, regex: str = None, proxy: str = None):
+        self.min_level = LEVELS.index(level) if level else None
+        self.contains = contains.lower() if contains else None
+        self.regex = re.compile(regex) if regex else None
+        self.proxy = proxy or None
+        self.key = (level, self.contains, regex, self.proxy)
+
+    def match(self, line: str) -> bool:
+        if self.min_level is not None:
+            m = _LEVEL.search(line)
+            # 没有级别标记的行（如 Agent 自身输出）按 INFO 处理
+            level = LEVELS.index(m.group(1)) if m else LEVELS.index("I")
+            if level < self.min_level:
+                return False
+        if self.contains is not None and self.contains not in line.lower():
+            return False
+        if self.proxy is not None:
+            suffix = "." + self.proxy
+            if not any(tag == self.proxy or tag.endswith(suffix) for tag in _BRACKET.findall(line)):
+                return False
+        if self.regex is not None and not self.regex.search(line):
+            return False
+        return True
+
+    def apply(self, entries: List[Tuple[int, str]]) -> List[Tuple[int, str]]:
+        """过滤 [(序号, 行)]"""
+        return [entry for entry in entries if self.match(entry[1])]
+
+
+def parse_filter(spec: dict) -> Optional[LogFilter]:
+    """
+    解析过滤条件 {"level": "warn", "contains": "...", "regex": "...", "proxy": "ssh"}
+    所有字段都为空时返回 None（不过滤），条件无效时抛出 ValueError
+    """
+    level = spec.get("level") or None
+    if level is not None:
+        level = LEVEL_NAMES.get(str(level).lower(), str(level).upper())
+        if level not in LEVELS:
+            raise ValueError(f"未知日志级别: {spec.get('level')}")
+
+    values = {}
+    for field in ("contains", "regex", "proxy"):
+        value = spec.get(field) or None
+        if value is not None:
+            value = str(value)
+            if len(value) > MAX_PATTERN_LENGTH:
+                raise ValueError(f"{field} 过长（最多 {MAX_PATTERN_LENGTH} 个字符）")
+        values[field] = value
+
+    if values["regex"]:
+        try:
+            re.compile(values["regex"])
+        except re.error as e:
+            raise ValueError(f"正则表达式无效: {e}")
+
+    if level is None and not any(values.values()):
+        return None
+    return LogFilter(level=level, **values)
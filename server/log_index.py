@@ -0,0 +1,551 @@
+"""
+Agent 日志倒排索引
+日志写入磁盘存储的同时被切分为词项，按 (客户端, 偏移量分块) 建立倒排表，
+支持精确词、前缀（term*）以及先用字面量预过滤再逐行校验的正则搜索，
+范围可以是单个客户端或全部客户端，结果按时间倒序分页。
+分块随磁盘日志的保留策略一起淘汰，索引大小与保留的日志量成正比
+"""
+from array import array
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+import bisect
+import heapq
+import logging
+import re
+import threading
+
+from log_store import LogStore, log_store
+
+logger = logging.getLogger(__name__)
+
+CHUNK_LINES = 65536  # 每个分块覆盖的连续偏移量数，相对偏移量可用 uint16 保存
+
+_TOKEN = re.compile(r"[a-z0-9_]+")
+MIN_TOKEN_LEN = 2
+MAX_TOKEN_LEN = 32
+MAX_NUMBER_LEN = 6  # 更长的纯数字（时间戳、计数器）不入索引
+
+_REGEX_META = set(".^$*+?{}[]()|\\")
+
+
+def tokenize(text: str) -> set:
+    """切分为去重后的小写词项"""
+    return {
+        t for t in _TOKEN.findall(text.lower())
+        if MIN_TOKEN_LEN <= len(t) <= MAX_TOKEN_LEN and not (t.isdigit() and len(t) > MAX_NUMBER_LEN)
+    }
+
+
+def _literal_terms(run: str) -> List[Tuple[str, bool]]:
+    """
+    正则中一段连续字面量对应的索引条件 [(词, 是否前缀)]
+    首个词可能只是某个词的后缀，不能使用；末尾的词可能只是前缀
+    """
+    tokens = _TOKEN.findall(run.lower())
+    if not tokens:
+        return []
+    if run[0].isalnum() or run[0] == "_":
+        tokens = tokens[1:]
+    result = []
+    for i, t in enumerate(tokens):
+        is_last = i == len(tokens) - 1
+        prefix = is_last and (run[-1].isalnum() or run[-1] == "_")
+        if len(t) >= MIN_TOKEN_LEN and (prefix or tokenize(t)):
+            result.append((t, prefix))
+    return result
+
+
+def regex_prefilter(pattern: str) -> List[Tuple[str, bool]]:
+    """
+    从正则中提取必须出现的字面量作为预过滤条件
+    只处理顶层连接：分组和字符类整体跳过，量词使前一个字符变为可选，出现 | 时放弃预过滤
+    """
+    if "|" in pattern:
+        return []
+    runs, current = [], []
+    depth, i = 0, 0
+    while i < len(pattern):
+        ch = pattern[i]
+        if ch == "\\":
+            nxt = pattern[i + 1:i + 2]
+            if depth == 0 and nxt and not nxt.isalnum():
+                current.append(nxt)  # 转义的标点是字面量
+            else:
+                runs.append("".join(current))
+                current = []
+            i += 2
+            continue
+        if ch == "[":
+            runs.append("".join(current))
+            current = []
+            i = pattern.find("]", i + 2)
+            if i < 0:
+                break
+        elif ch == "(":
+            depth += 1
+        elif ch == ")":
+            depth -= 1
+            runs.append("".join(current))
+            current = []
+        elif depth > 0:
+            pass
+        elif ch in "*?{":
+            if current:
+                current.pop()
+            runs.append("".join(current))
+            current = []
+        elif ch in _REGEX_META:
+            runs.append("".join(current))
+            current = []
+        else:
+            current.append(ch)
+        i += 1
+    runs.append("".join(current))
+
+    terms = []
+    for run in runs:
+        if run:
+            terms.extend(_literal_terms(run))
+    return terms
+
+
+def parse_query(q: str) -> List[Tuple[str, bool]]:
+    """空格分隔的词全部需要命中，以 * 结尾的词按前缀匹配"""
+    terms = []
+    for word in q.split():
+        prefix = word.endswith("*")
+        word = word.rstrip("*")
+        for t in sorted(tokenize(word)):
+            terms.append((t, prefix))
+    return terms
+
+
+class _Postings:
+    """一个或多个倒排表（前缀展开后）的并集，从大到小遍历并支持跳转"""
+
+    __slots__ = ("arrays", "pos", "head")
+
+    def __init__(self, arrays: List[array], below: int):
+        # 前缀展开出大量稀疏的表时，先合并成一张，避免每次跳转都遍历所有表
+        if len(arrays) > 1 and sum(len(a) for a in arrays) <= 1024 * len(arrays):
+            merged = set()
+            for a in arrays:
+                merged.update(a)
+            arrays = [array("H", sorted(merged))]
+        self.arrays = arrays
+        self.pos = [bisect.bisect_left(a, below) - 1 for a in arrays]
+        self._update()
+
+    def _update(self):
+        if len(self.arrays) == 1:
+            p = self.pos[0]
+            self.head = self.arrays[0][p] if p >= 0 else -1
+        else:
+            self.head = max((a[p] for a, p in zip(self.arrays, self.pos) if p >= 0), default=-1)
+
+    def seek(self, x: int):
+        """移动到不大于 x 的最大值"""
+        if self.head <= x:
+            return
+        for i, a in enumerate(self.arrays):
+            p = self.pos[i]
+            if p >= 0 and a[p] > x:
+                self.pos[i] = bisect.bisect_right(a, x, 0, p) - 1
+        self._update()
+
+
+def _intersect(streams: List[_Postings]) -> Iterator[int]:
+    """多路倒排表的降序交集（leapfrog），每次用二分跳到当前最小的表头"""
+    x = min(s.head for s in streams)
+    while x >= 0:
+        for s in streams:
+            s.seek(x)
+        y = min(s.head for s in streams)
+        if y == x:
+            yield x
+            x -= 1
+        else:
+            x = y
+
+
+class _Chunk:
+    """一个客户端 CHUNK_LINES 个连续偏移量的倒排表"""
+
+    __slots__ = ("base", "ts", "postings")
+
+    def __init__(self, base: int):
+        self.base = base
+        self.ts = array("d")                     # 相对偏移量 -> 时间戳
+        self.postings: Dict[int, array] = {}     # 词项 id -> 相对偏移量（升序，uint16）
+
+    @property
+    def end(self) -> int:
+        return self.base + len(self.ts)
+
+
+class LogIndex:
+    """建立在 LogStore 之上的倒排索引，行内容始终从 LogStore 读取"""
+
+    def __init__(self, store: LogStore):
+        self.store = store
+        self._lock = threading.Lock()
+        self._chunks: Dict[str, List[_Chunk]] = {}
+        # 词表：词项 -> id，以及引用该词项的分块数（为 0 时回收）
+        self._term_ids: Dict[str, int] = {}
+        self._terms: List[Optional[str]] = []
+        self._refs: List[int] = []
+        self._free_ids: List[int] = []
+        # 前缀查询使用的有序词表，新增词项先放入 _new_terms，查询时合并
+        self._sorted_terms: List[str] = []
+        self._new_terms: List[str] = []
+        self._removed_terms = 0
+        # 重建期间收到的新日志先暂存，重建完成后再写入，保证分块内偏移量有序
+        self._building: Dict[str, list] = {}
+        self.lines = 0
+
+    # ========================
+    # 写入
+    # ========================
+
+    def _term_id(self, term: str) -> int:
+        term_id = self._term_ids.get(term)
+        if term_id is None:
+            if self._free_ids:
+                term_id = self._free_ids.pop()
+                self._terms[term_id] = term
+                self._refs[term_id] = 0
+            else:
+                term_id = len(self._terms)
+                self._terms.append(term)
+                self._refs.append(0)
+            self._term_ids[term] = term_id
+            self._new_terms.append(term)
+        return term_id
+
+    def _add(self, client_id: str, offset: int, ts: float, line: str):
+        chunks = self._chunks.get(client_id)
+        if chunks is None:
+            chunks = self._chunks[client_id] = []
+        base = offset - offset % CHUNK_LINES
+        if not chunks or chunks[-1].base != base:
+            if chunks and chunks[-1].base > base:
+                return  # 偏移量倒退（不应发生），丢弃
+            chunks.append(_Chunk(base))
+            self._prune(client_id)
+        chunk = chunks[-1]
+        if offset < chunk.end:
+            return  # 重复写入
+        # 缺失的偏移量用 0 占位，保持 ts 按位置对齐
+        while chunk.end < offset:
+            chunk.ts.append(0.0)
+
+        rel = offset - chunk.base
+        chunk.ts.append(ts)
+        for term in tokenize(line):
+            term_id = self._term_id(term)
+            postings = chunk.postings.get(term_id)
+            if postings is None:
+                postings = chunk.postings[term_id] = array("H")
+                self._refs[term_id] += 1
+            postings.append(rel)
+        self.lines += 1
+
+    def add(self, client_id: str, offset: int, ts: float, line: str):
+        """索引一行日志（offset 为磁盘日志存储返回的偏移量）"""
+        with self._lock:
+            pending = self._building.get(client_id)
+            if pending is not None:
+                pending.append((offset, ts, line))
+            else:
+                self._add(client_id, offset, ts, line)
+
+    def _prune(self, client_id: str):
+        """淘汰已被日志存储清理的分块，调用方需持有锁"""
+        chunks = self._chunks.get(client_id)
+        if not chunks or len(chunks) < 2:
+            return
+        first_offset = self.store.first_offset(client_id)
+        while len(chunks) > 1 and chunks[0].end <= first_offset:
+            self._drop_chunk(chunks.pop(0))
+
+    def _drop_chunk(self, chunk: _Chunk):
+        self.lines -= len(chunk.ts)
+        for term_id in chunk.postings:
+            self._refs[term_id] -= 1
+            if self._refs[term_id] == 0:
+                del self._term_ids[self._terms[term_id]]
+                self._terms[term_id] = None
+                self._free_ids.append(term_id)
+                self._removed_terms += 1
+
+    # ========================
+    # 启动时重建
+    # ========================
+
+    def begin_rebuild(self, client_ids: Iterable[str]):
+        """在开始接收日志前调用，标记需要从磁盘重建的客户端"""
+        with self._lock:
+            for client_id in client_ids:
+                self._building[client_id] = []
+
+    def rebuild(self, batch: int = 5000):
+        """从磁盘日志存储重建索引（在线程池中执行）"""
+        for client_id in list(self._building):
+            try:
+                offset = self.store.first_offset(client_id)
+                while True:
+                    logs = self.store.read(client_id, offset=offset, limit=batch)["logs"]
+                    if not logs:
+                        break
+                    with self._lock:
+                        for entry in logs:
+                            self._add(client_id, entry["offset"], entry["ts"], entry["line"])
+                    offset = logs[-1]["offset"] + 1
+            except Exception as e:
+                logger.warning(f"日志索引重建失败 {client_id}: {e}")
+            finally:
+                with self._lock:
+                    for entry in self._building.pop(client_id, ()):
+                        self._add(client_id, *entry)
+        logger.info(f"日志索引重建完成，共 {self.lines} 行")
+
+    @property
+    def ready(self) -> bool:
+        return not self._building
+
+    # ========================
+    # 查询
+    # ========================
+
+    def _resolve(self, term: str, prefix: bool) -> List[int]:
+        """词项（或前缀）对应的 id 列表，调用方需持有锁"""
+        if not prefix:
+            term_id = self._term_ids.get(term)
+            return [] if term_id is None else [term_id]
+
+        if self._new_terms or self._removed_terms:
+            if self._removed_terms:
+                self._sorted_terms = sorted(self._term_ids)
+            else:
+                # 已有序的大列表 + 少量新词，Timsort 合并是线性的
+                self._new_terms.sort()
+                self._sorted_terms.extend(self._new_terms)
+                self._sorted_terms.sort()
+            self._new_terms = []
+            self._removed_terms = 0
+
+        lo = bisect.bisect_left(self._sorted_terms, term)
+        hi = bisect.bisect_left(self._sorted_terms, term + "\uffff")
+        return [self._term_ids[t] for t in self._sorted_terms[lo:hi]]
+
+    @staticmethod
+    def _matches(chunk: _Chunk, conditions: List[List[int]], below: int) -> Iterator[int]:
+        """按降序产生分块内小于 below、且同时满足所有条件的相对偏移量，调用方需持有锁"""
+        if not conditions:
+            return iter(range(below - 1, -1, -1))
+        streams = []
+        for term_ids in conditions:
+            postings = [chunk.postings[t] for t in term_ids if t in chunk.postings]
+            if not postings:
+                return iter(())
+            streams.append(_Postings(postings, below))
+        return _intersect(streams)
+
+    def search(
+        self,
+        terms: List[Tuple[str, bool]],
+        regex: Optional[re.Pattern] = None,
+        client_id: str = None,
+        limit: int = 50,
+        cursor: Tuple[float, str, int] = None,
+    ) -> dict:
+        """
+        搜索日志，结果按 (时间, 客户端, 偏移量) 倒序
+
+        Args:
+            terms: [(词, 是否前缀)]，全部需要命中
+            regex: 在索引候选行上逐行校验的正则
+            client_id: 为空时搜索全部客户端
+            cursor: 上一页最后一条结果的 (ts, client_id, offset)
+        """
+        with self._lock:
+            if client_id is None:
+                scope = list(self._chunks.keys())
+            else:
+                scope = [client_id] if client_id in self._chunks else []
+            for cid in scope:
+                self._prune(cid)
+
+            conditions = [self._resolve(t, prefix) for t, prefix in terms]
+            if any(not ids for ids in conditions):
+                return {"results": [], "next_cursor": None, "scanned_chunks": 0}
+
+            # 分块按最新时间倒序处理
+            queue = [(-c.ts[-1], cid, i, c) for cid in scope
+                     for i, c in enumerate(self._chunks[cid]) if len(c.ts)]
+        heapq.heapify(queue)
+
+        heap: List[tuple] = []  # 最小堆，保存当前最新的 limit 条 (ts, client_id, offset, line)
+        scanned = 0
+        while queue:
+            neg_max_ts, cid, _, chunk = heapq.heappop(queue)
+            # 剩余分块都不可能比已有的第 limit 条更新时结束
+            if len(heap) >= limit and -neg_max_ts < heap[0][0]:
+                break
+            if cursor is not None and chunk.ts[0] > cursor[0]:
+                continue
+            scanned += 1
+
+            with self._lock:
+                below = len(chunk.ts)
+                if cursor is not None:
+                    below = bisect.bisect_right(chunk.ts, cursor[0], 0, below)
+                matches = self._matches(chunk, conditions, below)
+
+            # 同一分块内偏移量递减、时间基本也递减，比堆中第 limit 条更旧时即可停止；
+            # 正则需要读取候选行逐行校验，按批处理以便尽早凑满一页
+            batch_size = limit if regex is None else 1024
+            while True:
+                candidates = []
+                for rel in matches:
+                    key = (chunk.ts[rel], cid, chunk.base + rel)
+                    if cursor is not None and key >= cursor:
+                        continue
+                    if len(heap) >= limit and key <= heap[0][:3]:
+                        break
+                    candidates.append(key)
+                    if len(candidates) >= batch_size:
+                        break
+                if not candidates:
+                    break
+                if regex is None:
+                    for key in candidates:
+                        self._push(heap, key + (None,), limit)
+                    break
+                offsets = sorted(k[2] for k in candidates)
+                for entry in self.store.read_offsets(cid, offsets):
+                    if regex.search(entry["line"]):
+                        key = (chunk.ts[entry["offset"] - chunk.base], cid, entry["offset"])
+                        self._push(heap, key + (entry["line"],), limit)
+                if len(candidates) < batch_size:
+                    break
+
+        page = sorted(heap, reverse=True)
+        # 补齐结果行内容
+        by_client: Dict[str, List[int]] = {}
+        for ts, cid, offset, line in page:
+            if line is None:
+                by_client.setdefault(cid, []).append(offset)
+        lines = {}
+        for cid, offsets in by_client.items():
+            for entry in self.store.read_offsets(cid, sorted(offsets)):
+                lines[(cid, entry["offset"])] = entry["line"]
+
+        results = []
+        for ts, cid, offset, line in page:
+            line = line if line is not None else lines.get((cid, offset))
+            if line is None:
+                continue  # 已被清理
+            results.append({"client_id": cid, "offset": offset, "ts": ts, "line": line})
+
+        next_cursor = None
+        if len(page) >= limit and page:
+            ts, cid, offset, _ = page[-1]
+            next_cursor = f"{ts!r}:{offset}:{cid}"
+        return {"results": results, "next_cursor": next_cursor, "scanned_chunks": scanned}
+
+    @staticmethod
+    def _push(heap: list, item: tuple, limit: int):
+        if len(heap) < limit:
+            heapq.heappush(heap, item)
+        elif item[:3] > heap[0][:3]:
+            heapq.heapreplace(heap, item)
+
+    @staticmethod
+    def parse_cursor(cursor: str) -> Tuple[float, str, int]:
+        ts, offset, client_id = cursor.split(":", 2)
+        return float(ts), client_id, int(offset)
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            return {
+                "lines": self.lines,
+                "terms": len(self._term_ids),
+                "chunks": sum(len(c) for c in self._chunks.values()),
+                "postings_bytes": sum(
+                    p.itemsize * len(p) for chunks in self._chunks.values()
+                    for c in chunks for p in c.postings.values()
+                ),
+                "ready": self.ready,
+            }
+
+
+# 全局日志索引实例
+log_index = LogIndex(log_store)
+
+
+if __name__ == "__main__":
+    # 查询延迟基准: python log_index.py [总行数]
+    import asyncio
+    import random
+    import sys
+    import tempfile
+    import time
+
+    total = int(sys.argv[1]) if len(sys.argv) > 1 else 3_000_000
+    clients = [f"client-{i:03d}" for i in range(100)]
+    templates = [
+        "[I] [proxy.go:204] [{c}.ssh] start proxy success",
+        "[I] [control.go:{n}] [{c}] login to server success, get run id [{h}]",
+        "[W] [proxy.go:117] [{c}.web] connect to local service [127.0.0.1:{p}] error: dial tcp: connection refused",
+        "[E] [service.go:{n}] [{c}] work connection closed before response StartWorkConn message: EOF",
+        "[I] [visitor.go:{n}] [{c}.stcp] start visitor success, remote port {p}",
+        "[D] [proxy.go:{n}] [{c}.rdp] join connections, bytes in {n}, bytes out {p}",
+    ]
+    rng = random.Random(1)
+
+    with tempfile.TemporaryDirectory() as root:
+        store = LogStore(root)
+        index = LogIndex(store)
+
+        async def fill():
+            # 与服务端一样在事件循环中写入，段文件 IO 由 LogStore 的写入线程完成
+            ts = time.time() - total * 0.001
+            for i in range(total):
+                c = clients[i % len(clients)]
+                line = rng.choice(templates).format(c=c, n=rng.randint(1, 999), p=rng.randint(1000, 65535),
+                                                    h=f"{rng.getrandbits(48):012x}")
+                offset = await store.append(c, line, ts)
+                index.add(c, offset, ts, line)
+                ts += 0.001
+
+        start = time.perf_counter()
+        asyncio.run(fill())
+        store.flush_all()
+        elapsed = time.perf_counter() - start
+        print(f"写入+索引 {total:,} 行: {elapsed:.1f}s ({total / elapsed:,.0f} 行/s)", index.get_stats())
+
+        queries = [
+            ("term 全舰队", parse_query("refused"), None, None),
+            ("多词 全舰队", parse_query("proxy success ssh"), None, None),
+            ("前缀 全舰队", parse_query("conn*"), None, None),
+            ("罕见组合 全舰队", parse_query("client-042 stcp 4242"), None, None),
+            ("多词 单客户端", parse_query("refused 127.0.0.1"), None, "client-007"),
+            ("term 单客户端", parse_query("eof"), None, "client-007"),
+            ("正则 全舰队", regex_prefilter(r"local service \[127\.0\.0\.1:80\d\d\]"),
+             re.compile(r"local service \[127\.0\.0\.1:80\d\d\]"), None),
+        ]
+        for name, terms, pattern, client_id in queries:
+            index.search(terms, regex=pattern, client_id=client_id)  # 预热
+            runs = 20
+            start = time.perf_counter()
+            for _ in range(runs):
+                result = index.search(terms, regex=pattern, client_id=client_id)
+            ms = (time.perf_counter() - start) / runs * 1000
+            cursor = result["next_cursor"]
+            start = time.perf_counter()
+            if cursor:
+                index.search(terms, regex=pattern, client_id=client_id, cursor=index.parse_cursor(cursor))
+            page2 = (time.perf_counter() - start) * 1000
+            print(f"{name:10s} {ms:8.2f} ms/页  第二页 {page2:7.2f} ms  结果 {len(result['results'])}"
+                  f"  扫描分块 {result['scanned_chunks']}")
+        store.close()
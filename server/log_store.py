@@ -0,0 +1,504 @@
+"""
+Agent 日志持久化存储
+每个客户端一个目录，日志追加写入段文件（segment），写满后滚动到新段；
+每个段配一个稀疏索引（每 INDEX_INTERVAL 字节记录一次 偏移量/时间/位置），
+查询时先在索引上二分定位，再通过 mmap 只扫描需要的区间，不会把整个文件读入内存。
+追加时只在内存中分配偏移量并排队，段文件的写入、滚动与清理都在专用的写入线程中进行，不阻塞事件循环。
+旧段按客户端总大小和保存时长清理（包括磁盘上未加载的客户端目录，如已删除的客户端）
+"""
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+import asyncio
+import bisect
+import hashlib
+import logging
+import mmap
+import os
+import re
+import struct
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+LOG_STORE_DIR = os.environ.get("LOG_STORE_DIR", "./agent_logs")
+SEGMENT_BYTES = int(os.environ.get("LOG_SEGMENT_BYTES", str(4 * 1024 * 1024)))
+RETENTION_BYTES = int(os.environ.get("LOG_RETENTION_BYTES", str(64 * 1024 * 1024)))  # 每个客户端
+RETENTION_DAYS = float(os.environ.get("LOG_RETENTION_DAYS", "7"))
+# 单个客户端排队未写入的日志超过这么多字节时立即安排写入，不等下一次定期落盘
+PENDING_WRITE_BYTES = int(os.environ.get("LOG_PENDING_WRITE_BYTES", str(256 * 1024)))
+
+INDEX_INTERVAL = 4096  # 稀疏索引间隔（字节）
+
+# 记录头: 偏移量(u64) 时间戳(f64) 内容长度(u32)，后接 UTF-8 内容
+_RECORD = struct.Struct("<QdI")
+# 索引项: 偏移量(u64) 时间戳(f64) 段内位置(u64)
+_INDEX = struct.Struct("<QdQ")
+
+# 可以直接作为目录名的 client_id，其余的取哈希并以 "_" 开头，避免与真实 id 冲突
+_SAFE_ID = re.compile(r"[A-Za-z0-9-][A-Za-z0-9_.-]{0,63}")
+
+
+class Segment:
+    """一个段文件及其稀疏索引，文件名为段内第一条记录的偏移量"""
+
+    __slots__ = ("base", "path", "index_path", "size", "index", "next_offset", "last_ts")
+
+    def __init__(self, directory: str, base: int):
+        self.base = base
+        self.path = os.path.join(directory, f"{base:020d}.log")
+        self.index_path = os.path.join(directory, f"{base:020d}.idx")
+        self.size = 0
+        self.index: List[tuple] = []  # [(offset, ts, pos)]
+        self.next_offset = base
+        self.last_ts = 0.0
+
+    def load(self):
+        """从磁盘恢复：读取索引，再从最后一个索引点扫描到文件末尾，截掉写了一半的记录"""
+        index = []
+        if os.path.exists(self.index_path):
+            with open(self.index_path, "rb") as f:
+                data = f.read()
+            usable = len(data) - len(data) % _INDEX.size
+            index = [_INDEX.unpack_from(data, i) for i in range(0, usable, _INDEX.size)]
+
+        size = os.path.getsize(self.path)
+        valid = [e for e in index if e[2] < size]
+        pos = valid[-1][2] if valid else 0
+        next_offset = valid[-1][0] if valid else self.base
+        last_ts = valid[-1][1] if valid else 0.0
+
+        with open(self.path, "rb") as f:
+            f.seek(pos)
+            tail = f.read()
+        i = 0
+        while i + _RECORD.size <= len(tail):
+            offset, ts, length = _RECORD.unpack_from(tail, i)
+            if i + _RECORD.size + length > len(tail):
+                break
+            next_offset, last_ts = offset + 1, ts
+            i += _RECORD.size + length
+
+        self.size = pos + i
+        self.index = valid
+        self.next_offset = next_offset
+        self.last_ts = last_ts
+
+        if self.size < size:
+            logger.warning(f"日志段尾部不完整，已截断: {self.path}")
+            with open(self.path, "r+b") as f:
+                f.truncate(self.size)
+        if len(valid) != len(index):
+            with open(self.index_path, "wb") as f:
+                f.write(b"".join(_INDEX.pack(*e) for e in valid))
+
+    def remove(self):
+        for path in (self.path, self.index_path):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+class ClientLog:
+    """单个客户端的段式日志，只有最后一个段可写"""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.lock = threading.Lock()  # 段文件读写
+        self._dirty = False
+        # 已分配偏移量、尚未写入段文件的日志 [(偏移量, 时间戳, 内容)]，只在 _pending_lock 下短暂访问
+        self._pending: List[Tuple[int, float, bytes]] = []
+        self._pending_lock = threading.Lock()
+        self.pending_bytes = 0
+        self.write_scheduled = False
+
+        self.segments: List[Segment] = []
+        for name in sorted(os.listdir(directory)):
+            if name.endswith(".log") and name[:-4].isdigit():
+                segment = Segment(directory, int(name[:-4]))
+                segment.load()
+                self.segments.append(segment)
+        if not self.segments:
+            self.segments.append(Segment(directory, 0))
+        self._next_offset = self.segments[-1].next_offset
+        self._open_active()
+
+    def _open_active(self):
+        active = self.segments[-1]
+        self._file = open(active.path, "ab")
+        self._index_file = open(active.index_path, "ab")
+        self._last_index_pos = active.index[-1][2] if active.index else None
+
+    def _close_active(self):
+        self._file.close()
+        self._index_file.close()
+
+    @property
+    def first_offset(self) -> int:
+        return self.segments[0].base
+
+    @property
+    def next_offset(self) -> int:
+        return self.segments[-1].next_offset
+
+    @property
+    def total_bytes(self) -> int:
+        return sum(s.size for s in self.segments)
+
+    # ========================
+    # 写入
+    # ========================
+
+    def append(self, line: str, ts: float) -> int:
+        """分配偏移量并把日志排队（不做任何磁盘 IO），返回其偏移量"""
+        data = line.encode("utf-8", "replace")
+        with self._pending_lock:
+            offset = self._next_offset
+            self._next_offset += 1
+            self._pending.append((offset, ts, data))
+            self.pending_bytes += _RECORD.size + len(data)
+            return offset
+
+    def _write_pending(self):
+        """把排队的日志按偏移量顺序写入段文件（需持有 self.lock）"""
+        with self._pending_lock:
+            pending, self._pending = self._pending, []
+            self.pending_bytes = 0
+        for offset, ts, data in pending:
+            self._write(offset, ts, data)
+
+    def _write(self, offset: int, ts: float, data: bytes):
+        if self.segments[-1].size >= SEGMENT_BYTES:
+            self._roll()
+        segment = self.segments[-1]
+        pos = segment.size
+
+        self._file.write(_RECORD.pack(offset, ts, len(data)))
+        self._file.write(data)
+        if self._last_index_pos is None or pos - self._last_index_pos >= INDEX_INTERVAL:
+            entry = (offset, ts, pos)
+            segment.index.append(entry)
+            self._index_file.write(_INDEX.pack(*entry))
+            self._last_index_pos = pos
+
+        segment.size += _RECORD.size + len(data)
+        segment.next_offset = offset + 1
+        segment.last_ts = ts
+        self._dirty = True
+
+    def _roll(self):
+        self._flush()
+        self._close_active()
+        self.segments.append(Segment(self.directory, self.next_offset))
+        self._open_active()
+        self._enforce_size()
+
+    def _flush(self):
+        if self._dirty:
+            self._file.flush()
+            self._index_file.flush()
+            self._dirty = False
+
+    def flush(self):
+        with self.lock:
+            self._write_pending()
+            self._flush()
+
+    def close(self):
+        with self.lock:
+            self._write_pending()
+            self._flush()
+            self._close_active()
+
+    # ========================
+    # 清理
+    # ========================
+
+    def _enforce_size(self):
+        total = self.total_bytes
+        while len(self.segments) > 1 and total > RETENTION_BYTES:
+            segment = self.segments.pop(0)
+            total -= segment.size
+            segment.remove()
+
+    def enforce_retention(self, now: float):
+        """删除超出总大小或保存时长的旧段（当前写入段不会被删除）"""
+        cutoff = now - RETENTION_DAYS * 86400
+        with self.lock:
+            self._enforce_size()
+            while len(self.segments) > 1 and self.segments[0].last_ts < cutoff:
+                self.segments.pop(0).remove()
+
+    # ========================
+    # 读取
+    # ========================
+
+    def read(self, since: float = None, offset: int = None, limit: int = 500) -> List[dict]:
+        """
+        读取日志
+
+        Args:
+            since: 返回时间戳 >= since 的记录
+            offset: 返回偏移量 >= offset 的记录
+            两者都为空时返回最近 limit 条
+        """
+        with self.lock:
+            self._write_pending()
+            self._flush()
+            # 段列表只在末尾追加、在头部删除，持有快照后即可在锁外读取
+            snapshot = [(s, s.size, len(s.index)) for s in self.segments]
+            first_offset, next_offset = self.first_offset, self.next_offset
+
+        if since is None and offset is None:
+            offset = max(first_offset, next_offset - limit)
+        min_offset = offset or 0
+        min_ts = since if since is not None else float("-inf")
+
+        # 定位起始段：最后一个 base <= offset 的段 / 第一个 last_ts >= since 的段
+        start = 0
+        if offset is not None:
+            start = max(0, bisect.bisect_right([s.base for s, _, _ in snapshot], offset) - 1)
+        if since is not None:
+            while start < len(snapshot) - 1 and snapshot[start][0].last_ts < since:
+                start += 1
+
+        entries: List[dict] = []
+        for segment, size, n_index in snapshot[start:]:
+            if len(entries) >= limit:
+                break
+            if size == 0:
+                continue
+            # 在稀疏索引上找到不晚于目标位置的最后一个索引点
+            index = segment.index[:n_index]
+            pos = 0
+            if index:
+                if offset is not None:
+                    i = bisect.bisect_right([e[0] for e in index], min_offset) - 1
+                else:
+                    i = bisect.bisect_left([e[1] for e in index], min_ts) - 1
+                pos = index[max(i, 0)][2]
+            try:
+                self._scan(segment.path, size, pos, min_offset, min_ts, limit, entries)
+            except FileNotFoundError:
+                continue  # 读取期间被清理
+        return entries
+
+    def read_offsets(self, offsets: List[int]) -> List[dict]:
+        """按偏移量批量读取（offsets 需升序），已被清理的偏移量会被跳过"""
+        with self.lock:
+            self._write_pending()
+            self._flush()
+            snapshot = [(s, s.size, len(s.index)) for s in self.segments]
+        bases = [s.base for s, _, _ in snapshot]
+
+        entries: List[dict] = []
+        i = 0
+        while i < len(offsets):
+            k = bisect.bisect_right(bases, offsets[i]) - 1
+            if k < 0:
+                i += 1
+                continue
+            # 同一段内的偏移量一起读取，只打开一次 mmap
+            end = bases[k + 1] if k + 1 < len(bases) else float("inf")
+            j = bisect.bisect_left(offsets, end, i)
+            segment, size, n_index = snapshot[k]
+            group, i = offsets[i:j], j
+            if size == 0:
+                continue
+            index = segment.index[:n_index]
+            index_offsets = [e[0] for e in index]
+            try:
+                with open(segment.path, "rb") as f:
+                    with mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ) as mm:
+                        pos, current = 0, segment.base
+                        for target in group:
+                            # 索引点比当前位置更近时跳过去，否则从当前位置继续向后扫描
+                            p = bisect.bisect_right(index_offsets, target) - 1
+                            if p >= 0 and index[p][0] > current:
+                                current, pos = index[p][0], index[p][2]
+                            while pos + _RECORD.size <= size:
+                                offset, ts, length = _RECORD.unpack_from(mm, pos)
+                                body = pos + _RECORD.size
+                                if body + length > size or offset > target:
+                                    break
+                                if offset == target:
+                                    entries.append({
+                                        "offset": offset,
+                                        "ts": ts,
+                                        "line": mm[body:body + length].decode("utf-8", "replace"),
+                                    })
+                                    break
+                                pos, current = body + length, offset + 1
+            except FileNotFoundError:
+                continue
+        return entries
+
+    @staticmethod
+    def _scan(path: str, size: int, pos: int, min_offset: int, min_ts: float, limit: int, out: List[dict]):
+        with open(path, "rb") as f:
+            with mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ) as mm:
+                while pos + _RECORD.size <= size and len(out) < limit:
+                    offset, ts, length = _RECORD.unpack_from(mm, pos)
+                    body = pos + _RECORD.size
+                    if body + length > size:
+                        break
+                    if offset >= min_offset and ts >= min_ts:
+                        out.append({
+                            "offset": offset,
+                            "ts": ts,
+                            "line": mm[body:body + length].decode("utf-8", "replace"),
+                        })
+                    pos = body + length
+
+
+class LogStore:
+    """所有客户端日志的入口，ClientLog 在首次访问时加载"""
+
+    def __init__(self, root: str = LOG_STORE_DIR):
+        self.root = root
+        self._logs: Dict[str, ClientLog] = {}
+        self._lock = threading.Lock()
+        # 写入线程：段文件写入、落盘与清理
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="log-store")
+
+    def _directory(self, client_id: str) -> str:
+        name = client_id if _SAFE_ID.fullmatch(client_id) else "_" + hashlib.sha1(client_id.encode()).hexdigest()
+        return os.path.join(self.root, name)
+
+    def _get(self, client_id: str, create: bool = True) -> Optional[ClientLog]:
+        log = self._logs.get(client_id)
+        if log is None:
+            with self._lock:
+                log = self._logs.get(client_id)
+                if log is None:
+                    directory = self._directory(client_id)
+                    if not create and not os.path.isdir(directory):
+                        return None
+                    log = self._logs[client_id] = ClientLog(directory)
+        return log
+
+    async def append(self, client_id: str, line: str, ts: float = None) -> int:
+        """追加一行日志并返回其偏移量；写入由写入线程批量完成"""
+        log = self._logs.get(client_id)
+        if log is None:
+            # 首次写入要从磁盘恢复段信息，放到写入线程中执行
+            log = await asyncio.get_running_loop().run_in_executor(self._executor, self._get, client_id)
+        offset = log.append(line, time.time() if ts is None else ts)
+        if log.pending_bytes >= PENDING_WRITE_BYTES and not log.write_scheduled:
+            log.write_scheduled = True
+            self._executor.submit(self._write, log)
+        return offset
+
+    @staticmethod
+    def _write(log: ClientLog):
+        log.write_scheduled = False
+        try:
+            log.flush()
+        except Exception as e:
+            logger.warning(f"写入日志段失败 ({log.directory}): {e}")
+
+    def read(self, client_id: str, since: float = None, offset: int = None, limit: int = 500) -> dict:
+        log = self._get(client_id, create=False)
+        if log is None:
+            return {"logs": [], "first_offset": 0, "next_offset": 0}
+        logs = log.read(since=since, offset=offset, limit=limit)
+        return {"logs": logs, "first_offset": log.first_offset, "next_offset": log.next_offset}
+
+    def read_offsets(self, client_id: str, offsets: List[int]) -> List[dict]:
+        log = self._get(client_id, create=False)
+        return log.read_offsets(offsets) if log is not None else []
+
+    def first_offset(self, client_id: str) -> int:
+        """最早仍保留的日志偏移量"""
+        log = self._get(client_id, create=False)
+        return log.first_offset if log is not None else 0
+
+    def client_ids(self) -> List[str]:
+        """磁盘上已有日志的客户端（哈希命名的目录无法还原 id，不包含在内）"""
+        if not os.path.isdir(self.root):
+            return []
+        return sorted(
+            name for name in os.listdir(self.root)
+            if _SAFE_ID.fullmatch(name) and os.path.isdir(os.path.join(self.root, name))
+        )
+
+    def flush_all(self):
+        for log in list(self._logs.values()):
+            log.flush()
+
+    def enforce_retention(self, now: float = None):
+        """清理所有客户端目录：已加载的按段的最后时间，未加载的（如已删除的客户端）按段文件修改时间"""
+        now = time.time() if now is None else now
+        loaded = set()
+        for log in list(self._logs.values()):
+            log.enforce_retention(now)
+            loaded.add(os.path.abspath(log.directory))
+        if not os.path.isdir(self.root):
+            return
+        cutoff = now - RETENTION_DAYS * 86400
+        for name in os.listdir(self.root):
+            directory = os.path.join(self.root, name)
+            if os.path.abspath(directory) in loaded or not os.path.isdir(directory):
+                continue
+            try:
+                self._expire_directory(directory, cutoff)
+            except OSError as e:
+                logger.warning(f"清理日志目录失败 ({directory}): {e}")
+
+    @staticmethod
+    def _expire_directory(directory: str, cutoff: float):
+        """
+        清理未加载的客户端目录中超出总大小或保存时长的段；
+        全部过期时换成一个空段，客户端再次上线时偏移量仍然接着之前的继续
+        """
+        bases = sorted(int(n[:-4]) for n in os.listdir(directory) if n.endswith(".log") and n[:-4].isdigit())
+        segments = [Segment(directory, base) for base in bases]
+        if not segments:
+            return
+        sizes = [os.path.getsize(s.path) for s in segments]
+        total = sum(sizes)
+        while len(segments) > 1 and (total > RETENTION_BYTES or os.path.getmtime(segments[0].path) < cutoff):
+            total -= sizes.pop(0)
+            segments.pop(0).remove()
+
+        last = segments[0] if len(segments) == 1 else None
+        if last is not None and sizes[0] > 0 and os.path.getmtime(last.path) < cutoff:
+            last.load()
+            empty = Segment(directory, last.next_offset)
+            if empty.base != last.base:
+                last.remove()
+                open(empty.path, "ab").close()
+
+    def close(self):
+        for log in list(self._logs.values()):
+            log.close()
+
+    async def run(self, flush_interval: float = 1.0, retention_interval: float = 600):
+        """后台任务：定期在写入线程中把排队的日志写入落盘，并清理过期段"""
+        loop = asyncio.get_running_loop()
+        last_retention = 0.0
+        while True:
+            await asyncio.sleep(flush_interval)
+            try:
+                await loop.run_in_executor(self._executor, self.flush_all)
+                now = time.time()
+                if now - last_retention >= retention_interval:
+                    last_retention = now
+                    await loop.run_in_executor(self._executor, self.enforce_retention, now)
+            except Exception as e:
+                logger.warning(f"日志存储维护失败: {e}")
+
+    def get_stats(self) -> dict:
+        logs = list(self._logs.values())
+        return {
+            "clients": len(logs),
+            "segments": sum(len(log.segments) for log in logs),
+            "pending_bytes": sum(log.pending_bytes for log in logs),
+            "bytes": sum(log.total_bytes for log in logs),
+        }
+
+
+# 全局日志存储实例
+log_store = LogStore()
@@ -0,0 +1,41 @@
+"""
+事件循环延迟监控
+周期性 sleep 并测量实际唤醒时间与预期的差值，用于发现阻塞事件循环的同步调用
+"""
+from collections import deque
+import asyncio
+import time
+
+
+class LoopLagMonitor:
+    """记录最近一段时间的事件循环延迟"""
+
+    def __init__(self, interval: float = 0.1, window: int = 600):
+        self.interval = interval
+        self._samples = deque(maxlen=window)  # 最近 window 次采样（秒）
+        self.max_lag = 0.0                    # 启动以来的最大延迟
+
+    async def run(self):
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, time.perf_counter() - start - self.interval)
+            self._samples.append(lag)
+            if lag > self.max_lag:
+                self.max_lag = lag
+
+    def get_stats(self) -> dict:
+        samples = sorted(self._samples)
+        if not samples:
+            return {"samples": 0}
+        return {
+            "samples": len(samples),
+            "avg_ms": round(sum(samples) / len(samples) * 1000, 2),
+            "p99_ms": round(samples[min(len(samples) - 1, int(len(samples) * 0.99))] * 1000, 2),
+            "window_max_ms": round(samples[-1] * 1000, 2),
+            "max_ms": round(self.max_lag * 1000, 2),
+        }
+
+
+# 全局监控实例
+loop_monitor = LoopLagMonitor()
@@ -1,16 +1,37 @@
 from fastapi import FastAPI, Depends, HTTPException, status, Header, WebSocket, WebSocketDisconnect
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from fastapi.responses import PlainTextResponse
-from sqlalchemy.orm import Session
+from sqlalchemy.orm import Session, selectinload
 import models, schemas, crud, auth
-from database import SessionLocal, engine
+from database import SessionLocal, engine, run_db, write_db, write_db_from_thread, on_undo, db_writer
 from fastapi.middleware.cors import CORSMiddleware
-from datetime import timedelta
+from datetime import datetime, timedelta
 from typing import List
 import re
 import time
 import asyncio
 from websocket_manager import manager as ws_manager
+from agent_info_cache import agent_info_cache
+from config_cache import config_cache
+from config_delivery import config_delivery
+from push_scheduler import push_scheduler
+from config_rollout import config_rollouts
+from port_allocator import port_allocator, claim_of, PortConflict
+from tunnel_index import tunnel_index, TunnelConflict, proxy_name, tunnel_key, domains_of
+from port_ranges import PortRangeSet, disabled_ports
+from frps_jobs import frps_jobs, RESTART, RESTART_NOW, RESTART_MODES, FRPS_CONTAINER
+from docker_api import docker_client, DockerError
+import agent_protocol
+from agent_protocol import router as agent_router
+from rate_limiter import rate_limiter, UNKNOWN_TYPE
+from loop_monitor import loop_monitor
+from fleet_stats import fleet_stats, METRICS as FLEET_METRICS, WINDOW_MINUTES as FLEET_WINDOW_MINUTES
+from alert_engine import alert_engine, WebhookSink, METRICS as ALERT_METRICS
+from log_store import log_store
+from log_index import log_index, parse_query, regex_prefilter
+from log_filter import parse_filter
+import json
+import os
 import frp_deploy
 from pathlib import Path
 
@@ -43,6 +64,19 @@ def init_database():
             print("[OK] 默认管理员已创建 (admin / 123456)")
         else:
             print("[OK] 管理员账号已存在")
+        
+        # 从隧道表和禁用端口配置构建远程端口索引
+        disabled_ports.load(db)
+        port_allocator.load(db)
+        # 代理名/自定义域名/客户端名唯一性索引
+        tunnel_index.load(db)
+        # FRPS 运行中的配置（判断修改 frps.toml 后是否需要重启）
+        frps_jobs.load(db)
+        
+        # 加载告警规则
+        rules = _load_alert_rules(db)
+        if rules is not None:
+            alert_engine.set_rules(rules)
     finally:
         db.close()
     
@@ -50,6 +84,44 @@ def init_database():
 
     # 启动后台 Ping 任务
     asyncio.create_task(background_ping_task())
+    # 未确认的配置推送按退避重发
+    asyncio.create_task(background_config_retry_task())
+    # 在维护窗口或没有在线 Agent 时执行推迟的 FRPS 重启
+    asyncio.create_task(background_frps_maintenance_task())
+    # 启动事件循环延迟监控
+    asyncio.create_task(loop_monitor.run())
+    # 已删除客户端的告警等内存状态
+    asyncio.create_task(background_client_prune_task())
+    # Agent 心跳等高频写入由单写入线程合并提交；整批回滚时 Agent 信息缓存可能已领先于数据库
+    db_writer.on_rollback.append(agent_info_cache.invalidate)
+    db_writer.start()
+
+    # 告警事件推送到 Dashboard，配置了 ALERT_WEBHOOK_URL 时同时发送到 Webhook
+    alert_engine.sinks.append(ws_manager.broadcast_alert)
+    webhook_url = os.environ.get("ALERT_WEBHOOK_URL", "").strip()
+    if webhook_url:
+        webhook = WebhookSink(webhook_url)
+        alert_engine.sinks.append(webhook)
+        asyncio.create_task(webhook.run())
+    asyncio.create_task(alert_engine.run())
+    asyncio.create_task(background_alert_task())
+    # 日志落盘与过期清理
+    asyncio.create_task(log_store.run())
+    # 从磁盘日志重建搜索索引（重建期间的新日志会暂存，完成后补上）
+    log_index.begin_rebuild(log_store.client_ids())
+    asyncio.get_running_loop().run_in_executor(None, log_index.rebuild)
+
+@app.on_event("shutdown")
+def close_log_store():
+    log_store.close()
+
+@app.on_event("shutdown")
+async def close_docker_client():
+    await docker_client.close()
+
+@app.on_event("shutdown")
+async def close_db_writer():
+    await db_writer.close()
 
 async def background_ping_task():
     """定期发送 Ping 保持 WebSocket 连接活跃"""
@@ -60,6 +132,58 @@ async def background_ping_task():
         except Exception as e:
             print(f"[Error] Ping 广播失败: {e}")
 
+async def background_config_retry_task():
+    """重发超时未确认的配置推送"""
+    while True:
+        await asyncio.sleep(1)
+        try:
+            await ws_manager.retry_config_deliveries()
+        except Exception as e:
+            print(f"[Error] 配置重发失败: {e}")
+
+async def background_frps_maintenance_task():
+    """检查是否可以执行推迟的 FRPS 重启"""
+    while True:
+        await asyncio.sleep(60)
+        try:
+            frps_jobs.maintenance_tick(len(ws_manager.agent_connections))
+        except Exception as e:
+            print(f"[Error] FRPS 维护检查失败: {e}")
+
+async def background_alert_task():
+    """定期检查静默的 Agent（离线告警）"""
+    while True:
+        await asyncio.sleep(5)
+        try:
+            events = alert_engine.check_offline()
+            if events:
+                alert_engine.enqueue(events)
+        except Exception as e:
+            print(f"[Error] 离线告警检查失败: {e}")
+
+async def background_client_prune_task():
+    """定期丢弃已从数据库删除的客户端的内存状态"""
+    while True:
+        await asyncio.sleep(60)
+        try:
+            client_ids = await run_db(lambda db: {c for (c,) in db.query(models.Client.id)})
+            alert_engine.retain(client_ids)
+            fleet_stats.retain(client_ids)
+            rate_limiter.retain(client_ids)
+        except Exception as e:
+            print(f"[Error] 清理已删除客户端的状态失败: {e}")
+
+def _load_alert_rules(db: Session):
+    """从 SystemConfig 读取告警规则，未配置时返回 None"""
+    raw = crud.get_config(db, models.ConfigKeys.ALERT_RULES)
+    if not raw:
+        return None
+    try:
+        return [schemas.AlertRule(**r) for r in json.loads(raw)]
+    except Exception as e:
+        print(f"[Error] 告警规则解析失败，使用默认规则: {e}")
+        return None
+
 # 依赖项
 def get_db():
     db = SessionLocal()
@@ -70,7 +194,7 @@ def get_db():
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
-async def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
+def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
@@ -100,7 +224,7 @@ def get_system_status(db: Session = Depends(get_db)):
 
 # 修改密码接口
 @app.post("/api/auth/change-password")
-async def change_password(
+def change_password(
     old_password: str,
     new_password: str,
     db: Session = Depends(get_db),
@@ -115,11 +239,13 @@ async def change_password(
         )
     
     # 更新密码
-    crud.update_admin_password(db, current_user.id, new_password)
+    # 哈希计算较慢，在当前工作线程中完成，单写入线程只执行 UPDATE
+    hashed = auth.get_password_hash(new_password)
+    write_db_from_thread(crud.set_admin_password_hash, current_user.id, hashed)
     return {"message": "密码修改成功"}
 
 @app.post("/token", response_model=schemas.Token)
-async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
+def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
     user = crud.get_admin_by_username(db, form_data.username)
     if not user or not auth.verify_password(form_data.password, user.hashed_password):
         raise HTTPException(
@@ -158,17 +284,58 @@ def update_client(
     name = (payload.get("name") or "").strip()
     if not name:
         raise HTTPException(status_code=400, detail="name is required")
-    updated = crud.update_client_name(db, client_id=client_id, new_name=name)
+
+    def _rename(db: Session):
+        # 校验、写入与更新索引都在单写入线程的操作里完成，期间持有索引锁
+        with tunnel_index.lock:
+            conflict = tunnel_index.client_name_conflict(client_id, name)
+            if conflict:
+                raise conflict
+            updated = crud.update_client_name(db, client_id=client_id, new_name=name)
+            if not updated:
+                return None
+            _undo_index(db, client_id=client_id)
+            tunnel_index.set_client(client_id, updated.name)
+            # 会话关闭前序列化，响应里的隧道列表需要懒加载
+            return schemas.Client.model_validate(updated)
+
+    try:
+        updated = write_db_from_thread(_rename)
+    except TunnelConflict as e:
+        raise HTTPException(status_code=409, detail=str(e))
     if not updated:
         raise HTTPException(status_code=404, detail="Client not found")
+    agent_info_cache.set_client_name(client_id, updated.name)
+    config_cache.invalidate_client(client_id)
     return updated
 
+
+def _undo_index(db: Session, tunnel_ids=(), client_id: str = None):
+    """修改索引前调用：写操作随事务回滚时，把这些隧道与客户端名的索引和端口占用恢复原样"""
+    state = tunnel_index.snapshot(tunnel_ids, client_id)
+    on_undo(db, lambda: tunnel_index.restore(state))
+
 @app.post("/clients/{client_id}/tunnels/", response_model=schemas.Tunnel)
 async def create_tunnel_for_client(
-    client_id: str, tunnel: schemas.TunnelCreate, db: Session = Depends(get_db), current_user: models.Admin = Depends(get_current_user)
+    client_id: str, tunnel: schemas.TunnelCreate, current_user: models.Admin = Depends(get_current_user)
 ):
-    created = crud.create_tunnel(db=db, tunnel=tunnel, client_id=client_id)
-    await _push_config_for_client(client_id)
+    def _create(db: Session):
+        # 在单写入线程中持有索引锁完成校验、写入与索引更新，并发请求不会占用同一代理名/域名/端口；
+        # 所有写入都经由这一个连接，持锁期间不会等待其他连接的写锁
+        with tunnel_index.lock:
+            tunnel_index.check(tunnel, client_id)
+            created = crud.create_tunnel(db, tunnel=tunnel, client_id=client_id)
+            _undo_index(db, [created.id])
+            tunnel_index.set_tunnel(created)
+            port_allocator.set_tunnel(created.id, claim_of(created))
+            return created
+
+    try:
+        created = await write_db(_create)
+    except (PortConflict, TunnelConflict) as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    config_cache.invalidate_client(client_id)
+    push_scheduler.schedule(client_id)
     return created
 
 @app.patch("/clients/{client_id}/tunnels/{tunnel_id}", response_model=schemas.Tunnel)
@@ -176,32 +343,229 @@ async def update_tunnel_for_client(
     client_id: str,
     tunnel_id: int,
     payload: dict,
-    db: Session = Depends(get_db),
     current_user: models.Admin = Depends(get_current_user),
 ):
-    tunnel = db.query(models.Tunnel).filter(models.Tunnel.id == tunnel_id, models.Tunnel.client_id == client_id).first()
-    if not tunnel:
+    if "enabled" not in payload:
+        raise HTTPException(status_code=400, detail="No supported fields")
+
+    def _update(db: Session):
+        with tunnel_index.lock:
+            tunnel = crud.get_client_tunnel(db, client_id=client_id, tunnel_id=tunnel_id)
+            if not tunnel:
+                return None
+            if payload.get("enabled"):
+                tunnel.enabled = True
+                # 名称没有变化，只需校验启用后占用的域名和端口
+                tunnel_index.check(tunnel, tunnel_id=tunnel_id, check_name=False)
+            updated = crud.set_tunnel_enabled(db, tunnel_id=tunnel_id, enabled=payload.get("enabled"))
+            _undo_index(db, [tunnel_id])
+            tunnel_index.set_tunnel(updated)
+            port_allocator.set_tunnel(tunnel_id, claim_of(updated))
+            return updated
+
+    try:
+        updated = await write_db(_update)
+    except (PortConflict, TunnelConflict) as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    if not updated:
         raise HTTPException(status_code=404, detail="Tunnel not found")
-    if "enabled" in payload:
-        updated = crud.set_tunnel_enabled(db, tunnel_id=tunnel_id, enabled=payload.get("enabled"))
-        await _push_config_for_client(client_id)
-        return updated
-    raise HTTPException(status_code=400, detail="No supported fields")
+    config_cache.invalidate_client(client_id)
+    push_scheduler.schedule(client_id)
+    return updated
 
 @app.delete("/clients/{client_id}/tunnels/{tunnel_id}")
 async def delete_tunnel_for_client(
     client_id: str,
     tunnel_id: int,
-    db: Session = Depends(get_db),
     current_user: models.Admin = Depends(get_current_user),
 ):
-    tunnel = db.query(models.Tunnel).filter(models.Tunnel.id == tunnel_id, models.Tunnel.client_id == client_id).first()
-    if not tunnel:
+    def _delete(db: Session):
+        if not crud.get_client_tunnel(db, client_id=client_id, tunnel_id=tunnel_id):
+            return None
+        with tunnel_index.lock:
+            ok = crud.delete_tunnel(db, tunnel_id=tunnel_id)
+            _undo_index(db, [tunnel_id])
+            tunnel_index.remove_tunnel(tunnel_id)
+            port_allocator.remove_tunnel(tunnel_id)
+            return ok
+
+    ok = await write_db(_delete)
+    if ok is None:
         raise HTTPException(status_code=404, detail="Tunnel not found")
-    ok = crud.delete_tunnel(db, tunnel_id=tunnel_id)
-    await _push_config_for_client(client_id)
+    config_cache.invalidate_client(client_id)
+    push_scheduler.schedule(client_id)
     return {"success": ok}
 
+# 单次批量请求最多包含的操作数
+TUNNEL_BATCH_MAX = 1000
+
+
+class _BatchError(Exception):
+    def __init__(self, index: int, detail: str):
+        self.index = index
+        self.detail = detail
+
+
+def _proxy_key(tunnel) -> str:
+    # 与 _render_frpc_toml 中代理名的清洗方式一致
+    return (tunnel.name or "").replace('"', '').strip()
+
+
+def _apply_tunnel_batch(db: Session, operations: List[schemas.TunnelBatchOp], port_range=None):
+    """
+    在同一个事务中按顺序执行批量操作，全部校验通过后才提交（通过单写入线程执行）
+    返回 (每个操作的结果, 受影响的客户端 ID 列表)，任一操作无效时抛出 _BatchError，由单写入线程回滚
+    """
+    client_ids = {op.client_id for op in operations}
+    clients = {
+        c.id: c for c in db.query(models.Client)
+        .options(selectinload(models.Client.tunnels))
+        .filter(models.Client.id.in_(client_ids))
+    }
+    results = []
+    index_ops = {}          # 隧道 -> [最后一个操作序号, 是否校验名称, 是否校验域名]
+    port_ops = {}           # 操作序号 -> 远程端口可能变化的隧道
+    allocate = []           # 需要自动分配端口的操作序号
+    deleted = {}            # 被删除的隧道 ID -> 操作序号
+    # 持有索引锁直到写入并同步索引，期间其他隧道写入会等待
+    with tunnel_index.lock:
+        for i, op in enumerate(operations):
+            client = clients.get(op.client_id)
+            if client is None:
+                raise _BatchError(i, f"Client not found: {op.client_id}")
+
+            if op.op == "create":
+                if op.tunnel is None:
+                    raise _BatchError(i, "tunnel is required for create")
+                tunnel = models.Tunnel(**op.tunnel.model_dump(), client_id=client.id)
+                client.tunnels.append(tunnel)
+                results.append(tunnel)
+                changed = set(schemas.TunnelCreate.model_fields)
+                if op.allocate_port and not tunnel.remote_port:
+                    allocate.append(i)
+            else:
+                tunnel = next((t for t in client.tunnels if t.id == op.tunnel_id), None)
+                if op.tunnel_id is None or tunnel is None:
+                    raise _BatchError(i, f"Tunnel not found: {op.tunnel_id}")
+                if op.op == "delete":
+                    client.tunnels.remove(tunnel)
+                    results.append(None)
+                    deleted[tunnel.id] = i
+                    continue
+                if op.changes is None:
+                    raise _BatchError(i, "changes is required for update")
+                changes = op.changes.model_dump(exclude_unset=True)
+                for field, value in changes.items():
+                    if field in ("name", "type", "local_port") and value is None:
+                        raise _BatchError(i, f"{field} cannot be null")
+                    setattr(tunnel, field, value)
+                results.append(tunnel)
+                changed = set(changes)
+
+            # 只校验本批次改动到的名称、域名和端口，不因已有的历史冲突拒绝无关操作
+            if "name" in changed and not _proxy_key(tunnel):
+                raise _BatchError(i, "Tunnel name is required")
+            check_name = "name" in changed
+            check_domains = bool(changed & {"custom_domains", "enabled"})
+            if check_name or check_domains:
+                flags = index_ops.setdefault(tunnel, [i, False, False])
+                flags[0] = i
+                flags[1] |= check_name
+                flags[2] |= check_domains
+            if changed & {"remote_port", "enabled", "type"}:
+                port_ops[i] = tunnel
+
+        # 为未指定端口的新隧道批量分配，避开本批次显式指定的端口
+        if allocate:
+            for i in allocate:
+                if results[i].type.value not in ("tcp", "udp"):
+                    raise _BatchError(i, "allocate_port only applies to tcp/udp tunnels")
+            start, end = port_range or (None, None)
+            for proto in ("tcp", "udp"):
+                wanted = [i for i in allocate if results[i].type.value == proto]
+                if not wanted:
+                    continue
+                explicit = {c[1] for t in port_ops.values() if (c := claim_of(t)) and c[0] == proto}
+                ports = port_allocator.find_free(proto, len(wanted), start, end, exclude=explicit)
+                if len(ports) < len(wanted):
+                    raise _BatchError(wanted[len(ports)], f"No free {proto} port left in range")
+                for i, port in zip(wanted, ports):
+                    results[i].remote_port = port
+
+        db.flush()
+
+        # 整体校验：代理名（客户端名.隧道名）与启用隧道的自定义域名在全舰队范围内不能重复
+        op_of = {}
+        entries = {}
+        for tunnel, (i, check_name, check_domains) in index_ops.items():
+            op_of[tunnel.id] = i
+            entries[tunnel.id] = (
+                tunnel.client_id,
+                tunnel_key(tunnel.name, tunnel.id) if check_name else None,
+                domains_of(tunnel) if check_domains else None,
+            )
+        for tunnel_id, i in deleted.items():
+            op_of[tunnel_id] = i
+            entries[tunnel_id] = None
+        conflict = tunnel_index.check_batch(entries)
+        if conflict:
+            tunnel_id, error = conflict
+            raise _BatchError(op_of[tunnel_id], str(error))
+
+        # 整体校验：启用的 TCP/UDP 隧道之间 remote_port 不能冲突，也不能使用禁用/保留端口
+        op_of = {}
+        claims = {}
+        for i, tunnel in port_ops.items():
+            op_of[tunnel.id] = i
+            claims[tunnel.id] = claim_of(tunnel)
+        for tunnel_id, i in deleted.items():
+            op_of[tunnel_id] = i
+            claims[tunnel_id] = None
+        conflict = port_allocator.check_batch(claims)
+        if conflict:
+            tunnel_id, error = conflict
+            raise _BatchError(op_of[tunnel_id], str(error))
+
+        db.commit()
+
+        _undo_index(db, set(claims) | {t.id for t in index_ops} | set(deleted))
+        for tunnel_id, claim in claims.items():
+            port_allocator.set_tunnel(tunnel_id, claim)
+        for tunnel in index_ops:
+            tunnel_index.set_tunnel(tunnel)
+        for tunnel_id in deleted:
+            tunnel_index.remove_tunnel(tunnel_id)
+
+    return [
+        {"op": op.op, "client_id": op.client_id, "tunnel": schemas.Tunnel.model_validate(t).model_dump() if t is not None else None}
+        for op, t in zip(operations, results)
+    ], sorted(client_ids)
+
+
+@app.post("/clients/tunnels/batch")
+async def batch_tunnels(
+    batch: schemas.TunnelBatch,
+    current_user: models.Admin = Depends(get_current_user),
+):
+    """
+    批量创建/修改/删除隧道（可跨多个客户端）
+    所有操作在同一事务中执行并整体校验，任一操作无效时全部回滚；成功后每个受影响的客户端只推送一次配置
+    """
+    if not batch.operations:
+        raise HTTPException(status_code=400, detail="operations is empty")
+    if len(batch.operations) > TUNNEL_BATCH_MAX:
+        raise HTTPException(status_code=400, detail=f"Too many operations (max {TUNNEL_BATCH_MAX})")
+
+    try:
+        results, client_ids = await write_db(_apply_tunnel_batch, batch.operations, batch.port_range)
+    except _BatchError as e:
+        raise HTTPException(status_code=400, detail={"index": e.index, "message": e.detail})
+
+    for client_id in client_ids:
+        config_cache.invalidate_client(client_id)
+        push_scheduler.schedule(client_id)
+    return {"results": results, "scheduled": client_ids}
+
 # 获取公网 IP 接口
 @app.get("/api/system/public-ip")
 async def get_public_ip(current_user: models.Admin = Depends(get_current_user)):
@@ -225,128 +589,122 @@ def _get_admin_from_token(db: Session, token: str):
     except Exception:
         return None
 
+def _build_dashboard_snapshot(db: Session, ws_agents_info: dict) -> dict:
+    """
+    组装 Dashboard 推送中来自数据库的部分（在数据库线程池中执行）
+    ws_agents_info 为事件循环侧获取的 WebSocket 实时状态快照（client_id -> info）
+    """
+    clients = crud.get_clients(db)
+
+    registered_clients = []
+    for c in clients:
+        # 1. 基础信息
+        client_data = {
+            "id": c.id,
+            "name": c.name,
+            "auth_token": c.auth_token,
+            "status": c.status,
+            "last_seen": c.last_seen,  # Integer 时间戳
+            "tunnels": [
+                {
+                    "id": t.id,
+                    "name": t.name,
+                    "type": t.type,
+                    "local_ip": t.local_ip,
+                    "local_port": t.local_port,
+                    "remote_port": t.remote_port,
+                    "custom_domains": t.custom_domains,
+                }
+                for t in c.tunnels
+            ],
+        }
+
+        # 2. 注入 Agent 硬件信息 (持久化数据，经内存缓存读取)
+        agent_info = agent_info_cache.get(db, c.id)
+
+        if agent_info:
+            client_data.update({
+                "hostname": agent_info["hostname"],
+                "os": agent_info["os"],
+                "arch": agent_info["arch"],
+                "platform": agent_info["platform"],
+                "agent_version": agent_info["agent_version"],
+            })
+
+        # 3. 注入实时状态和系统指标 (从 Memory Cache)
+        if c.id in ws_agents_info:
+            ws_info = ws_agents_info[c.id]
+            client_data.update({
+                # 使用 WS 连接状态覆盖数据库状态，更实时
+                "is_online": True, 
+                "cpu_percent": ws_info.get("cpu_percent"),
+                "memory_percent": ws_info.get("memory_percent"),
+                "memory_used": ws_info.get("memory_used"),
+                "memory_total": ws_info.get("memory_total"),
+                "disk_percent": ws_info.get("disk_percent"),
+                "disk_used": ws_info.get("disk_used"),
+                "disk_total": ws_info.get("disk_total"),
+                "net_bytes_in": ws_info.get("net_bytes_in"),
+                "net_bytes_out": ws_info.get("net_bytes_out"),
+                "net_speed_in": ws_info.get("net_speed_in"),
+                "net_speed_out": ws_info.get("net_speed_out"),
+            })
+        else:
+            client_data["is_online"] = False
+
+        # 4. 隧道信息
+        client_data["tunnels"] = [
+            {
+                "id": t.id,
+                "client_id": t.client_id,
+                "name": t.name,
+                "type": t.type.value if hasattr(t.type, "value") else str(t.type),
+                "enabled": getattr(t, "enabled", True),
+                "local_ip": t.local_ip,
+                "local_port": t.local_port,
+                "remote_port": t.remote_port,
+                "custom_domains": t.custom_domains,
+            }
+            for t in (c.tunnels or [])
+        ]
+
+        registered_clients.append(client_data)
+
+    return {
+        "disabled_ports": disabled_ports.active.ranges(),
+        "agents": _list_agents(db),
+        "registered_clients": registered_clients,
+    }
+
+
 @app.websocket("/ws/dashboard")
 async def websocket_dashboard(websocket: WebSocket):
     """
     Dashboard 实时状态推送
     每秒推送一次 FRPS 状态，替代前端轮询
     """
-    db = SessionLocal()
-    try:
-        token = websocket.query_params.get("token")
-        admin = _get_admin_from_token(db, token)
-        if not admin:
-            await websocket.close(code=1008)
-            return
-    finally:
-        db.close()
+    token = websocket.query_params.get("token")
+    admin = await run_db(_get_admin_from_token, token)
+    if not admin:
+        await websocket.close(code=1008)
+        return
 
     await websocket.accept()
     await ws_manager.connect_dashboard(websocket)
     
     try:
         while True:
-            db = SessionLocal()
-            try:
-                status = await get_frps_status(db=db, current_user=None)
-                disabled = await get_disabled_ports(db=db, current_user=None)
-                agents = await get_agents(db=db, current_user=None)
-
-                clients = crud.get_clients(db)
-                
-                # 获取 WebSocket 实时在线状态和内存缓存（CPU/Mem等）
-                ws_agents_info = {
-                    info["client_id"]: info 
-                    for info in ws_manager.get_all_agents_info()
-                }
-
-                registered_clients = []
-                for c in clients:
-                    # 1. 基础信息
-                    client_data = {
-                        "id": c.id,
-                        "name": c.name,
-                        "auth_token": c.auth_token,
-                        "status": c.status,
-                        "last_seen": c.last_seen,  # Integer 时间戳
-                        "tunnels": [
-                            {
-                                "id": t.id,
-                                "name": t.name,
-                                "type": t.type,
-                                "local_ip": t.local_ip,
-                                "local_port": t.local_port,
-                                "remote_port": t.remote_port,
-                                "custom_domains": t.custom_domains,
-                            }
-                            for t in c.tunnels
-                        ],
-                    }
-
-                    # 2. 注入 Agent 硬件信息 (优先从 DB 获取持久化数据)
-                    agent_info_db = db.query(models.AgentInfo).filter(
-                        models.AgentInfo.client_id == c.id
-                    ).first()
-                    
-                    if agent_info_db:
-                        client_data.update({
-                            "hostname": agent_info_db.hostname,
-                            "os": agent_info_db.os,
-                            "arch": agent_info_db.arch,
-                            "platform": agent_info_db.platform,
-                            "agent_version": agent_info_db.agent_version,
-                        })
-                    
-                    # 3. 注入实时状态和系统指标 (从 Memory Cache)
-                    if c.id in ws_agents_info:
-                        ws_info = ws_agents_info[c.id]
-                        client_data.update({
-                            # 使用 WS 连接状态覆盖数据库状态，更实时
-                            "is_online": True, 
-                            "cpu_percent": ws_info.get("cpu_percent"),
-                            "memory_percent": ws_info.get("memory_percent"),
-                            "memory_used": ws_info.get("memory_used"),
-                            "memory_total": ws_info.get("memory_total"),
-                            "disk_percent": ws_info.get("disk_percent"),
-                            "disk_used": ws_info.get("disk_used"),
-                            "disk_total": ws_info.get("disk_total"),
-                            "net_bytes_in": ws_info.get("net_bytes_in"),
-                            "net_bytes_out": ws_info.get("net_bytes_out"),
-                            "net_speed_in": ws_info.get("net_speed_in"),
-                            "net_speed_out": ws_info.get("net_speed_out"),
-                        })
-                    else:
-                        client_data["is_online"] = False
-
-                    # 4. 隧道信息
-                    client_data["tunnels"] = [
-                        {
-                            "id": t.id,
-                            "client_id": t.client_id,
-                            "name": t.name,
-                            "type": t.type.value if hasattr(t.type, "value") else str(t.type),
-                            "enabled": getattr(t, "enabled", True),
-                            "local_ip": t.local_ip,
-                            "local_port": t.local_port,
-                            "remote_port": t.remote_port,
-                            "custom_domains": t.custom_domains,
-                        }
-                        for t in (c.tunnels or [])
-                    ]
-                    
-                    registered_clients.append(client_data)
-
-                await websocket.send_json({
-                    "type": "dashboard",
-                    "data": {
-                        "status": status,
-                        "disabled_ports": disabled.get("disabled_ports", []),
-                        "agents": agents.get("agents", []),
-                        "registered_clients": registered_clients,
-                    }
-                })
-            finally:
-                db.close()
+            status = await get_frps_status(current_user=None)
+            # 获取 WebSocket 实时在线状态和内存缓存（CPU/Mem等）
+            ws_agents_info = {
+                info["client_id"]: info 
+                for info in ws_manager.get_all_agents_info()
+            }
+            snapshot = await run_db(_build_dashboard_snapshot, ws_agents_info)
+            await websocket.send_json({
+                "type": "dashboard",
+                "data": {"status": status, **snapshot, "alerts": alert_engine.active()},
+            })
 
             await asyncio.sleep(1)
     except WebSocketDisconnect:
@@ -372,61 +730,109 @@ async def websocket_agent(websocket: WebSocket, client_id: str):
         await websocket.close(code=1008)
         return
 
-    db = SessionLocal()
-    try:
-        client = crud.get_client(db, client_id=client_id)
-        if not client or not header_token or header_token != client.auth_token:
-            await websocket.close(code=1008)
-            return
-    finally:
-        db.close()
+    client = await run_db(crud.get_client, client_id=client_id)
+    if not client or not header_token or header_token != client.auth_token:
+        await websocket.close(code=1008)
+        return
 
     await websocket.accept()
     await ws_manager.connect_agent(websocket, client_id)
     
     try:
         while True:
-            data = await websocket.receive_json()
-            await _handle_agent_message(client_id, data)
+            # 直接从原始帧解码，格式错误的消息在分发前丢弃
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(message.get("code", 1000))
+            raw = message.get("text") or message.get("bytes")
+            if not raw:
+                continue
+            # 按客户端和消息类型限流，超出部分丢弃并通知 Agent 降速；
+            # 先按帧开头的 type 限流，超速的消息不再完整解码。
+            # 开头找不到已知 type 的帧按 unknown 限流，超速时直接丢弃（Agent 不认识这个类型，不发通知）
+            peeked = agent_protocol.peek_type(raw)
+            if not rate_limiter.allow(client_id, peeked or UNKNOWN_TYPE):
+                if peeked is not None:
+                    await _throttle_agent(client_id, peeked)
+                continue
+            msg = agent_router.decode(raw)
+            if msg is None:
+                continue
+            # 开头没有 type 或与实际类型不一致时，按实际类型限流
+            if msg.type != peeked and not rate_limiter.allow(client_id, msg.type):
+                await _throttle_agent(client_id, msg.type)
+                continue
+            await agent_router.dispatch(client_id, msg)
     except WebSocketDisconnect:
         ws_manager.disconnect_agent(client_id)
     except Exception as e:
         ws_manager.disconnect_agent(client_id)
 
 
+async def _throttle_agent(client_id: str, msg_type: str):
+    notice = rate_limiter.throttle_notice(client_id, msg_type)
+    if notice:
+        await ws_manager.send_to_agent(client_id, notice)
+
+
 @app.websocket("/ws/logs/{client_id}")
 async def websocket_logs(websocket: WebSocket, client_id: str):
     """
     日志实时订阅
     前端订阅某个客户端的日志流
     """
-    db = SessionLocal()
-    try:
-        token = websocket.query_params.get("token")
-        admin = _get_admin_from_token(db, token)
-        if not admin:
-            await websocket.close(code=1008)
-            return
-    finally:
-        db.close()
+    token = websocket.query_params.get("token")
+    admin = await run_db(_get_admin_from_token, token)
+    if not admin:
+        await websocket.close(code=1008)
+        return
 
     await websocket.accept()
-    await ws_manager.subscribe_logs(websocket, client_id)
+    
+    # 初始过滤条件可以放在 URL 参数中，避免先回放一遍未过滤的历史
+    try:
+        log_filter = parse_filter(dict(websocket.query_params))
+    except ValueError as e:
+        await websocket.send_json({"type": "filter_error", "detail": str(e)})
+        log_filter = None
+    # 断线重连时带上 ?after=<最后收到的序号>，只补发缺失的部分
+    after = websocket.query_params.get("after")
+    after = int(after) if after and after.lstrip("-").isdigit() else None
+    await ws_manager.subscribe_logs(websocket, client_id, log_filter, after)
     
     try:
         while True:
-            # 保持连接，等待日志推送
-            await websocket.receive_text()
+            # 订阅者可随时发送 {"type": "filter", "level", "contains", "regex", "proxy"} 更新过滤条件
+            text = await websocket.receive_text()
+            try:
+                message = json.loads(text)
+            except ValueError:
+                continue
+            if not isinstance(message, dict) or message.get("type") != "filter":
+                continue
+            try:
+                log_filter = parse_filter(message)
+            except ValueError as e:
+                await websocket.send_json({"type": "filter_error", "detail": str(e)})
+                continue
+            await ws_manager.set_log_filter(websocket, client_id, log_filter)
     except WebSocketDisconnect:
         ws_manager.unsubscribe_logs(websocket, client_id)
     except Exception:
         ws_manager.unsubscribe_logs(websocket, client_id)
 
 
-def _render_frpc_toml(db: Session, client: models.Client) -> str | None:
-    server_ip = crud.get_config(db, models.ConfigKeys.SERVER_PUBLIC_IP)
-    frps_port = crud.get_config(db, models.ConfigKeys.FRPS_PORT)
-    auth_token = crud.get_config(db, models.ConfigKeys.FRPS_AUTH_TOKEN)
+def _frpc_server_settings(db: Session):
+    """frpc 连接 FRPS 所需的配置: (公网 IP, 端口, Token)"""
+    return (
+        crud.get_config(db, models.ConfigKeys.SERVER_PUBLIC_IP),
+        crud.get_config(db, models.ConfigKeys.FRPS_PORT),
+        crud.get_config(db, models.ConfigKeys.FRPS_AUTH_TOKEN),
+    )
+
+
+def _render_frpc_toml(db: Session, client: models.Client, settings=None) -> str | None:
+    server_ip, frps_port, auth_token = settings or _frpc_server_settings(db)
     if not server_ip or not frps_port or not auth_token:
         return None
 
@@ -446,12 +852,9 @@ def _render_frpc_toml(db: Session, client: models.Client) -> str | None:
             continue
 
         proxy_type = t.type.value if hasattr(t.type, "value") else str(t.type)
-        # 清洗名称，防止 TOML 语法错误 (例如包含双引号)
-        safe_client_name = (client.name or "unknown").replace('"', '').strip()
-        safe_tunnel_name = (t.name or f"tun_{t.id}").replace('"', '').strip()
-        proxy_name = f"{safe_client_name}.{safe_tunnel_name}"
         lines.append("[[proxies]]")
-        lines.append(f'name = "{proxy_name}"')
+        # 清洗名称，防止 TOML 语法错误 (例如包含双引号)
+        lines.append(f'name = "{proxy_name(client.name, t.name, t.id)}"')
         lines.append(f'type = "{proxy_type}"')
         lines.append(f'localIP = "{t.local_ip}"')
         lines.append(f"localPort = {int(t.local_port or 0)}")
@@ -468,174 +871,224 @@ def _render_frpc_toml(db: Session, client: models.Client) -> str | None:
     return "\n".join(lines).rstrip() + "\n"
 
 
+def _render_client_config(db: Session, client_id: str) -> str | None:
+    client = crud.get_client(db, client_id=client_id)
+    if not client:
+        return None
+    return _render_frpc_toml(db, client)
+
+
 async def _push_config_for_client(client_id: str):
-    db = SessionLocal()
-    try:
-        client = crud.get_client(db, client_id=client_id)
-        if not client:
-            return False
-        toml = _render_frpc_toml(db, client)
-        if not toml:
-            return False
-        return await ws_manager.push_config_to_agent(client_id, toml)
-    finally:
-        db.close()
+    rendered = config_cache.get(client_id)
+    if rendered is None:
+        rendered = await run_db(config_cache.render, client_id, _render_client_config)
+    toml, content_hash = rendered
+    if not toml:
+        return False
+    return await ws_manager.push_config_to_agent(client_id, toml, content_hash)
+
+
+push_scheduler.pusher = _push_config_for_client
+
+
+def _render_client_configs(db: Session, client_ids: List[str]) -> dict:
+    """批量渲染多个客户端的配置（FRPS 配置只读一次，隧道按批预加载），结果写入渲染缓存"""
+    result = {}
+    missing = []
+    for client_id in client_ids:
+        cached = config_cache.get(client_id)
+        if cached is not None:
+            result[client_id] = cached
+        else:
+            missing.append(client_id)
+
+    settings = _frpc_server_settings(db)
+    for i in range(0, len(missing), 500):
+        chunk = missing[i:i + 500]
+        versions = {cid: config_cache.version(cid) for cid in chunk}
+        clients = db.query(models.Client).options(selectinload(models.Client.tunnels)) \
+            .filter(models.Client.id.in_(chunk))
+        for client in clients:
+            toml = _render_frpc_toml(db, client, settings)
+            result[client.id] = config_cache.store(client.id, versions[client.id], toml)
+    return result
 
 
-async def _handle_agent_message(client_id: str, msg: dict):
-    """
-    处理 Agent 上报的消息
-    """
-    from datetime import datetime
-    
-    msg_type = msg.get("type")
-    data = msg.get("data")
-    
-    if msg_type == "register":
-        # Agent 注册/上线
-        db = SessionLocal()
-        try:
-            crud.touch_client(db, client_id=client_id, status="online")
-            
-            # 获取 hostname 并强制更新客户端名称 (废除手动改名)
-            hostname = data.get("hostname") if isinstance(data, dict) else None
-            if hostname:
-                client = crud.get_client(db, client_id=client_id)
-                if client and client.name != hostname:
-                    crud.update_client_name(db, client_id=client_id, new_name=hostname)
-            
-            agent = db.query(models.AgentInfo).filter(
-                models.AgentInfo.client_id == client_id
-            ).first()
-            
-            if agent:
-                # 更新现有记录
-                agent.hostname = data.get("hostname", agent.hostname) if isinstance(data, dict) else agent.hostname
-                agent.os = data.get("os", agent.os) if isinstance(data, dict) else agent.os
-                agent.arch = data.get("arch", agent.arch) if isinstance(data, dict) else agent.arch
-                agent.agent_version = data.get("version", agent.agent_version) if isinstance(data, dict) else agent.agent_version
-                agent.platform = data.get("platform", agent.platform) if isinstance(data, dict) else agent.platform
-                # is_online 和 last_heartbeat 已移除
-            else:
-                # 创建新记录
-                agent = models.AgentInfo(
-                    client_id=client_id,
-                    hostname=data.get("hostname") if isinstance(data, dict) else None,
-                    os=data.get("os") if isinstance(data, dict) else None,
-                    arch=data.get("arch") if isinstance(data, dict) else None,
-                    agent_version=data.get("version") if isinstance(data, dict) else None,
-                    platform=data.get("platform") if isinstance(data, dict) else None,
-                    # is_online=True, # 已移除
-                    # last_heartbeat=datetime.utcnow() # 已移除
-                )
-                db.add(agent)
-            
-            db.commit()
-            client = crud.get_client(db, client_id=client_id)
-            toml = _render_frpc_toml(db, client) if client else None
-        finally:
-            db.close()
-        if toml:
-            await ws_manager.push_config_to_agent(client_id, toml)
-    
+def _start_config_rollout(reason: str):
+    """向所有在线 Agent 重新下发配置"""
+    return config_rollouts.start(
+        reason,
+        list(ws_manager.agent_connections),
+        render=lambda client_ids: run_db(_render_client_configs, client_ids),
+        push=ws_manager.push_config_to_agent,
+    )
+
 
+@agent_router.handler("register")
+async def _on_agent_register(client_id: str, msg: agent_protocol.RegisterMessage):
+    """Agent 注册/上线"""
+    info = msg.data
+
+    def _sync_name(db: Session) -> bool:
+        # 获取 hostname 并强制更新客户端名称 (废除手动改名)
+        # 与其他客户端重名时加上客户端 ID 前缀，保证代理名全局唯一
+        with tunnel_index.lock:
+            name = tunnel_index.unique_client_name(client_id, info.hostname)
+            if not agent_info_cache.sync_client_name(db, client_id, name):
+                return False
+            _undo_index(db, client_id=client_id)
+            tunnel_index.set_client(client_id, name)
+            return True
+
+    def _register(db: Session) -> bool:
+        renamed = _sync_name(db) if info.hostname else False
+        crud.touch_client(db, client_id=client_id, status="online")
+        
+        # 仅写入发生变化的 Agent 信息（无记录时新建）
+        fields = {
+            "hostname": info.hostname,
+            "os": info.os,
+            "arch": info.arch,
+            "agent_version": info.version,
+            "platform": info.platform,
+        }
+        fields = {k: v for k, v in fields.items() if v is not None}
+        agent_info_cache.update(db, client_id, fields, create=True)
+        
+        db.commit()
+        return renamed
+
+    # Agent 上报的本地配置与渲染结果一致时不再推送，避免重连风暴引发大量 frpc 重载
+    config_delivery.reported(client_id, info.config_hash)
+    if await write_db(_register):
+        config_cache.invalidate_client(client_id)
+    toml, content_hash = await run_db(config_cache.render, client_id, _render_client_config)
+    if toml:
+        await ws_manager.push_config_to_agent(client_id, toml, content_hash)
+
+
+@agent_router.handler("system_info")
+async def _on_agent_system_info(client_id: str, msg: agent_protocol.SystemInfoMessage):
+    """系统信息上报 (同时视作心跳)"""
+    data = msg.data
+    
+    # 更新内存缓存（用于实时显示和全舰队统计）
+    sample = data.model_dump()
+    ws_manager.update_agent_system_info(client_id, sample)
+    fleet_stats.record(client_id, sample)
+
+    # 增量评估告警规则
+    events = alert_engine.observe(client_id, sample)
+    if events:
+        alert_engine.enqueue(events)
     
-    elif msg_type == "system_info":
-        # 系统信息上报 (同时视作心跳)
-        if not isinstance(data, dict):
-            return
+    def _store(db: Session):
+        # 更新在线状态和心跳时间
+        crud.touch_client(db, client_id=client_id, status="online")
+        # 更新其他 Agent 信息（未变化时不读写数据库）
+        fields = {"hostname": data.hostname, "os": data.os, "arch": data.arch}
+        agent_info_cache.update(db, client_id, {k: v for k, v in fields.items() if v is not None})
         
-        # 更新内存缓存（用于实时显示）
-        ws_manager.update_agent_system_info(client_id, data)
+        # 存储系统指标
+        metrics = models.SystemMetrics(
+            client_id=client_id,
+            timestamp=datetime.utcnow(),
+            cpu_percent=data.cpu_percent,
+            memory_used=data.memory_used,
+            memory_total=data.memory_total,
+            memory_percent=data.memory_percent,
+            disk_used=data.disk_used,
+            disk_total=data.disk_total,
+            disk_percent=data.disk_percent,
+            net_bytes_in=data.net_bytes_in,
+            net_bytes_out=data.net_bytes_out,
+            net_speed_in=data.net_speed_in,
+            net_speed_out=data.net_speed_out
+        )
+        db.add(metrics)
         
-        db = SessionLocal()
-        try:
-            # 更新在线状态和心跳时间
-            crud.touch_client(db, client_id=client_id, status="online")
-            agent = db.query(models.AgentInfo).filter(
-                models.AgentInfo.client_id == client_id
-            ).first()
-            
-            if agent:
-                # agent.last_heartbeat = datetime.utcnow() # 已移除
-                # agent.is_online = True # 已移除
-                # 更新其他 Agent 信息
-                if "hostname" in data: agent.hostname = data["hostname"]
-                if "os" in data: agent.os = data["os"]
-                if "arch" in data: agent.arch = data["arch"]
-            
-            # 存储系统指标
-            metrics = models.SystemMetrics(
-                client_id=client_id,
-                timestamp=datetime.utcnow(),
-                cpu_percent=data.get("cpu_percent"),
-                memory_used=data.get("memory_used"),
-                memory_total=data.get("memory_total"),
-                memory_percent=data.get("memory_percent"),
-                disk_used=data.get("disk_used"),
-                disk_total=data.get("disk_total"),
-                disk_percent=data.get("disk_percent"),
-                net_bytes_in=data.get("net_bytes_in"),
-                net_bytes_out=data.get("net_bytes_out"),
-                net_speed_in=data.get("net_speed_in"),
-                net_speed_out=data.get("net_speed_out")
-            )
-            db.add(metrics)
-            
-            # 清理旧数据（保留最近 1000 条）
-            count = db.query(models.SystemMetrics).filter(
+        # 清理旧数据（保留最近 1000 条）
+        count = db.query(models.SystemMetrics).filter(
+            models.SystemMetrics.client_id == client_id
+        ).count()
+        
+        if count > 1000:
+            # 删除最旧的记录
+            oldest = db.query(models.SystemMetrics).filter(
                 models.SystemMetrics.client_id == client_id
-            ).count()
-            
-            if count > 1000:
-                # 删除最旧的记录
-                oldest = db.query(models.SystemMetrics).filter(
-                    models.SystemMetrics.client_id == client_id
-                ).order_by(models.SystemMetrics.timestamp.asc()).limit(count - 1000).all()
-                
-                for old in oldest:
-                    db.delete(old)
+            ).order_by(models.SystemMetrics.timestamp.asc()).limit(count - 1000).all()
             
+            for old in oldest:
+                db.delete(old)
+        
+        db.commit()
+
+    await write_db(_store)
+
+
+@agent_router.handler("log")
+async def _on_agent_log(client_id: str, msg: agent_protocol.LogMessage):
+    """日志上报，持久化、建索引并广播给订阅者"""
+    ts = time.time()
+    offset = await log_store.append(client_id, msg.data, ts)
+    log_index.add(client_id, offset, ts, msg.data)
+    await ws_manager.broadcast_log(client_id, offset, msg.data)
+
+
+@agent_router.handler("frpc_status")
+async def _on_agent_frpc_status(client_id: str, msg: agent_protocol.FrpcStatusMessage):
+    """FRPC 进程状态更新"""
+    def _set_status(db: Session):
+        client = db.query(models.Client).filter(
+            models.Client.id == client_id
+        ).first()
+        
+        if client:
+            client.status = "online" if msg.status == "running" else "offline"
             db.commit()
-        finally:
-            db.close()
-    
-    elif msg_type == "log":
-        # 日志上报，广播给订阅者
-        await ws_manager.broadcast_log(client_id, data)
-    
-    elif msg_type == "frpc_status":
-        # FRPC 进程状态更新
-        db = SessionLocal()
-        try:
-            client = db.query(models.Client).filter(
-                models.Client.id == client_id
-            ).first()
-            
-            if client:
-                status = data if isinstance(data, str) else data.get("status", "unknown")
-                client.status = "online" if status == "running" else "offline"
-                db.commit()
-        finally:
-            db.close()
+
+    await write_db(_set_status)
+
+
+@agent_router.handler("config_ack")
+async def _on_agent_config_ack(client_id: str, msg: agent_protocol.ConfigAckMessage):
+    """Agent 应用配置后的确认（失败时带错误信息）"""
+    ack = msg.data
+    config_delivery.ack(client_id, ack.version, ack.ok, ack.hash, ack.error)
+
+
+@agent_router.handler("pong")
+async def _on_agent_pong(client_id: str, msg: agent_protocol.PongMessage):
+    """Ping 的回应，连接本身已证明存活，无需处理"""
+    return
 
 
 @app.get("/api/ws/stats")
 async def get_websocket_stats(current_user: models.Admin = Depends(get_current_user)):
     """获取 WebSocket 连接统计"""
-    return ws_manager.get_stats()
+    return {
+        **ws_manager.get_stats(),
+        "agent_messages": agent_router.get_stats(),
+        "rate_limits": rate_limiter.get_stats(),
+        "event_loop_lag": loop_monitor.get_stats(),
+        "log_store": log_store.get_stats(),
+        "log_index": log_index.get_stats(),
+        "config_cache": config_cache.get_stats(),
+        "config_push": push_scheduler.get_stats(),
+        "ports": port_allocator.get_stats(),
+        "tunnels": tunnel_index.get_stats(),
+        "frps_jobs": frps_jobs.get_stats(),
+        "docker": docker_client.get_stats(),
+        "db_writer": db_writer.get_stats(),
+        "alerts": {"queued": alert_engine.queue.qsize(), "dropped": alert_engine.dropped},
+    }
 
 
 # ===========================
 # Agent 管理 API
 # ===========================
 
-@app.get("/api/agents")
-async def get_agents(
-    db: Session = Depends(get_db),
-    current_user: models.Admin = Depends(get_current_user)
-):
-    """获取所有 Agent 列表"""
+def _list_agents(db: Session) -> list:
     agents = db.query(models.AgentInfo).all()
     
     result = []
@@ -665,12 +1118,140 @@ async def get_agents(
             "disk_used": system_info.get("disk_used"),
             "disk_total": system_info.get("disk_total"),
         })
-    
+    return result
+
+
+@app.get("/api/agents")
+def get_agents(
+    db: Session = Depends(get_db),
+    current_user: models.Admin = Depends(get_current_user)
+):
+    """获取所有 Agent 列表"""
+    result = _list_agents(db)
     return {"agents": result, "total": len(result)}
 
 
+@app.get("/api/fleet/config")
+async def get_fleet_config(
+    state: str = None,
+    current_user: models.Admin = Depends(get_current_user)
+):
+    """
+    全舰队配置收敛情况：每个 Agent 最新下发的版本、已确认应用的版本与下发状态
+    state 可按 pending / applied / failed / timeout 过滤
+    """
+    view = config_delivery.fleet(ws_manager.agent_connections)
+    if state:
+        view["agents"] = [a for a in view["agents"] if a["state"] == state]
+    return view
+
+
+@app.post("/api/fleet/config/rollouts")
+async def create_config_rollout(
+    current_user: models.Admin = Depends(get_current_user)
+):
+    """手动向所有在线 Agent 重新渲染并下发配置"""
+    config_cache.invalidate_all()
+    job = _start_config_rollout("manual")
+    return job.progress()
+
+
+@app.get("/api/fleet/config/rollouts")
+async def list_config_rollouts(current_user: models.Admin = Depends(get_current_user)):
+    """最近的配置下发任务及进度"""
+    return {"rollouts": config_rollouts.list()}
+
+
+@app.get("/api/fleet/config/rollouts/{job_id}")
+async def get_config_rollout(job_id: str, current_user: models.Admin = Depends(get_current_user)):
+    """配置下发任务进度：已推送、已确认、失败、等待确认"""
+    job = config_rollouts.get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Rollout not found")
+    return job.progress()
+
+
+@app.get("/api/fleet/stats")
+async def get_fleet_stats(
+    metric: str = "cpu_percent",
+    window: int = None,
+    top: int = 10,
+    bins: int = 10,
+    order: str = "desc",
+    online_only: bool = False,
+    current_user: models.Admin = Depends(get_current_user)
+):
+    """
+    全舰队指标统计（百分位、Top-K、直方图）
+    metric 可用逗号分隔多个指标；window 为空时统计最新值，否则统计最近 window 分钟（最多 1 小时）的均值
+    """
+    metrics = [m.strip() for m in metric.split(",") if m.strip()]
+    unknown = [m for m in metrics if m not in FLEET_METRICS]
+    if not metrics or unknown:
+        raise HTTPException(status_code=400, detail=f"Invalid metric. Valid: {list(FLEET_METRICS)}")
+    if window is not None and not 0 < window <= FLEET_WINDOW_MINUTES:
+        raise HTTPException(status_code=400, detail=f"window must be between 1 and {FLEET_WINDOW_MINUTES}")
+    top = max(0, min(top, 1000))
+    bins = max(1, min(bins, 100))
+
+    return {
+        "agents": len(fleet_stats),
+        "stats": [
+            fleet_stats.query(
+                m,
+                window_minutes=window,
+                top=top,
+                bins=bins,
+                ascending=(order == "asc"),
+                # 在线判断：最近 30 秒内有上报（Agent 每 3 秒上报一次）
+                max_age=30 if online_only else None,
+            )
+            for m in metrics
+        ],
+    }
+
+
+@app.get("/api/alerts")
+async def get_alerts(
+    limit: int = 100,
+    current_user: models.Admin = Depends(get_current_user)
+):
+    """当前触发中的告警和最近的告警事件"""
+    events = list(alert_engine.events)[-max(0, limit):] if limit > 0 else []
+    return {"active": alert_engine.active(), "events": events}
+
+
+@app.get("/api/alerts/rules", response_model=List[schemas.AlertRule])
+async def get_alert_rules(current_user: models.Admin = Depends(get_current_user)):
+    return alert_engine.rules
+
+
+@app.put("/api/alerts/rules", response_model=List[schemas.AlertRule])
+async def update_alert_rules(
+    rules: List[schemas.AlertRule],
+    current_user: models.Admin = Depends(get_current_user)
+):
+    """整体替换告警规则"""
+    ids = [r.id for r in rules]
+    if len(ids) != len(set(ids)):
+        raise HTTPException(status_code=400, detail="Duplicate rule id")
+    for r in rules:
+        if r.kind != "offline" and not r.metric:
+            raise HTTPException(status_code=400, detail=f"Rule {r.id}: metric is required")
+        if r.kind != "offline" and r.metric not in ALERT_METRICS:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Rule {r.id}: invalid metric {r.metric!r}. Valid: {list(ALERT_METRICS)}",
+            )
+
+    payload = json.dumps([r.model_dump() for r in rules], ensure_ascii=False)
+    await write_db(crud.set_config, models.ConfigKeys.ALERT_RULES, payload)
+    alert_engine.set_rules(rules)
+    return alert_engine.rules
+
+
 @app.get("/api/agents/{client_id}")
-async def get_agent_detail(
+def get_agent_detail(
     client_id: str,
     db: Session = Depends(get_db),
     current_user: models.Admin = Depends(get_current_user)
@@ -699,7 +1280,7 @@ async def get_agent_detail(
 
 
 @app.get("/api/agents/{client_id}/metrics")
-async def get_agent_metrics(
+def get_agent_metrics(
     client_id: str,
     limit: int = 100,
     db: Session = Depends(get_db),
@@ -732,7 +1313,7 @@ async def get_agent_metrics(
 
 
 @app.get("/api/agents/{client_id}/metrics/latest")
-async def get_agent_latest_metrics(
+def get_agent_latest_metrics(
     client_id: str,
     db: Session = Depends(get_db),
     current_user: models.Admin = Depends(get_current_user)
@@ -762,6 +1343,69 @@ async def get_agent_latest_metrics(
     }
 
 
+@app.get("/api/agents/{client_id}/logs")
+def get_agent_logs(
+    client_id: str,
+    since: float = None,
+    offset: int = None,
+    limit: int = 500,
+    current_user: models.Admin = Depends(get_current_user)
+):
+    """
+    查询 Agent 历史日志（磁盘日志存储）
+    
+    - since: Unix 时间戳，返回该时间之后的日志
+    - offset: 从指定偏移量开始（翻页时传入上次返回的 next_offset）
+    - 都不传时返回最近 limit 条
+    """
+    limit = max(1, min(limit, 5000))
+    result = log_store.read(client_id, since=since, offset=offset, limit=limit)
+    logs = result["logs"]
+    return {
+        "client_id": client_id,
+        "logs": logs,
+        "first_offset": result["first_offset"],
+        "next_offset": logs[-1]["offset"] + 1 if logs else result["next_offset"],
+    }
+
+
+@app.get("/api/logs/search")
+def search_logs(
+    q: str = "",
+    regex: str = None,
+    client_id: str = None,
+    limit: int = 50,
+    cursor: str = None,
+    current_user: models.Admin = Depends(get_current_user)
+):
+    """
+    搜索 Agent 日志（单个客户端或全部客户端），按时间倒序分页
+    
+    - q: 空格分隔的词，全部需要命中；以 * 结尾表示前缀，如 "proxy err*"
+    - regex: 正则，先用其中的字面量在索引上预过滤，再逐行校验
+    - cursor: 翻页时传入上次返回的 next_cursor
+    """
+    terms = parse_query(q)
+    pattern = None
+    if regex:
+        try:
+            pattern = re.compile(regex)
+        except re.error as e:
+            raise HTTPException(status_code=400, detail=f"正则表达式无效: {e}")
+        terms += regex_prefilter(regex)
+    if not terms and pattern is None:
+        raise HTTPException(status_code=400, detail="请提供搜索词或正则表达式")
+    
+    try:
+        position = log_index.parse_cursor(cursor) if cursor else None
+    except ValueError:
+        raise HTTPException(status_code=400, detail="无效的 cursor")
+    
+    limit = max(1, min(limit, 500))
+    result = log_index.search(terms, regex=pattern, client_id=client_id, limit=limit, cursor=position)
+    return {**result, "index_ready": log_index.ready}
+
+
 @app.post("/api/agents/{client_id}/push-config")
 async def push_config_to_agent(
     client_id: str,
@@ -774,17 +1418,48 @@ async def push_config_to_agent(
     if not config_content:
         raise HTTPException(status_code=400, detail="Config content is required")
     
-    success = await ws_manager.push_config_to_agent(client_id, config_content)
+    success = await ws_manager.push_config_to_agent(client_id, config_content, force=bool(config.get("force")))
     
     if success:
         return {"success": True, "message": "Config pushed successfully"}
     else:
         return {"success": False, "message": "Agent not connected"}
 
+# 远程端口查询与分配
+@app.get("/api/ports/check")
+async def check_remote_port(
+    port: int,
+    type: str = "tcp",
+    current_user: models.Admin = Depends(get_current_user)
+):
+    """检查远程端口是否可用"""
+    if type not in ("tcp", "udp") or not 0 < port < 65536:
+        raise HTTPException(status_code=400, detail="Invalid port or type")
+    reason = port_allocator.conflict((type, port))
+    return {"port": port, "type": type, "available": reason is None, "reason": reason}
+
+
+@app.get("/api/ports/free")
+async def find_free_ports(
+    type: str = "tcp",
+    count: int = 1,
+    start: int = None,
+    end: int = None,
+    current_user: models.Admin = Depends(get_current_user)
+):
+    """
+    查找空闲的远程端口（仅查询不占用）
+    需要原子地分配时使用批量接口的 allocate_port
+    """
+    if type not in ("tcp", "udp"):
+        raise HTTPException(status_code=400, detail="Invalid type")
+    count = max(1, min(count, 1000))
+    return {"type": type, "ports": port_allocator.find_free(type, count, start, end)}
+
+
 # 获取 FRPS 实时状态（从 FRPS Dashboard API）
 @app.get("/api/frp/server-status")
 async def get_frps_status(
-    db: Session = Depends(get_db),
     current_user: models.Admin = Depends(get_current_user)
 ):
     """
@@ -794,7 +1469,7 @@ async def get_frps_status(
     import requests
     
     # 获取 Dashboard 密码
-    dashboard_pwd = crud.get_config(db, models.ConfigKeys.FRPS_DASHBOARD_PWD)
+    dashboard_pwd = await run_db(crud.get_config, models.ConfigKeys.FRPS_DASHBOARD_PWD)
     if not dashboard_pwd:
         return {
             "success": False,
@@ -1006,131 +1681,281 @@ async def get_frps_status(
 
 # 端口管理 API
 @app.get("/api/frp/disabled-ports")
-async def get_disabled_ports(
-    db: Session = Depends(get_db),
+async def get_disabled_ports(current_user: models.Admin = Depends(get_current_user)):
+    """禁用端口（[起始, 结束] 区间列表与字符串形式）以及尚未应用的暂存修改"""
+    return {"disabled_ports": disabled_ports.active.ranges(), **disabled_ports.describe()}
+
+def _frps_settings(db: Session):
+    """读取重新生成 frps.toml 所需的现有配置: (端口, Token, 公网 IP, Dashboard 密码)"""
+    frps_port = int(crud.get_config(db, models.ConfigKeys.FRPS_PORT) or 7000)
+    auth_token = crud.get_config(db, models.ConfigKeys.FRPS_AUTH_TOKEN)
+    server_ip = crud.get_config(db, models.ConfigKeys.SERVER_PUBLIC_IP)
+    dashboard_pwd = crud.get_config(db, models.ConfigKeys.FRPS_DASHBOARD_PWD)
+    return frps_port, auth_token, server_ip, dashboard_pwd
+
+# 接口默认等待 FRPS 任务结束的最长秒数，超时后返回任务 id，结果通过 /api/frp/jobs/{id} 查询
+FRPS_JOB_WAIT_TIMEOUT = 60
+
+async def _write_frps_config(job) -> dict:
+    """FRPS 任务步骤：按当前保存的配置与禁用端口重新生成 frps.toml"""
+    frps_port, auth_token, server_ip, dashboard_pwd = await run_db(_frps_settings)
+    job.log("重新生成 frps.toml")
+    loop = asyncio.get_running_loop()
+    result = await loop.run_in_executor(
+        None, frp_deploy.generate_frps_config,
+        frps_port, auth_token, server_ip, disabled_ports.active, dashboard_pwd
+    )
+    if not result["success"]:
+        raise RuntimeError(result["message"])
+    job.config = result["content"]
+    return {}
+
+def _check_restart_mode(restart: str):
+    if restart not in RESTART_MODES:
+        raise HTTPException(status_code=400, detail=f"restart must be one of {', '.join(RESTART_MODES)}")
+
+async def _apply_disabled_ports(ports: PortRangeSet, consumed: int = 0, restart: str = "auto"):
+    """
+    保存新的禁用端口集合，并提交重新生成 frps.toml、重启 FRPS 的后台任务
+    排队中的同类任务会被合并，任务执行时总是使用最新的禁用端口，因此连续修改只重启一次；
+    restart 为 auto 时只禁用端口（收窄 allowPorts）的重启会推迟到维护窗口，重新启用端口会立即重启
+    调用方需持有 disabled_ports.lock
+    """
+    await write_db(disabled_ports.save, ports, consumed)
+    port_allocator.set_disabled(ports)
+    return frps_jobs.submit("ports", [_write_frps_config, RESTART], coalesce=True, restart_mode=restart)
+
+async def _frps_job_result(job, wait: bool) -> dict:
+    """
+    wait 为 True 时等待任务结束（不阻塞事件循环），返回 success/message 以及任务信息
+    wait 为 False 或等待超时时 success 为 True、job.state 为 queued/running
+    """
+    if wait:
+        job = await frps_jobs.wait(job, FRPS_JOB_WAIT_TIMEOUT)
+    if not job.finished:
+        return {"success": True, "message": "任务已提交，正在后台执行", "job": job.to_dict(logs=False)}
+    return {
+        "success": job.error is None,
+        "message": job.result.get("restart_message") or job.error or "完成",
+        "job": job.to_dict(logs=False),
+    }
+
+def _parse_port_ranges(items) -> list:
+    """[[start, end], port, "a-b", ...] -> [(start, end)]"""
+    ranges = []
+    for item in items or []:
+        if isinstance(item, int):
+            ranges.append((item, item))
+        elif isinstance(item, str):
+            ranges.extend(PortRangeSet.parse(item).ranges())
+        elif isinstance(item, (list, tuple)) and len(item) == 2:
+            ranges.append((int(item[0]), int(item[1])))
+        else:
+            raise ValueError(f"无效的端口区间: {item}")
+    return ranges
+
+@app.post("/api/frp/ports/disabled/stage")
+async def stage_disabled_ports(
+    payload: dict,
     current_user: models.Admin = Depends(get_current_user)
 ):
-    disabled_ports_str = crud.get_config(db, models.ConfigKeys.DISABLED_PORTS)
-    if disabled_ports_str:
-        return {"disabled_ports": [int(p) for p in disabled_ports_str.split(",") if p.strip()]}
-    return {"disabled_ports": []}
+    """
+    暂存禁用端口的修改，不重启 FRPS
+    payload: {"add": [[6000, 6999], 7001, "8000-8100"], "remove": [...]}，先加后删
+    """
+    try:
+        disabled_ports.stage(_parse_port_ranges(payload.get("add")), _parse_port_ranges(payload.get("remove")))
+    except (TypeError, ValueError) as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return disabled_ports.describe()
+
+@app.delete("/api/frp/ports/disabled/stage")
+async def discard_disabled_ports(current_user: models.Admin = Depends(get_current_user)):
+    """丢弃暂存的修改"""
+    disabled_ports.discard()
+    return disabled_ports.describe()
+
+@app.post("/api/frp/ports/disabled/apply")
+async def apply_disabled_ports(
+    wait: bool = True,
+    restart: str = "auto",
+    current_user: models.Admin = Depends(get_current_user)
+):
+    """
+    一次性应用所有暂存的修改：写入配置并最多重启一次 FRPS（wait=false 时立即返回任务）
+    restart=auto 时只禁用端口的重启推迟到维护窗口（重新启用端口仍立即重启），restart=now 总是立即重启
+    """
+    _check_restart_mode(restart)
+    async with disabled_ports.lock:
+        staged, consumed = disabled_ports.staged, disabled_ports.staged_count
+        if staged is None:
+            return {"success": True, "message": "没有暂存的修改", **disabled_ports.describe()}
+        if staged == disabled_ports.active:
+            await write_db(disabled_ports.save, staged, consumed)
+            return {"success": True, "message": "禁用端口没有变化", **disabled_ports.describe()}
+        job = await _apply_disabled_ports(staged, consumed, restart)
+    return {**await _frps_job_result(job, wait), **disabled_ports.describe()}
+
+async def _toggle_disabled_port(port: int, disabled: bool, restart: str = "auto"):
+    """把单个端口加入/移出禁用列表并立即应用，返回 FRPS 任务，None 表示无需变更"""
+    async with disabled_ports.lock:
+        if (port in disabled_ports.active) == disabled:
+            return None
+        if disabled:
+            ports = disabled_ports.changed(add=[(port, port)])
+        else:
+            ports = disabled_ports.changed(remove=[(port, port)])
+        return await _apply_disabled_ports(ports, restart=restart)
 
 @app.post("/api/frp/ports/disable")
 async def disable_port(
     port: int,
-    db: Session = Depends(get_db),
+    wait: bool = True,
+    restart: str = "auto",
     current_user: models.Admin = Depends(get_current_user)
 ):
-    # 1. 获取当前禁用列表
-    current_str = crud.get_config(db, models.ConfigKeys.DISABLED_PORTS) or ""
-    current_ports = [int(p) for p in current_str.split(",") if p.strip()]
+    _check_restart_mode(restart)
+    try:
+        job = await _toggle_disabled_port(port, True, restart)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     
-    # 2. 添加新端口
-    if port not in current_ports:
-        current_ports.append(port)
-        crud.set_config(db, models.ConfigKeys.DISABLED_PORTS, ",".join(map(str, current_ports)))
-        
-        # 3. 重新生成配置并重启
-        # 获取现有配置
-        frps_port = int(crud.get_config(db, models.ConfigKeys.FRPS_PORT) or 7000)
-        auth_token = crud.get_config(db, models.ConfigKeys.FRPS_AUTH_TOKEN)
-        server_ip = crud.get_config(db, models.ConfigKeys.SERVER_PUBLIC_IP)
-        
-        import frp_deploy
-        frp_deploy.generate_frps_config(frps_port, auth_token, server_ip, current_ports)
-        
-        return {"success": True, "message": f"端口 {port} 已禁用，FRPS 已重启"}
+    if job:
+        result = await _frps_job_result(job, wait)
+        return {**result, "message": f"端口 {port} 已禁用，{result['message']}"}
     
     return {"success": True, "message": f"端口 {port} 已经是禁用状态"}
 
 @app.post("/api/frp/ports/enable")
 async def enable_port(
     port: int,
-    db: Session = Depends(get_db),
+    wait: bool = True,
+    restart: str = "auto",
     current_user: models.Admin = Depends(get_current_user)
 ):
-    # 1. 获取当前禁用列表
-    current_str = crud.get_config(db, models.ConfigKeys.DISABLED_PORTS) or ""
-    current_ports = [int(p) for p in current_str.split(",") if p.strip()]
+    _check_restart_mode(restart)
+    try:
+        job = await _toggle_disabled_port(port, False, restart)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     
-    # 2. 移除端口
-    if port in current_ports:
-        current_ports.remove(port)
-        crud.set_config(db, models.ConfigKeys.DISABLED_PORTS, ",".join(map(str, current_ports)))
-        
-        # 3. 重新生成配置并重启
-        frps_port = int(crud.get_config(db, models.ConfigKeys.FRPS_PORT) or 7000)
-        auth_token = crud.get_config(db, models.ConfigKeys.FRPS_AUTH_TOKEN)
-        server_ip = crud.get_config(db, models.ConfigKeys.SERVER_PUBLIC_IP)
-        
-        import frp_deploy
-        frp_deploy.generate_frps_config(frps_port, auth_token, server_ip, current_ports)
-        
-        return {"success": True, "message": f"端口 {port} 已启用，FRPS 已重启"}
+    if job:
+        result = await _frps_job_result(job, wait)
+        return {**result, "message": f"端口 {port} 已启用，{result['message']}"}
     
     return {"success": True, "message": f"端口 {port} 未被禁用"}
+
 # FRPS 配置生成接口
 @app.post("/api/frp/deploy-server")
 async def deploy_frp_server(
     port: int = 7000,
     auth_token: str = None,
     server_ip: str = None,
-    db: Session = Depends(get_db),
+    wait: bool = True,
     current_user: models.Admin = Depends(get_current_user)
 ):
     """
-    生成 FRPS 配置文件
+    生成 FRPS 配置文件并重启 FRPS（后台任务）
     FRPS 本身由 docker-compose 管理，这里只生成配置
     
     Args:
         port: 监听端口
         auth_token: 认证 Token (可选，为空自动生成)
         server_ip: 公网 IP (可选，为空自动检测)
+        wait: 是否等待任务完成，为 False 时立即返回任务 id
     """
-    import frp_deploy
-    
-    # 生成配置（不再下载安装）
-    result = frp_deploy.generate_frps_config(port, auth_token, server_ip)
-    
-    if result["success"]:
+    async def _generate(job) -> dict:
+        job.log("生成 frps.toml")
+        # 沿用已有的 Dashboard 密码，配置没有其他变化时不需要重启 FRPS
+        dashboard_pwd = await run_db(crud.get_config, models.ConfigKeys.FRPS_DASHBOARD_PWD)
+        # 保留现有的禁用端口，否则重新生成的配置会丢失 allowPorts
+        loop = asyncio.get_running_loop()
+        result = await loop.run_in_executor(
+            None, frp_deploy.generate_frps_config,
+            port, auth_token, server_ip, disabled_ports.active, dashboard_pwd
+        )
+        if not result["success"]:
+            raise RuntimeError(result["message"])
+        job.config = result["content"]
         # 保存配置到数据库
         info = result["info"]
-        crud.set_config(db, models.ConfigKeys.FRPS_VERSION, info["version"])
-        crud.set_config(db, models.ConfigKeys.FRPS_PORT, str(info["port"]))
-        crud.set_config(db, models.ConfigKeys.FRPS_AUTH_TOKEN, info["auth_token"])
-        crud.set_config(db, models.ConfigKeys.SERVER_PUBLIC_IP, info["public_ip"])
-        crud.set_config(db, models.ConfigKeys.FRPS_DASHBOARD_PWD, info["dashboard_pwd"])
-    
-    return result
+
+        def _save(db: Session):
+            crud.set_config(db, models.ConfigKeys.FRPS_VERSION, info["version"])
+            crud.set_config(db, models.ConfigKeys.FRPS_PORT, str(info["port"]))
+            crud.set_config(db, models.ConfigKeys.FRPS_AUTH_TOKEN, info["auth_token"])
+            crud.set_config(db, models.ConfigKeys.SERVER_PUBLIC_IP, info["public_ip"])
+            crud.set_config(db, models.ConfigKeys.FRPS_DASHBOARD_PWD, info["dashboard_pwd"])
+
+        await write_db(_save)
+        port_allocator.set_frps_port(int(info["port"]))
+        return {"info": info}
+
+    async def _rollout(job) -> dict:
+        # FRPS 地址/端口/Token 可能已变化，所有在线 Agent 需要拿到新的 frpc.toml
+        config_cache.invalidate_all()
+        rollout = _start_config_rollout("frps settings changed")
+        job.log(f"开始向所有 Agent 下发新配置（{rollout.id}）")
+        return {"rollout_id": rollout.id}
+
+    # 随后会向所有 Agent 下发新配置，FRPS 必须先加载新配置，不能推迟重启
+    job = frps_jobs.submit("deploy", [_generate, RESTART, _rollout], restart_mode=RESTART_NOW)
+    if wait:
+        job = await frps_jobs.wait(job, FRPS_JOB_WAIT_TIMEOUT)
+    if not job.finished:
+        return {"success": True, "message": "FRPS 配置任务已提交，正在后台执行", "job": job.to_dict(logs=False)}
+    if "info" not in job.result:
+        return {"success": False, "message": job.error, "info": {}, "job": job.to_dict(logs=False)}
+    restarted = job.result.get("frps_restarted", False)
+    if job.error:
+        # 配置已写入但 FRPS 未能重启，没有向 Agent 下发新配置
+        message = f"FRPS 配置已生成，但重启失败，未下发 Agent 配置: {job.error}"
+    else:
+        message = "FRPS 配置已生成" + (" 并已重启" if restarted else "")
+    return {
+        "success": job.error is None,
+        "message": message,
+        "frps_restarted": restarted,
+        "restart_message": job.result.get("restart_message", ""),
+        "info": job.result["info"],
+        "rollout_id": job.result.get("rollout_id"),
+        "job": job.to_dict(logs=False),
+    }
 
 # 手动重启 FRPS
 @app.post("/api/frp/restart-frps")
 async def restart_frps(
+    wait: bool = True,
     current_user: models.Admin = Depends(get_current_user)
 ):
     """
-    手动重启 FRPS 容器
+    手动重启 FRPS 容器（后台任务），并发的重启请求合并为一次
     """
-    import subprocess
+    return await _frps_job_result(frps_jobs.restart("manual"), wait)
+
+@app.get("/api/frp/container")
+async def get_frps_container(current_user: models.Admin = Depends(get_current_user)):
+    """FRPS 容器的运行状态与健康检查结果（通过 Docker Engine API）"""
+    if not docker_client.available:
+        return {"success": False, "message": f"未挂载 Docker Socket ({docker_client.socket_path})"}
     try:
-        result = subprocess.run(
-            ["docker", "restart", "frps"],
-            check=False,
-            capture_output=True,
-            timeout=30,
-            text=True
-        )
-        if result.returncode == 0:
-            return {"success": True, "message": "FRPS 重启成功"}
-        else:
-            return {"success": False, "message": f"重启失败: {result.stderr.strip()}"}
-    except FileNotFoundError:
-        return {"success": False, "message": "未找到 docker 命令"}
-    except subprocess.TimeoutExpired:
-        return {"success": False, "message": "重启超时"}
-    except Exception as e:
+        return {"success": True, "container": await docker_client.state(FRPS_CONTAINER)}
+    except DockerError as e:
         return {"success": False, "message": str(e)}
 
+@app.get("/api/frp/jobs")
+async def list_frps_jobs(current_user: models.Admin = Depends(get_current_user)):
+    """最近的 FRPS 任务（生成配置、重启）"""
+    return {"jobs": frps_jobs.list(), **frps_jobs.get_stats()}
+
+@app.get("/api/frp/jobs/{job_id}")
+async def get_frps_job(job_id: str, current_user: models.Admin = Depends(get_current_user)):
+    """单个 FRPS 任务的状态、结果与日志"""
+    job = frps_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job.to_dict()
+
 # 已移除旧版“FRPC 客户端脚本生成”接口。
 # 当前系统统一使用 Go 版 frp-agent（WebSocket 双向）与 /api/agent/install-script/* 安装脚本。
 
@@ -1202,7 +2027,7 @@ async def get_available_agent_platforms():
 
 
 @app.get("/api/agent/install-script/{platform}")
-async def get_agent_install_script(
+def get_agent_install_script(
     platform: str,
     client_id: str = None,
     db: Session = Depends(get_db),
@@ -1225,7 +2050,14 @@ async def get_agent_install_script(
             raise HTTPException(status_code=404, detail="Client not found")
     else:
         suffix = str(int(time.time()))[-6:]
-        client = crud.create_client_with_token(db, name=f"device-{suffix}")
+
+        def _create_client(db: Session):
+            client = crud.create_client_with_token(db, name=f"device-{suffix}")
+            _undo_index(db, client_id=client.id)
+            tunnel_index.set_client(client.id, client.name)
+            return client
+
+        client = write_db_from_thread(_create_client)
     client_id = client.id
     client_token = client.auth_token
     
@@ -1580,7 +2412,7 @@ echo ""
 
 
 @app.get("/api/agent/install-script-info")
-async def get_install_script_info(db: Session = Depends(get_db)):
+def get_install_script_info(db: Session = Depends(get_db)):
     """获取安装脚本信息（用于前端显示）"""
     auth_token = crud.get_config(db, models.ConfigKeys.FRPS_AUTH_TOKEN) or "frp-token"
     server_ip = crud.get_config(db, models.ConfigKeys.SERVER_PUBLIC_IP) or "YOUR_SERVER_IP"
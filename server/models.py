@@ -44,6 +44,8 @@ class ConfigKeys:
     SERVER_PUBLIC_IP = "server_public_ip"  # 服务器公网 IP
     FRPS_DASHBOARD_PWD = "frps_dashboard_pwd"  # FRPS Dashboard API 密码
     DISABLED_PORTS = "disabled_ports"  # 禁用的端口列表，逗号分隔，如 "6001,6005"
+    ALERT_RULES = "alert_rules"        # 告警规则，JSON 数组
+    FRPS_RUNNING_CONFIG = "frps_running_config"  # FRPS 最近一次重启时加载的 frps.toml 内容
 
 class Tunnel(Base):
     __tablename__ = "tunnels"
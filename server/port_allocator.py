@@ -0,0 +1,219 @@
+"""
+远程端口分配索引
+TCP/UDP 各一张 65536 字节的端口位图（占用/禁用/保留三种标记），冲突检查为 O(1)，
+查找空闲端口直接在位图上做 C 层面的 bytearray.find；启动时从 tunnels 表加载，之后随隧道增删改同步更新
+"""
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+import os
+import threading
+import logging
+
+import crud
+import models
+from port_ranges import PortRangeSet
+
+logger = logging.getLogger(__name__)
+
+PROTOCOLS = ("tcp", "udp")
+
+# 自动分配端口的默认范围
+PORT_ALLOC_START = int(os.environ.get("PORT_ALLOC_START", "10000"))
+PORT_ALLOC_END = int(os.environ.get("PORT_ALLOC_END", "60000"))
+
+# FRPS Dashboard 端口（见 frp_deploy.generate_frps_config）
+FRPS_DASHBOARD_PORT = 7500
+
+IN_USE = 1
+DISABLED = 2
+RESERVED = 4
+
+# 按区间整段设置/清除 DISABLED 标记（bytes.translate 在 C 层面逐字节映射）
+_SET_DISABLED = bytes(b | DISABLED for b in range(256))
+_CLEAR_DISABLED = bytes(b & ~DISABLED for b in range(256))
+
+Claim = Tuple[str, int]  # (协议, 端口)
+
+
+class PortConflict(ValueError):
+    def __init__(self, proto: str, port: int, reason: str):
+        super().__init__(f"Remote port {port}/{proto} {reason}")
+        self.proto = proto
+        self.port = port
+        self.reason = reason
+
+
+def claim_of(tunnel) -> Optional[Claim]:
+    """隧道当前占用的远程端口，未启用或不是 TCP/UDP 隧道时为 None"""
+    proto = tunnel.type.value if hasattr(tunnel.type, "value") else str(tunnel.type)
+    if proto not in PROTOCOLS or not tunnel.enabled or not tunnel.remote_port:
+        return None
+    port = int(tunnel.remote_port)
+    return (proto, port) if 0 < port < 65536 else None
+
+
+class PortAllocator:
+    """
+    远程端口索引
+    检查与写入隧道的整个过程应持有 lock，保证检查结果在事务提交前不会失效
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self._reset()
+
+    def _reset(self):
+        self._flags: Dict[str, bytearray] = {p: bytearray(65536) for p in PROTOCOLS}
+        self._owners: Dict[Claim, Set[int]] = {}   # 端口 -> 占用的隧道（历史数据可能有多个）
+        self._claims: Dict[int, Claim] = {}        # 隧道 -> 端口
+        self._disabled = PortRangeSet()
+        self._reserved: Set[Claim] = set()
+        self.conflicts_at_load = 0
+
+    def load(self, db):
+        """从数据库重建索引"""
+        with self.lock:
+            self._reset()
+            rows = db.query(models.Tunnel.id, models.Tunnel.type, models.Tunnel.enabled, models.Tunnel.remote_port)
+            for row in rows:
+                claim = claim_of(row)
+                if claim is None:
+                    continue
+                if claim in self._owners:
+                    self.conflicts_at_load += 1
+                self._claim(row.id, claim)
+            disabled = PortRangeSet.parse(crud.get_config(db, models.ConfigKeys.DISABLED_PORTS))
+            self.set_disabled(disabled)
+            self.set_frps_port(int(crud.get_config(db, models.ConfigKeys.FRPS_PORT) or 7000))
+        if self.conflicts_at_load:
+            logger.warning(f"已有 {self.conflicts_at_load} 个隧道的远程端口与其他隧道冲突")
+
+    # ========================
+    # 更新
+    # ========================
+
+    def _claim(self, tunnel_id: int, claim: Claim):
+        self._claims[tunnel_id] = claim
+        self._owners.setdefault(claim, set()).add(tunnel_id)
+        self._flags[claim[0]][claim[1]] |= IN_USE
+
+    def _release(self, tunnel_id: int):
+        claim = self._claims.pop(tunnel_id, None)
+        if claim is None:
+            return
+        owners = self._owners[claim]
+        owners.discard(tunnel_id)
+        if not owners:
+            del self._owners[claim]
+            self._flags[claim[0]][claim[1]] &= ~IN_USE
+
+    def set_tunnel(self, tunnel_id: int, claim: Optional[Claim]):
+        """隧道创建或修改后更新占用（claim 为 None 表示不再占用端口）"""
+        with self.lock:
+            if self._claims.get(tunnel_id) == claim:
+                return
+            self._release(tunnel_id)
+            if claim is not None:
+                self._claim(tunnel_id, claim)
+
+    def remove_tunnel(self, tunnel_id: int):
+        with self.lock:
+            self._release(tunnel_id)
+
+    def claim(self, tunnel_id: int) -> Optional[Claim]:
+        """隧道当前在索引中的占用"""
+        return self._claims.get(tunnel_id)
+
+    def set_disabled(self, ports: PortRangeSet):
+        """替换禁用端口集合（对 TCP 和 UDP 都生效），按区间更新位图，代价与区间数成正比"""
+        with self.lock:
+            for flags in self._flags.values():
+                for start, end in self._disabled.ranges():
+                    flags[start:end + 1] = flags[start:end + 1].translate(_CLEAR_DISABLED)
+                for start, end in ports.ranges():
+                    flags[start:end + 1] = flags[start:end + 1].translate(_SET_DISABLED)
+            self._disabled = ports.copy()
+
+    def set_frps_port(self, port: int):
+        """FRPS 自身监听的端口（bindPort 与 Dashboard）不能分配给隧道"""
+        with self.lock:
+            for proto, p in self._reserved:
+                self._flags[proto][p] &= ~RESERVED
+            self._reserved = {("tcp", port), ("tcp", FRPS_DASHBOARD_PORT)}
+            for proto, p in self._reserved:
+                self._flags[proto][p] |= RESERVED
+
+    # ========================
+    # 查询
+    # ========================
+
+    def conflict(self, claim: Claim, tunnel_id: int = None, ignore: Set[int] = frozenset()) -> Optional[str]:
+        """端口不可用时返回原因；tunnel_id 与 ignore 中隧道自身的占用不算冲突"""
+        proto, port = claim
+        flags = self._flags[proto][port]
+        if not flags:
+            return None
+        if flags & DISABLED:
+            return "is disabled"
+        if flags & RESERVED:
+            return "is reserved by frps"
+        others = self._owners[claim] - {tunnel_id} - ignore
+        if others:
+            return f"is already in use by tunnel {min(others)}"
+        return None
+
+    def check(self, claim: Optional[Claim], tunnel_id: int = None):
+        """端口不可用时抛出 PortConflict"""
+        if claim is None:
+            return
+        reason = self.conflict(claim, tunnel_id)
+        if reason:
+            raise PortConflict(claim[0], claim[1], reason)
+
+    def check_batch(self, claims: Dict[int, Optional[Claim]]) -> Optional[Tuple[int, PortConflict]]:
+        """
+        校验一批隧道的最终占用 {tunnel_id: claim}，返回第一个冲突 (tunnel_id, PortConflict)
+        批次内隧道原来的占用视为已释放
+        """
+        seen: Dict[Claim, int] = {}
+        batch = set(claims)
+        for tunnel_id, claim in claims.items():
+            if claim is None:
+                continue
+            if claim in seen:
+                return tunnel_id, PortConflict(claim[0], claim[1], f"is already in use by tunnel {seen[claim]}")
+            seen[claim] = tunnel_id
+            reason = self.conflict(claim, tunnel_id, ignore=batch)
+            if reason:
+                return tunnel_id, PortConflict(claim[0], claim[1], reason)
+        return None
+
+    def find_free(self, proto: str, count: int = 1, start: int = None, end: int = None,
+                  exclude: Iterable[int] = ()) -> List[int]:
+        """在 [start, end] 内按从小到大找 count 个空闲端口（不占用），不足时返回找到的部分"""
+        start = max(1, PORT_ALLOC_START if start is None else start)
+        end = min(65535, PORT_ALLOC_END if end is None else end)
+        exclude = set(exclude)
+        flags = self._flags[proto]
+        result = []
+        pos = start
+        while len(result) < count and pos <= end:
+            pos = flags.find(0, pos, end + 1)
+            if pos < 0:
+                break
+            if pos not in exclude:
+                result.append(pos)
+            pos += 1
+        return result
+
+    def get_stats(self) -> dict:
+        return {
+            "in_use": {p: sum(1 for c in self._owners if c[0] == p) for p in PROTOCOLS},
+            "disabled": len(self._disabled),
+            "reserved": sorted(f"{p}/{proto}" for proto, p in self._reserved),
+            "conflicting_ports": sum(1 for owners in self._owners.values() if len(owners) > 1),
+            "conflicts_at_load": self.conflicts_at_load,
+        }
+
+
+# 全局端口分配索引实例
+port_allocator = PortAllocator()
@@ -0,0 +1,188 @@
+"""
+禁用端口的区间集合
+禁用端口以规范化（有序、互不重叠、相邻合并）的区间列表保存，配置中存为 "6000-6999,7001"，
+兼容旧的逐个端口逗号列表；修改先暂存，确认后一次性写入 frps.toml 并只重启一次 FRPS
+"""
+from bisect import bisect_left, bisect_right
+import asyncio
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+import crud
+import models
+
+PORT_MIN = 1
+PORT_MAX = 65535
+
+
+class PortRangeSet:
+    """端口区间集合，成员检查 O(log n)"""
+
+    __slots__ = ("_starts", "_ends")
+
+    def __init__(self, ranges: Iterable[Tuple[int, int]] = ()):
+        self._starts: List[int] = []
+        self._ends: List[int] = []
+        for start, end in ranges:
+            self.add(start, end)
+
+    @classmethod
+    def parse(cls, text: Optional[str]) -> "PortRangeSet":
+        """解析 "6000-6999,7001"，无效的片段抛出 ValueError"""
+        result = cls()
+        for part in (text or "").split(","):
+            part = part.strip()
+            if not part:
+                continue
+            start, _, end = part.partition("-")
+            result.add(int(start), int(end or start))
+        return result
+
+    @staticmethod
+    def _check(start: int, end: int):
+        if not PORT_MIN <= start <= end <= PORT_MAX:
+            raise ValueError(f"无效的端口区间: {start}-{end}")
+
+    def add(self, start: int, end: int):
+        self._check(start, end)
+        # 与 [start, end] 重叠或相邻的区间为 [i, j)
+        i = bisect_left(self._ends, start - 1)
+        j = bisect_right(self._starts, end + 1)
+        if i < j:
+            start = min(start, self._starts[i])
+            end = max(end, self._ends[j - 1])
+        self._starts[i:j] = [start]
+        self._ends[i:j] = [end]
+
+    def remove(self, start: int, end: int):
+        self._check(start, end)
+        # 与 [start, end] 重叠的区间为 [i, j)，两端可能各剩下一段
+        i = bisect_left(self._ends, start)
+        j = bisect_right(self._starts, end)
+        if i >= j:
+            return
+        starts, ends = [], []
+        if self._starts[i] < start:
+            starts.append(self._starts[i])
+            ends.append(start - 1)
+        if self._ends[j - 1] > end:
+            starts.append(end + 1)
+            ends.append(self._ends[j - 1])
+        self._starts[i:j] = starts
+        self._ends[i:j] = ends
+
+    def __contains__(self, port: int) -> bool:
+        i = bisect_right(self._starts, port) - 1
+        return i >= 0 and self._ends[i] >= port
+
+    def __len__(self) -> int:
+        """集合中的端口数"""
+        return sum(e - s + 1 for s, e in zip(self._starts, self._ends))
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, PortRangeSet) and self._starts == other._starts and self._ends == other._ends
+
+    def __str__(self) -> str:
+        return ",".join(str(s) if s == e else f"{s}-{e}" for s, e in zip(self._starts, self._ends))
+
+    def issubset(self, other: "PortRangeSet") -> bool:
+        """集合中的每个区间都落在 other 的某个区间内"""
+        for start, end in zip(self._starts, self._ends):
+            i = bisect_right(other._starts, start) - 1
+            if i < 0 or other._ends[i] < end:
+                return False
+        return True
+
+    def ranges(self) -> List[Tuple[int, int]]:
+        return list(zip(self._starts, self._ends))
+
+    def ports(self) -> Iterator[int]:
+        for start, end in zip(self._starts, self._ends):
+            yield from range(start, end + 1)
+
+    def copy(self) -> "PortRangeSet":
+        result = PortRangeSet()
+        result._starts = list(self._starts)
+        result._ends = list(self._ends)
+        return result
+
+    def complement(self, lo: int = PORT_MIN, hi: int = PORT_MAX) -> "PortRangeSet":
+        """[lo, hi] 中不在集合内的端口"""
+        result = PortRangeSet()
+        pos = lo
+        for start, end in zip(self._starts, self._ends):
+            if start > pos:
+                result._starts.append(pos)
+                result._ends.append(min(start - 1, hi))
+            pos = max(pos, end + 1)
+            if pos > hi:
+                break
+        if pos <= hi:
+            result._starts.append(pos)
+            result._ends.append(hi)
+        return result
+
+
+class DisabledPorts:
+    """
+    当前生效的禁用端口与尚未应用的暂存修改
+    暂存的是操作序列而不是结果，单个端口的即时修改生效后，暂存结果会基于新的集合重新计算
+    """
+
+    def __init__(self):
+        self.active = PortRangeSet()
+        self._staged_ops: List[Tuple[bool, int, int]] = []  # (是否禁用, 起始, 结束)
+        self.lock = asyncio.Lock()  # 保存修改（并提交 FRPS 任务）时互斥
+
+    def load(self, db):
+        self.active = PortRangeSet.parse(crud.get_config(db, models.ConfigKeys.DISABLED_PORTS))
+        self._staged_ops = []
+
+    @staticmethod
+    def _replay(base: PortRangeSet, ops) -> PortRangeSet:
+        result = base.copy()
+        for disable, start, end in ops:
+            if disable:
+                result.add(start, end)
+            else:
+                result.remove(start, end)
+        return result
+
+    @property
+    def staged(self) -> Optional[PortRangeSet]:
+        return self._replay(self.active, self._staged_ops) if self._staged_ops else None
+
+    def changed(self, add: Iterable[Tuple[int, int]] = (), remove: Iterable[Tuple[int, int]] = ()) -> PortRangeSet:
+        """当前生效集合先加后删后的结果（不修改任何状态），区间无效时抛出 ValueError"""
+        ops = [(True, s, e) for s, e in add] + [(False, s, e) for s, e in remove]
+        return self._replay(self.active, ops)
+
+    def stage(self, add: Iterable[Tuple[int, int]] = (), remove: Iterable[Tuple[int, int]] = ()) -> PortRangeSet:
+        """暂存修改并返回暂存结果；区间无效时抛出 ValueError 且不修改暂存"""
+        ops = self._staged_ops + [(True, s, e) for s, e in add] + [(False, s, e) for s, e in remove]
+        staged = self._replay(self.active, ops)
+        self._staged_ops = ops
+        return staged
+
+    def discard(self):
+        self._staged_ops = []
+
+    @property
+    def staged_count(self) -> int:
+        return len(self._staged_ops)
+
+    def save(self, db, ports: PortRangeSet, consumed: int = 0):
+        """写入数据库并设为当前生效集合，consumed 为已包含在 ports 中的暂存操作数"""
+        crud.set_config(db, models.ConfigKeys.DISABLED_PORTS, str(ports))
+        self.active = ports
+        self._staged_ops = self._staged_ops[consumed:]
+
+    def describe(self) -> dict:
+        result = {"ranges": str(self.active), "count": len(self.active), "staged": None}
+        staged = self.staged
+        if staged is not None:
+            result["staged"] = {"ranges": str(staged), "count": len(staged), "operations": len(self._staged_ops)}
+        return result
+
+
+# 全局禁用端口实例
+disabled_ports = DisabledPorts()
@@ -0,0 +1,108 @@
+"""
+配置推送调度
+隧道/客户端变更后不立即推送，而是按客户端防抖：窗口内的多次变更合并为一次推送，
+推送时重新渲染最新状态；持续变更时最迟 CONFIG_PUSH_MAX_DELAY 秒也会推送一次
+"""
+from collections import deque
+from typing import Awaitable, Callable, Dict, Optional
+import asyncio
+import os
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+CONFIG_PUSH_DEBOUNCE = float(os.environ.get("CONFIG_PUSH_DEBOUNCE", "0.5"))
+CONFIG_PUSH_MAX_DELAY = float(os.environ.get("CONFIG_PUSH_MAX_DELAY", "3"))
+
+# 保留最近多少次推送的延迟用于统计
+LATENCY_SAMPLES = 1000
+
+
+class _Pending:
+    __slots__ = ("first", "last", "mutations")
+
+    def __init__(self, now: float):
+        self.first = now      # 第一次变更时间
+        self.last = now       # 最近一次变更时间
+        self.mutations = 1
+
+
+class PushScheduler:
+    """按客户端防抖合并配置推送"""
+
+    def __init__(self, debounce: float = CONFIG_PUSH_DEBOUNCE, max_delay: float = CONFIG_PUSH_MAX_DELAY):
+        self.debounce = debounce
+        self.max_delay = max(max_delay, debounce)
+        # 实际执行推送的协程函数 push(client_id) -> bool，由 main 注入
+        self.pusher: Optional[Callable[[str], Awaitable[bool]]] = None
+        self._pending: Dict[str, _Pending] = {}
+        self._tasks: Dict[str, asyncio.Task] = {}
+        self._latencies = deque(maxlen=LATENCY_SAMPLES)
+        self.mutations = 0
+        self.pushes = 0
+        self.coalesced = 0     # 被合并掉的变更数
+        self.undelivered = 0   # Agent 不在线等原因未能送达（Agent 上线注册时会拿到最新配置）
+
+    def schedule(self, client_id: str):
+        """记录一次变更，在防抖窗口结束后推送该客户端的最新配置"""
+        now = time.monotonic()
+        self.mutations += 1
+        pending = self._pending.get(client_id)
+        if pending is None:
+            self._pending[client_id] = _Pending(now)
+        else:
+            pending.last = now
+            pending.mutations += 1
+        if client_id not in self._tasks:
+            self._tasks[client_id] = asyncio.create_task(self._run(client_id))
+
+    async def _run(self, client_id: str):
+        try:
+            while True:
+                pending = self._pending[client_id]
+                due = min(pending.last + self.debounce, pending.first + self.max_delay)
+                delay = due - time.monotonic()
+                if delay <= 0:
+                    break
+                await asyncio.sleep(delay)
+            # 推送期间的新变更会开启下一轮调度
+            del self._pending[client_id]
+        finally:
+            self._tasks.pop(client_id, None)
+
+        self.coalesced += pending.mutations - 1
+        try:
+            ok = await self.pusher(client_id)
+        except Exception as e:
+            logger.warning(f"推送配置到 Agent {client_id} 失败: {e}")
+            ok = False
+        if ok:
+            self.pushes += 1
+            self._latencies.append(time.monotonic() - pending.first)
+        else:
+            self.undelivered += 1
+
+    def get_stats(self) -> dict:
+        latencies = sorted(self._latencies)
+
+        def percentile(q: float) -> Optional[float]:
+            if not latencies:
+                return None
+            return round(latencies[min(len(latencies) - 1, int(q * len(latencies)))] * 1000, 1)
+
+        return {
+            "pending_clients": len(self._pending),
+            "pending_mutations": sum(p.mutations for p in self._pending.values()),
+            "mutations": self.mutations,
+            "pushes": self.pushes,
+            "undelivered": self.undelivered,
+            "coalesced": self.coalesced,
+            "latency_ms": {"p50": percentile(0.5), "p95": percentile(0.95), "max": percentile(1.0)},
+            "debounce_seconds": self.debounce,
+            "max_delay_seconds": self.max_delay,
+        }
+
+
+# 全局配置推送调度实例
+push_scheduler = PushScheduler()
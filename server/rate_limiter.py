@@ -0,0 +1,154 @@
+"""
+Agent 入站限流
+按 (客户端, 消息类型) 维护令牌桶，超出速率的消息直接丢弃，
+并通过 throttle 控制消息通知 Agent 暂停发送，避免单个节点拖垮整个事件循环
+"""
+from typing import Dict, Optional, Tuple
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+# 消息类型 -> (每秒速率, 桶容量)
+# system_info 正常每 3 秒一条，log 允许短时突发
+# register 每次重连发送一次，Agent 重连间隔至少 3 秒；
+# 帧开头找不到已知 type 的消息记为 unknown，在完整解码前单独限流
+UNKNOWN_TYPE = "unknown"
+DEFAULT_LIMITS: Dict[str, Tuple[float, float]] = {
+    "register": (0.5, 3),
+    "system_info": (1.0, 5),
+    "log": (200.0, 1000),
+    "frpc_status": (2.0, 10),
+    "config_ack": (2.0, 10),
+    "pong": (1.0, 5),
+    UNKNOWN_TYPE: (5.0, 20),
+}
+
+# 同一客户端同一类型的 throttle 通知最短间隔（秒）
+THROTTLE_NOTICE_INTERVAL = 5.0
+
+
+class TokenBucket:
+    """经典令牌桶，按调用时刻惰性补充令牌"""
+
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def consume(self, now: float, amount: float = 1.0) -> bool:
+        elapsed = now - self.updated
+        if elapsed > 0:
+            self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+            self.updated = now
+        if self.tokens >= amount:
+            self.tokens -= amount
+            return True
+        return False
+
+    def retry_after(self, amount: float = 1.0) -> float:
+        """距离下一次可用还需等待的秒数"""
+        if self.tokens >= amount or self.rate <= 0:
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+
+class AgentStats:
+    __slots__ = ("allowed", "dropped", "throttle_notices", "last_notice")
+
+    def __init__(self):
+        self.allowed: Dict[str, int] = {}
+        self.dropped: Dict[str, int] = {}
+        self.throttle_notices = 0
+        self.last_notice: Dict[str, float] = {}
+
+
+class AgentRateLimiter:
+    """每个 Agent、每种消息类型一个令牌桶"""
+
+    def __init__(self, limits: Dict[str, Tuple[float, float]] = None):
+        self.limits = dict(DEFAULT_LIMITS if limits is None else limits)
+        self._buckets: Dict[Tuple[str, str], TokenBucket] = {}
+        self._stats: Dict[str, AgentStats] = {}
+
+    def _bucket(self, client_id: str, msg_type: str) -> Optional[TokenBucket]:
+        key = (client_id, msg_type)
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            limit = self.limits.get(msg_type)
+            if limit is None:
+                return None
+            bucket = self._buckets[key] = TokenBucket(*limit)
+        return bucket
+
+    def _agent_stats(self, client_id: str) -> AgentStats:
+        stats = self._stats.get(client_id)
+        if stats is None:
+            stats = self._stats[client_id] = AgentStats()
+        return stats
+
+    def allow(self, client_id: str, msg_type: str) -> bool:
+        """消耗一个令牌，返回该消息是否放行（未配置限额的类型总是放行）"""
+        bucket = self._bucket(client_id, msg_type)
+        stats = self._agent_stats(client_id)
+        if bucket is None or bucket.consume(time.monotonic()):
+            stats.allowed[msg_type] = stats.allowed.get(msg_type, 0) + 1
+            return True
+        stats.dropped[msg_type] = stats.dropped.get(msg_type, 0) + 1
+        return False
+
+    def throttle_notice(self, client_id: str, msg_type: str) -> Optional[dict]:
+        """
+        消息被丢弃后调用：需要通知 Agent 时返回 throttle 控制消息，
+        否则返回 None（同类型通知按 THROTTLE_NOTICE_INTERVAL 去重）
+        """
+        stats = self._agent_stats(client_id)
+        now = time.monotonic()
+        if now - stats.last_notice.get(msg_type, float("-inf")) < THROTTLE_NOTICE_INTERVAL:
+            return None
+        stats.last_notice[msg_type] = now
+        stats.throttle_notices += 1
+
+        bucket = self._bucket(client_id, msg_type)
+        rate, capacity = self.limits[msg_type]
+        return {
+            "type": "throttle",
+            "data": {
+                "message_type": msg_type,
+                "rate": rate,
+                "burst": capacity,
+                # 等桶恢复到一半容量再继续发送，避免 Agent 在临界点反复触发限流
+                "retry_after": round(max(bucket.retry_after(capacity / 2), 1.0), 3),
+                "dropped": stats.dropped.get(msg_type, 0),
+            },
+        }
+
+    def retain(self, client_ids):
+        """
+        只保留仍存在的客户端的令牌桶与计数。
+        断开连接时不清理：否则 Agent 重连即可重置限额，按 Agent 统计的丢弃数也会丢失
+        """
+        for key in [k for k in self._buckets if k[0] not in client_ids]:
+            del self._buckets[key]
+        for client_id in [c for c in self._stats if c not in client_ids]:
+            del self._stats[client_id]
+
+    def get_stats(self, client_id: str = None) -> dict:
+        def _one(stats: AgentStats) -> dict:
+            return {
+                "allowed": dict(stats.allowed),
+                "dropped": dict(stats.dropped),
+                "throttle_notices": stats.throttle_notices,
+            }
+
+        if client_id is not None:
+            stats = self._stats.get(client_id)
+            return _one(stats) if stats else _one(AgentStats())
+        return {cid: _one(stats) for cid, stats in self._stats.items()}
+
+
+# 全局限流器实例
+rate_limiter = AgentRateLimiter()
@@ -1,5 +1,5 @@
 from pydantic import BaseModel
-from typing import List, Optional
+from typing import List, Literal, Optional, Tuple
 from enum import Enum
 
 class TunnelType(str, Enum):
@@ -20,6 +20,28 @@ class TunnelBase(BaseModel):
 class TunnelCreate(TunnelBase):
     pass
 
+class TunnelUpdate(BaseModel):
+    """批量修改隧道时只包含需要修改的字段"""
+    name: Optional[str] = None
+    type: Optional[TunnelType] = None
+    enabled: Optional[bool] = None
+    local_ip: Optional[str] = None
+    local_port: Optional[int] = None
+    remote_port: Optional[int] = None
+    custom_domains: Optional[str] = None
+
+class TunnelBatchOp(BaseModel):
+    op: Literal["create", "update", "delete"]
+    client_id: str
+    tunnel_id: Optional[int] = None          # update / delete
+    tunnel: Optional[TunnelCreate] = None    # create
+    changes: Optional[TunnelUpdate] = None   # update
+    allocate_port: bool = False              # create: 未指定 remote_port 时自动分配空闲端口
+
+class TunnelBatch(BaseModel):
+    operations: List[TunnelBatchOp]
+    port_range: Optional[Tuple[int, int]] = None  # 自动分配端口的范围，默认见 port_allocator
+
 class Tunnel(TunnelBase):
     id: int
     client_id: str
@@ -53,3 +75,13 @@ class TokenData(BaseModel):
 class UserCreate(BaseModel):
     username: str
     password: str
+
+class AlertRule(BaseModel):
+    id: str
+    name: str
+    kind: Literal["threshold", "rate", "offline"] = "threshold"
+    metric: Optional[str] = None      # threshold / rate 规则使用的 system_info 字段
+    op: Literal[">", ">=", "<", "<="] = ">="
+    value: float = 0                  # 阈值（rate 规则为每秒变化量）
+    for_seconds: float = 0            # 条件持续多久才触发（offline 规则为静默时长）
+    enabled: bool = True
@@ -0,0 +1,359 @@
+"""
+全舰队隧道唯一性索引
+frps 中代理名（客户端名.隧道名）与自定义域名都必须全局唯一，重复的会被 frps 静默拒绝。
+索引在内存中维护 代理名 -> 隧道、域名 -> 隧道、客户端名 -> 客户端，每次隧道修改的校验为 O(1)；
+远程端口由 port_allocator 负责，两者共用同一把锁，校验与写库在同一个临界区内完成
+"""
+from typing import Dict, Iterable, Optional, Set, Tuple
+import logging
+
+import models
+from port_allocator import port_allocator, claim_of
+
+logger = logging.getLogger(__name__)
+
+# (客户端 ID, 隧道名, 占用的域名)，隧道名为 None 表示不校验名称，域名为 None 表示不校验域名
+Entry = Tuple[str, Optional[str], Optional[Tuple[str, ...]]]
+
+
+class TunnelConflict(ValueError):
+    def __init__(self, kind: str, value: str, reason: str):
+        super().__init__(f"{kind} {value} {reason}")
+        self.kind = kind
+        self.value = value
+        self.reason = reason
+
+
+def client_key(name: Optional[str]) -> str:
+    """客户端名在代理名中的形式（与渲染 frpc.toml 时的清洗方式一致）"""
+    return (name or "unknown").replace('"', '').strip()
+
+
+def tunnel_key(name: Optional[str], tunnel_id: int = None) -> str:
+    return (name or f"tun_{tunnel_id}").replace('"', '').strip()
+
+
+def proxy_name(client_name: Optional[str], tunnel_name: Optional[str], tunnel_id: int = None) -> str:
+    """frpc.toml 中的代理名"""
+    return f"{client_key(client_name)}.{tunnel_key(tunnel_name, tunnel_id)}"
+
+
+def split_domains(custom_domains: Optional[str]) -> Tuple[str, ...]:
+    return tuple(d.strip() for d in (custom_domains or "").split(",") if d.strip())
+
+
+def domains_of(tunnel) -> Tuple[str, ...]:
+    """隧道当前占用的自定义域名（未启用的隧道不会下发给 frpc，不占用）"""
+    if not tunnel.enabled:
+        return ()
+    return tuple(sorted({d.lower() for d in split_domains(tunnel.custom_domains)}))
+
+
+def entry_of(tunnel, client_id: str = None) -> Entry:
+    """tunnel 可以是 models.Tunnel 或尚未写库的 schemas.TunnelCreate（此时需要传入 client_id）"""
+    return (client_id or tunnel.client_id, tunnel_key(tunnel.name, getattr(tunnel, "id", None)), domains_of(tunnel))
+
+
+class TunnelIndex:
+    """
+    代理名、自定义域名与客户端名索引
+    检查与写入的整个过程应持有 lock（即 port_allocator.lock）
+    """
+
+    def __init__(self):
+        self.lock = port_allocator.lock
+        self._reset()
+
+    def _reset(self):
+        self._client_names: Dict[str, str] = {}          # 客户端 -> 清洗后的名称
+        self._clients_by_name: Dict[str, Set[str]] = {}  # 名称 -> 客户端（历史数据可能重名）
+        self._client_tunnels: Dict[str, Set[int]] = {}   # 客户端 -> 隧道
+        self._tunnels: Dict[int, Tuple[str, str, Tuple[str, ...]]] = {}  # 隧道 -> (客户端, 隧道名, 域名)
+        self._proxies: Dict[str, Set[int]] = {}          # 代理名 -> 隧道
+        self._domains: Dict[str, Set[int]] = {}          # 域名 -> 隧道
+        self.conflicts_at_load = 0
+
+    def load(self, db):
+        """从数据库重建索引"""
+        with self.lock:
+            self._reset()
+            for client_id, name in db.query(models.Client.id, models.Client.name):
+                self._set_client_name(client_id, client_key(name))
+            rows = db.query(models.Tunnel.id, models.Tunnel.client_id, models.Tunnel.name,
+                            models.Tunnel.enabled, models.Tunnel.custom_domains)
+            for row in rows:
+                self._add(row.id, entry_of(row))
+            self.conflicts_at_load = (
+                sum(1 for t in self._proxies.values() if len(t) > 1)
+                + sum(1 for t in self._domains.values() if len(t) > 1)
+                + sum(1 for c in self._clients_by_name.values() if len(c) > 1)
+            )
+        if self.conflicts_at_load:
+            logger.warning(f"已有 {self.conflicts_at_load} 个代理名/域名/客户端名重复")
+
+    # ========================
+    # 更新
+    # ========================
+
+    def _proxy(self, client_id: str, key: str) -> str:
+        return f"{self._client_names.get(client_id, 'unknown')}.{key}"
+
+    def _set_client_name(self, client_id: str, name: str):
+        old = self._client_names.get(client_id)
+        if old is not None:
+            owners = self._clients_by_name[old]
+            owners.discard(client_id)
+            if not owners:
+                del self._clients_by_name[old]
+        self._client_names[client_id] = name
+        self._clients_by_name.setdefault(name, set()).add(client_id)
+
+    def _add(self, tunnel_id: int, entry: Entry):
+        client_id, key, domains = entry
+        self._tunnels[tunnel_id] = (client_id, key, domains)
+        self._client_tunnels.setdefault(client_id, set()).add(tunnel_id)
+        self._proxies.setdefault(self._proxy(client_id, key), set()).add(tunnel_id)
+        for domain in domains:
+            self._domains.setdefault(domain, set()).add(tunnel_id)
+
+    @staticmethod
+    def _discard(index: Dict[str, Set[int]], value: str, tunnel_id: int):
+        owners = index.get(value)
+        if owners is not None:
+            owners.discard(tunnel_id)
+            if not owners:
+                del index[value]
+
+    def _remove(self, tunnel_id: int):
+        record = self._tunnels.pop(tunnel_id, None)
+        if record is None:
+            return
+        client_id, key, domains = record
+        self._client_tunnels[client_id].discard(tunnel_id)
+        self._discard(self._proxies, self._proxy(client_id, key), tunnel_id)
+        for domain in domains:
+            self._discard(self._domains, domain, tunnel_id)
+
+    def set_client(self, client_id: str, name: Optional[str]):
+        """客户端创建或改名后更新（其所有隧道的代理名随之改变）"""
+        with self.lock:
+            name = client_key(name)
+            if self._client_names.get(client_id) == name:
+                return
+            tunnels = [(t, self._tunnels[t]) for t in self._client_tunnels.get(client_id, ())]
+            for tunnel_id, _ in tunnels:
+                self._remove(tunnel_id)
+            self._set_client_name(client_id, name)
+            for tunnel_id, record in tunnels:
+                self._add(tunnel_id, record)
+
+    def set_tunnel(self, tunnel, client_id: str = None):
+        """隧道创建或修改后更新"""
+        with self.lock:
+            self._remove(tunnel.id)
+            self._add(tunnel.id, entry_of(tunnel, client_id))
+
+    def remove_tunnel(self, tunnel_id: int):
+        with self.lock:
+            self._remove(tunnel_id)
+
+    def snapshot(self, tunnel_ids: Iterable[int] = (), client_id: str = None):
+        """隧道与客户端名在索引中的当前状态（含端口占用），写入回滚时交给 restore() 恢复"""
+        with self.lock:
+            tunnels = {t: (self._tunnels.get(t), port_allocator.claim(t)) for t in tunnel_ids}
+            return tunnels, client_id, self._client_names.get(client_id)
+
+    def restore(self, state):
+        """恢复 snapshot() 时的状态，之后对这些隧道和客户端名的修改全部丢弃"""
+        tunnels, client_id, name = state
+        with self.lock:
+            if client_id is not None:
+                if name is not None:
+                    self.set_client(client_id, name)
+                elif client_id in self._client_names:
+                    # 快照时还没有这个客户端
+                    current = self._client_names.pop(client_id)
+                    owners = self._clients_by_name[current]
+                    owners.discard(client_id)
+                    if not owners:
+                        del self._clients_by_name[current]
+            for tunnel_id, (record, claim) in tunnels.items():
+                self._remove(tunnel_id)
+                if record is not None:
+                    self._add(tunnel_id, record)
+                port_allocator.set_tunnel(tunnel_id, claim)
+
+    # ========================
+    # 查询
+    # ========================
+
+    @staticmethod
+    def _others(owners: Optional[Set[int]], tunnel_id: Optional[int], ignore: Set[int]) -> list:
+        return [t for t in owners or () if t != tunnel_id and t not in ignore]
+
+    def conflict(self, entry: Entry, tunnel_id: int = None,
+                 ignore: Set[int] = frozenset()) -> Optional[TunnelConflict]:
+        """隧道最终状态为 entry 时的第一个冲突；tunnel_id 与 ignore 中隧道自身的占用不算冲突"""
+        client_id, key, domains = entry
+        if key is not None:
+            name = self._proxy(client_id, key)
+            others = self._others(self._proxies.get(name), tunnel_id, ignore)
+            if others:
+                return TunnelConflict("Proxy name", name, f"is already used by tunnel {min(others)}")
+        for domain in domains or ():
+            others = self._others(self._domains.get(domain), tunnel_id, ignore)
+            if others:
+                return TunnelConflict("Custom domain", domain, f"is already used by tunnel {min(others)}")
+        return None
+
+    def check(self, tunnel, client_id: str = None, tunnel_id: int = None, check_name: bool = True):
+        """校验单个隧道（代理名、域名与远程端口），冲突时抛出 TunnelConflict 或 PortConflict"""
+        client_id, key, domains = entry_of(tunnel, client_id)
+        error = self.conflict((client_id, key if check_name else None, domains), tunnel_id)
+        if error:
+            raise error
+        port_allocator.check(claim_of(tunnel), tunnel_id)
+
+    def check_batch(self, entries: Dict[int, Optional[Entry]]) -> Optional[Tuple[int, TunnelConflict]]:
+        """
+        校验一批隧道的最终状态 {tunnel_id: entry}（None 表示删除），返回第一个冲突 (tunnel_id, TunnelConflict)
+        批次内被删除或改名/改域名的隧道原来的占用视为已释放
+        """
+        released_names = {t for t, e in entries.items() if e is None or e[1] is not None}
+        released_domains = {t for t, e in entries.items() if e is None or e[2] is not None}
+        seen_names: Dict[str, int] = {}
+        seen_domains: Dict[str, int] = {}
+        for tunnel_id, entry in entries.items():
+            if entry is None:
+                continue
+            client_id, key, domains = entry
+            if key is not None:
+                name = self._proxy(client_id, key)
+                if name in seen_names:
+                    return tunnel_id, TunnelConflict("Proxy name", name, f"is already used by tunnel {seen_names[name]}")
+                seen_names[name] = tunnel_id
+                error = self.conflict((client_id, key, None), tunnel_id, released_names)
+                if error:
+                    return tunnel_id, error
+            for domain in domains or ():
+                if domain in seen_domains:
+                    return tunnel_id, TunnelConflict("Custom domain", domain,
+                                                     f"is already used by tunnel {seen_domains[domain]}")
+                seen_domains[domain] = tunnel_id
+            error = self.conflict((client_id, None, domains), tunnel_id, released_domains)
+            if error:
+                return tunnel_id, error
+        return None
+
+    def client_name_conflict(self, client_id: str, name: str) -> Optional[TunnelConflict]:
+        """客户端改名为 name 时的冲突：名称不能与其他客户端相同，改名后的代理名也不能与其他客户端的冲突"""
+        name = client_key(name)
+        others = [c for c in self._clients_by_name.get(name, ()) if c != client_id]
+        if others:
+            return TunnelConflict("Client name", name, f"is already used by client {min(others)}")
+        own = self._client_tunnels.get(client_id, set())
+        for tunnel_id in own:
+            proxy = f"{name}.{self._tunnels[tunnel_id][1]}"
+            others = self._others(self._proxies.get(proxy), None, own)
+            if others:
+                return TunnelConflict("Proxy name", proxy, f"would collide with tunnel {min(others)}")
+        return None
+
+    def unique_client_name(self, client_id: str, name: str) -> str:
+        """Agent 上报的主机名与其他客户端冲突时，追加客户端 ID 前缀作为名称（同一客户端每次结果相同）"""
+        if self.client_name_conflict(client_id, name) is None:
+            return name
+        return f"{name}-{client_id[:8]}"
+
+    def get_stats(self) -> dict:
+        return {
+            "clients": len(self._client_names),
+            "tunnels": len(self._tunnels),
+            "proxy_names": len(self._proxies),
+            "custom_domains": len(self._domains),
+            "conflicting_proxy_names": sum(1 for t in self._proxies.values() if len(t) > 1),
+            "conflicting_domains": sum(1 for t in self._domains.values() if len(t) > 1),
+            "conflicting_client_names": sum(1 for c in self._clients_by_name.values() if len(c) > 1),
+            "conflicts_at_load": self.conflicts_at_load,
+        }
+
+
+# 全局隧道唯一性索引实例
+tunnel_index = TunnelIndex()
+
+
+if __name__ == "__main__":
+    # 校验延迟基准: python tunnel_index.py [客户端数] [每个客户端的隧道数]
+    import os
+    import random
+    import sys
+    import tempfile
+    import time
+    from types import SimpleNamespace
+
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import sessionmaker
+
+    from database import Base
+
+    n_clients = int(sys.argv[1]) if len(sys.argv) > 1 else 10_000
+    per_client = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    rng = random.Random(1)
+
+    with tempfile.TemporaryDirectory() as root:
+        engine = create_engine(f"sqlite:///{os.path.join(root, 'bench.db')}")
+        Base.metadata.create_all(engine)
+        clients = [{"id": f"{i:08x}-bench", "name": f"host-{i}", "auth_token": "x"} for i in range(n_clients)]
+        tunnels = []
+        for i in range(n_clients * per_client):
+            http = i % 2 == 0
+            tunnels.append({
+                "id": i + 1, "client_id": clients[i // per_client]["id"], "name": f"svc{i % per_client}",
+                "type": models.TunnelType.HTTP if http else models.TunnelType.TCP, "enabled": True,
+                "local_port": 80, "remote_port": None if http else 10000 + i // 2 % 50000,
+                "custom_domains": f"s{i}.example.com" if http else None,
+            })
+        with engine.begin() as conn:
+            conn.execute(models.Client.__table__.insert(), clients)
+            conn.execute(models.Tunnel.__table__.insert(), tunnels)
+
+        db = sessionmaker(bind=engine)()
+        start = time.perf_counter()
+        port_allocator.load(db)
+        tunnel_index.load(db)
+        print(f"从 SQLite 重建 {len(tunnels):,} 条隧道: {time.perf_counter() - start:.2f}s", tunnel_index.get_stats())
+        db.close()
+
+        def timed(name, fn, inputs):
+            samples = []
+            for args in inputs:
+                start = time.perf_counter()
+                fn(*args)
+                samples.append(time.perf_counter() - start)
+            samples.sort()
+            mean = sum(samples) / len(samples) * 1e6
+            print(f"{name:14s} 平均 {mean:9.1f} us  p99 {samples[int(len(samples) * 0.99)] * 1e6:9.1f} us")
+
+        def new_tunnel(i: int):
+            """i 小于隧道总数时与已有隧道的域名冲突"""
+            return SimpleNamespace(name=f"new{i}", type=models.TunnelType.HTTP, enabled=True,
+                                   remote_port=None, custom_domains=f"s{i}.example.com")
+
+        def check(tunnel, client_id):
+            try:
+                tunnel_index.check(tunnel, client_id)
+            except TunnelConflict:
+                pass
+
+        def client_id():
+            return clients[rng.randrange(n_clients)]["id"]
+
+        fresh = iter(range(len(tunnels) * 2, len(tunnels) * 100))
+        timed("单条校验 无冲突", check, [(new_tunnel(next(fresh)), client_id()) for _ in range(20_000)])
+        timed("单条校验 有冲突", check,
+              [(new_tunnel(rng.randrange(0, len(tunnels), 2)), client_id()) for _ in range(20_000)])
+        batches = [{-(k + 1): entry_of(new_tunnel(next(fresh)), client_id()) for k in range(1000)} for _ in range(50)]
+        timed("批量 1000 条", lambda entries: tunnel_index.check_batch(entries), [(b,) for b in batches])
+        timed("客户端改名校验", tunnel_index.client_name_conflict,
+              [(client_id(), f"renamed-{next(fresh)}") for _ in range(5_000)])
+        engine.dispose()
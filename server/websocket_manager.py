@@ -3,12 +3,29 @@ WebSocket 连接管理器
 用于管理 Dashboard 客户端和 Agent 的 WebSocket 连接
 """
 from fastapi import WebSocket
-from typing import Dict, Set
+from typing import Dict, List, Optional, Set, Tuple
 import asyncio
+import json
 import logging
 
+from config_cache import config_hash
+from config_delivery import config_delivery
+from log_buffer import log_buffers
+from log_filter import LogFilter
+from log_store import log_store
+
 logger = logging.getLogger(__name__)
 
+# 日志微批：攒够 LOG_BATCH_SIZE 行或等待 LOG_FLUSH_INTERVAL 秒后合并为一帧发送
+LOG_BATCH_SIZE = 200
+LOG_FLUSH_INTERVAL = 0.02
+
+# 历史日志回放时每帧的最大行数
+LOG_HISTORY_CHUNK = 1000
+
+# 断线续传时最多补发的行数（内存缓冲不够时从磁盘日志读取）
+LOG_RESUME_MAX = 10000
+
 
 class ConnectionManager:
     """管理所有 WebSocket 连接"""
@@ -22,12 +39,21 @@ class ConnectionManager:
         
         # Agent 系统信息（client_id -> system_info）
         self.agent_system_info: Dict[str, dict] = {}
+
+        
+        # 日志订阅者（client_id -> {WebSocket: 过滤条件}，None 表示不过滤）
+        self.log_subscribers: Dict[str, Dict[WebSocket, Optional[LogFilter]]] = {}
+        # 正在回放历史日志的订阅者（client_id -> {WebSocket: 回放期间到达的新日志}），回放完成后才登记到 log_subscribers
+        self._replaying: Dict[str, Dict[WebSocket, List[Tuple[int, str]]]] = {}
+        # 新登记订阅者已收到的最后序号，首次实时推送时跳过不大于它的日志
+        self._log_after: Dict[WebSocket, int] = {}
         
-        # 日志订阅者（client_id -> 订阅该客户端日志的 WebSocket 集合）
-        self.log_subscribers: Dict[str, Set[WebSocket]] = {}
+        # Agent 近期日志缓存（紧凑字节环形缓冲，全局预算 + LRU 淘汰）
+        self.log_buffers = log_buffers
         
-        # Agent 日志缓存（client_id -> deque）
-        self.agent_log_buffer: Dict[str, any] = {}
+        # 待发送给订阅者的日志（client_id -> [(序号, 行)]）及其延迟刷新任务
+        self._pending_logs: Dict[str, List[Tuple[int, str]]] = {}
+        self._flush_tasks: Dict[str, asyncio.Task] = {}
     
     # ========================
     # Dashboard 连接管理
@@ -62,6 +88,20 @@ class ConnectionManager:
         for ws in disconnected:
             self.disconnect_dashboard(ws)
     
+    async def broadcast_alert(self, event: dict):
+        """向所有 Dashboard 推送告警事件"""
+        disconnected = []
+        
+        for ws in self.dashboard_connections:
+            try:
+                await ws.send_json({"type": "alert", "data": event})
+            except Exception as e:
+                logger.warning(f"发送告警失败: {e}")
+                disconnected.append(ws)
+        
+        for ws in disconnected:
+            self.disconnect_dashboard(ws)
+    
     # ========================
     # Agent 连接管理
     # ========================
@@ -76,12 +116,14 @@ class ConnectionManager:
                 pass
         
         self.agent_connections[client_id] = websocket
+        config_delivery.disconnected(client_id)
         logger.info(f"Agent {client_id} 已连接，当前 Agent 数: {len(self.agent_connections)}")
     
     def disconnect_agent(self, client_id: str):
         """断开 Agent 连接"""
         if client_id in self.agent_connections:
             del self.agent_connections[client_id]
+            config_delivery.disconnected(client_id)
             logger.info(f"Agent {client_id} 已断开，当前 Agent 数: {len(self.agent_connections)}")
         # 保留系统信息一段时间，标记为离线
         if client_id in self.agent_system_info:
@@ -122,67 +164,225 @@ class ConnectionManager:
                 self.disconnect_agent(client_id)
         return False
     
-    async def push_config_to_agent(self, client_id: str, config: str) -> bool:
-        """推送配置更新到 Agent"""
-        return await self.send_to_agent(client_id, {
-            "type": "config_update",
-            "data": config
-        })
+    async def push_config_to_agent(self, client_id: str, config: str,
+                                   content_hash: str = None, force: bool = False) -> bool:
+        """
+        推送配置更新到 Agent，消息携带版本号和内容哈希，Agent 应用后回复 config_ack
+        
+        Agent 已确认相同内容或相同内容正在等待确认时不再发送（返回 True），force 为真时总是发送新版本；
+        未确认的推送由 retry_config_deliveries 按退避重发
+        """
+        if content_hash is None:
+            content_hash = config_hash(config)
+        delivery = config_delivery.prepare(client_id, config, content_hash, force)
+        if delivery is None:
+            return True
+        if not await self.send_to_agent(client_id, delivery.message()):
+            return False
+        config_delivery.mark_sent(delivery)
+        return True
+    
+    async def retry_config_deliveries(self):
+        """重发超时未确认的配置"""
+        for client_id, delivery in config_delivery.due(self.agent_connections):
+            logger.info(f"重发配置 v{delivery.version} 到 Agent {client_id}（第 {delivery.attempts + 1} 次）")
+            if await self.send_to_agent(client_id, delivery.message()):
+                config_delivery.mark_sent(delivery)
     
     # ========================
     # 日志订阅管理
     # ========================
     
-    async def subscribe_logs(self, websocket: WebSocket, client_id: str):
-        """订阅某客户端的日志"""
+    async def subscribe_logs(self, websocket: WebSocket, client_id: str,
+                             log_filter: LogFilter = None, after: int = None):
+        """
+        订阅某客户端的日志
         
-        if client_id not in self.log_subscribers:
-            self.log_subscribers[client_id] = set()
-        self.log_subscribers[client_id].add(websocket)
+        after 为客户端已收到的最后一个序号（断线重连时），只补发之后的日志
+        """
+        await self._replay(websocket, client_id, log_filter, after)
         logger.info(f"日志订阅: {client_id}，当前订阅者: {len(self.log_subscribers[client_id])}")
-
-        # 发送历史日志（如果有）
-        if client_id in self.agent_log_buffer:
-            history = list(self.agent_log_buffer[client_id])
-            if history:
-                try:
-                    # 批量发送或逐条发送，这里选择批量包装，但当前前端可能期待逐条
-                    # 为了兼容前端逐条处理：
-                    for log_entry in history:
-                        await websocket.send_json(log_entry)
-                except Exception as e:
-                    logger.warning(f"发送历史日志失败: {e}")
-
+    
+    async def set_log_filter(self, websocket: WebSocket, client_id: str, log_filter: Optional[LogFilter]):
+        """更新订阅者的过滤条件，并按新条件重新回放历史日志"""
+        subscribers = self.log_subscribers.get(client_id)
+        if subscribers is None or websocket not in subscribers:
+            return
+        self.unsubscribe_logs(websocket, client_id)
+        await self._replay(websocket, client_id, log_filter)
+    
+    async def _replay(self, websocket: WebSocket, client_id: str,
+                      log_filter: Optional[LogFilter], after: int = None):
+        """
+        回放历史日志后再登记为实时订阅者
+        回放期间到达的新日志先排队，历史发送完后按序补发，保证客户端收到的序号单调递增
+        """
+        queue: List[Tuple[int, str]] = []
+        self._replaying.setdefault(client_id, {})[websocket] = queue
+        try:
+            last_seq = await self._send_history(websocket, client_id, log_filter, after)
+            while queue:
+                entries = [e for e in queue if last_seq is None or e[0] > last_seq]
+                queue.clear()
+                if not entries:
+                    continue
+                last_seq = entries[-1][0]
+                matched = log_filter.apply(entries) if log_filter is not None else entries
+                if matched:
+                    await websocket.send_text(self._encode_batch(client_id, matched))
+        except Exception as e:
+            logger.warning(f"补发回放期间的日志失败: {e}")
+        finally:
+            replaying = self._replaying.get(client_id)
+            if replaying is not None:
+                replaying.pop(websocket, None)
+                if not replaying:
+                    del self._replaying[client_id]
+        
+        # 队列已清空，到登记之间没有 await，之后的新日志都走实时推送
+        self.log_subscribers.setdefault(client_id, {})[websocket] = log_filter
+        if last_seq is not None:
+            self._log_after[websocket] = last_seq
+    
+    async def _send_history(self, websocket: WebSocket, client_id: str,
+                            log_filter: Optional[LogFilter], after: int = None) -> Optional[int]:
+        """
+        发送历史日志（如果有），按 LOG_HISTORY_CHUNK 分块，每块一帧
+        返回历史覆盖到的最后序号（过滤前），没有历史时返回 after
+        """
+        # 订阅者已进入回放队列，且这里到快照之间没有 await，之后的新日志都会进入回放队列
+        first_seq, lines = self.log_buffers.entries(client_id, after)
+        history = list(zip(range(first_seq, first_seq + len(lines)), lines)) if lines else []
+        last_seq = history[-1][0] if history else after
+        
+        try:
+            # 内存缓冲不覆盖续传位置时，从磁盘日志补齐缺口
+            if after is not None and (first_seq is None or after + 1 < first_seq):
+                lost, older = await asyncio.get_running_loop().run_in_executor(
+                    None, self._read_stored, client_id, after + 1, first_seq
+                )
+                if lost:
+                    await websocket.send_json({
+                        "type": "log_gap",
+                        "client_id": client_id,
+                        "after": after,
+                        "lost": lost,
+                        "next_seq": after + 1 + lost,
+                    })
+                history = older + history
+            
+            if log_filter is not None:
+                history = log_filter.apply(history)
+            for i in range(0, len(history), LOG_HISTORY_CHUNK):
+                await websocket.send_text(self._encode_batch(
+                    client_id, history[i:i + LOG_HISTORY_CHUNK], history=True
+                ))
+        except Exception as e:
+            logger.warning(f"发送历史日志失败: {e}")
+        return last_seq
+    
+    @staticmethod
+    def _read_stored(client_id: str, start: int, end: Optional[int]) -> Tuple[int, List[Tuple[int, str]]]:
+        """
+        从磁盘日志读取序号 [start, end) 的日志（end 为空表示到最新），最多 LOG_RESUME_MAX 行
+        返回 (丢失的行数, [(序号, 行)])，丢失的行是已被清理或超出补发上限的部分
+        """
+        bounds = log_store.read(client_id, offset=start, limit=1)
+        if end is None:
+            end = bounds["next_offset"]
+        begin = max(start, bounds["first_offset"], end - LOG_RESUME_MAX)
+        if begin >= end:
+            return max(0, end - start), []
+        logs = log_store.read(client_id, offset=begin, limit=end - begin)["logs"]
+        return begin - start, [(e["offset"], e["line"]) for e in logs if e["offset"] < end]
     
     def unsubscribe_logs(self, websocket: WebSocket, client_id: str):
         """取消日志订阅"""
+        self._log_after.pop(websocket, None)
         if client_id in self.log_subscribers:
-            self.log_subscribers[client_id].discard(websocket)
+            self.log_subscribers[client_id].pop(websocket, None)
             if not self.log_subscribers[client_id]:
                 del self.log_subscribers[client_id]
     
-    async def broadcast_log(self, client_id: str, log_line: str):
-        """广播日志到所有订阅者，并缓存最近日志"""
-        
-        message = {"type": "log", "data": log_line, "client_id": client_id}
+    @staticmethod
+    def _encode_batch(client_id: str, entries: List[Tuple[int, str]], history: bool = False) -> str:
+        """日志批量帧: {"type": "log_batch", "client_id", "data": [行...], "seqs": [序号...], "history"}"""
+        return json.dumps({
+            "type": "log_batch",
+            "client_id": client_id,
+            "data": [line for _, line in entries],
+            "seqs": [seq for seq, _ in entries],
+            "history": history,
+        }, ensure_ascii=False)
+    
+    async def broadcast_log(self, client_id: str, seq: int, log_line: str):
+        """缓存日志，并按微批方式推送给订阅者（seq 为该客户端内单调递增的序号）"""
         
         # 1. 缓存日志
-        if client_id not in self.agent_log_buffer:
-            from collections import deque
-            self.agent_log_buffer[client_id] = deque(maxlen=2000)
-        self.agent_log_buffer[client_id].append(message)
-        
-        # 2. 广播给订阅者
-        subscribers = self.log_subscribers.get(client_id, set())
-        if not subscribers:
+        self.log_buffers.append(client_id, seq, log_line)
+        
+        # 2. 正在回放历史的订阅者先排队
+        replaying = self._replaying.get(client_id)
+        if replaying:
+            for queue in replaying.values():
+                queue.append((seq, log_line))
+        
+        # 3. 没有订阅者时只缓存
+        if not self.log_subscribers.get(client_id):
             return
         
-        disconnected = []
+        pending = self._pending_logs.setdefault(client_id, [])
+        pending.append((seq, log_line))
+        if len(pending) >= LOG_BATCH_SIZE:
+            await self._flush_logs(client_id)
+        elif client_id not in self._flush_tasks:
+            self._flush_tasks[client_id] = asyncio.create_task(self._delayed_flush(client_id))
+    
+    async def _delayed_flush(self, client_id: str):
+        try:
+            await asyncio.sleep(LOG_FLUSH_INTERVAL)
+        finally:
+            self._flush_tasks.pop(client_id, None)
+        await self._flush_logs(client_id)
+    
+    async def _flush_logs(self, client_id: str):
+        """把待发送日志合并为一帧发给所有订阅者（只序列化一次）"""
+        entries = self._pending_logs.pop(client_id, None)
+        subscribers = self.log_subscribers.get(client_id)
+        if not entries or not subscribers:
+            return
+        
+        # 按过滤条件分组，每组只过滤、序列化一次；刚回放完历史的订阅者跳过已收到的日志，单独发送
+        groups: Dict[tuple, list] = {}
+        own: List[Tuple[WebSocket, Optional[LogFilter], List[Tuple[int, str]]]] = []
+        for ws, log_filter in subscribers.items():
+            after = self._log_after.pop(ws, None)
+            if after is not None and entries[0][0] <= after:
+                own.append((ws, log_filter, [e for e in entries if e[0] > after]))
+                continue
+            key = log_filter.key if log_filter is not None else None
+            if key not in groups:
+                groups[key] = [log_filter, []]
+            groups[key][1].append(ws)
         
-        for ws in subscribers:
+        disconnected = []
+        for log_filter, websockets in groups.values():
+            matched = log_filter.apply(entries) if log_filter is not None else entries
+            if not matched:
+                continue
+            frame = self._encode_batch(client_id, matched)
+            for ws in websockets:
+                try:
+                    await ws.send_text(frame)
+                except Exception:
+                    disconnected.append(ws)
+        for ws, log_filter, remaining in own:
+            matched = log_filter.apply(remaining) if log_filter is not None and remaining else remaining
+            if not matched:
+                continue
             try:
-                await ws.send_json(message)
-            except:
+                await ws.send_text(self._encode_batch(client_id, matched))
+            except Exception:
                 disconnected.append(ws)
         
         # 清理断开的连接
@@ -199,7 +399,9 @@ class ConnectionManager:
             "dashboard_connections": len(self.dashboard_connections),
             "agent_connections": len(self.agent_connections),
             "online_agents": list(self.agent_connections.keys()),
-            "log_subscribers": {k: len(v) for k, v in self.log_subscribers.items()}
+            "log_subscribers": {k: len(v) for k, v in self.log_subscribers.items()},
+            "log_buffers": {**self.log_buffers.get_stats(), "clients_usage": self.log_buffers.usage()},
+            "config_delivery": config_delivery.get_stats(),
         }
     
     async def broadcast_ping(self):